@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import shutil
+import resource
+import tempfile
+import subprocess
+import importlib.util
+
+VECTOR_STORE_PATH = os.path.join(os.path.dirname(__file__), '..', 'testflow', 'memories', 'vector_store.py')
+BACKENDS = ['numpy', 'chroma']
+MODES = ['memory', 'persistent']
+
+WIDGET_TYPES = ['Button', 'TextView', 'ImageButton', 'EditText', 'CheckBox', 'Switch']
+WORDS = ['settings', 'alarm', 'timer', 'delete', 'save', 'share', 'add', 'edit', 'search', 'menu', 'back', 'about', 'help', 'sort', 'filter', 'export']
+
+
+def make_state_signature(rng, page):
+    widgets = [f'{rng.choice(WIDGET_TYPES)} "{rng.choice(WORDS)} {rng.choice(WORDS)}"' for _ in range(rng.randint(10, 40))]
+    return f'{page} page: ' + ', '.join(widgets)
+
+
+def make_entries(n_entries, n_pages, n_widgets, seed=0):
+    """
+    Synthetic widget observations shaped like the entries of SpatialMemory
+    """
+    rng = random.Random(seed)
+    ids, documents, metadatas = [], [], []
+    for i in range(n_entries):
+        page = f'Page{rng.randrange(n_pages)}'
+        ids.append(str(i + 1))
+        documents.append(make_state_signature(rng, page))
+        metadatas.append({
+            'type': 'WIDGET',
+            'page': page,
+            'widget': f'widget{rng.randrange(n_widgets)}',
+            'action': rng.choice(['touch', 'long_touch', 'scroll down']),
+            'observation': f'The app shows the {rng.choice(WORDS)} page',
+            'timestamp': '2024-01-01 00:00:00',
+        })
+    return ids, documents, metadatas
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if len(values) > 0 else 0.0
+
+
+def run_worker(backend, mode, n_entries, n_queries, n_pages, n_widgets):
+    """
+    Measure one backend in this process and print the results as JSON
+    """
+    # a persistent client writes to a fresh directory, so that the cost of persisting each write shows up
+    path = tempfile.mkdtemp(prefix='benchmark_vector_store_') if mode == 'persistent' else None
+
+    start_time = time.perf_counter()
+    if backend == 'numpy':
+        spec = importlib.util.spec_from_file_location('vector_store', VECTOR_STORE_PATH)
+        vector_store = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(vector_store)
+        client = vector_store.NumpyClient(path=path)
+    else:
+        import chromadb
+        client = chromadb.PersistentClient(path=path) if path is not None else chromadb.Client()
+    import_time = time.perf_counter() - start_time
+
+    collection = client.get_or_create_collection(name='benchmark_knowledge')
+    ids, documents, metadatas = make_entries(n_entries, n_pages, n_widgets)
+
+    start_time = time.perf_counter()
+    for i in range(0, n_entries, 100):
+        collection.upsert(ids=ids[i:i + 100], documents=documents[i:i + 100], metadatas=metadatas[i:i + 100])
+    insert_time = time.perf_counter() - start_time
+
+    # single-entry writes, as done by add_entry (write-through) and inject_activity
+    upsert_latencies = []
+    for i in range(min(n_queries, n_entries)):
+        start_time = time.perf_counter()
+        collection.upsert(ids=[ids[i]], documents=[documents[i]], metadatas=[metadatas[i]])
+        upsert_latencies.append(time.perf_counter() - start_time)
+
+    rng = random.Random(1)
+    query_latencies, get_latencies = [], []
+    for _ in range(n_queries):
+        page = f'Page{rng.randrange(n_pages)}'
+        widgets = [f'widget{rng.randrange(n_widgets)}' for _ in range(5)]
+        where = {'$and': [{'type': 'WIDGET'}, {'page': page}, {'$or': [{'widget': w} for w in widgets]}]}
+
+        start_time = time.perf_counter()
+        collection.query(query_texts=[make_state_signature(rng, page)], n_results=25, where=where)
+        query_latencies.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        collection.get(where={'$and': [{'type': 'WIDGET'}, {'page': page}]}, include=['metadatas'])
+        get_latencies.append(time.perf_counter() - start_time)
+
+    if path is not None:
+        shutil.rmtree(path, ignore_errors=True)
+
+    print(json.dumps({
+        'backend': backend,
+        'mode': mode,
+        'import_s': import_time,
+        'insert_s': insert_time,
+        'upsert_p50_ms': percentile(upsert_latencies, 0.5) * 1000,
+        'query_p50_ms': percentile(query_latencies, 0.5) * 1000,
+        'query_p95_ms': percentile(query_latencies, 0.95) * 1000,
+        'get_p50_ms': percentile(get_latencies, 0.5) * 1000,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the NumPy and Chroma memory backends (import time, latency, RSS)')
+    parser.add_argument('--backends', type=str, nargs='+', default=BACKENDS, choices=BACKENDS)
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES, help='in-memory and/or persistent clients')
+    parser.add_argument('--entries', type=int, default=3000, help='number of stored widget observations')
+    parser.add_argument('--queries', type=int, default=200, help='number of queries per backend')
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--widgets', type=int, default=200)
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--worker_mode', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        run_worker(args.worker, args.worker_mode, args.entries, args.queries, args.pages, args.widgets)
+        sys.exit(0)
+
+    # each backend runs in a fresh interpreter so that import time and RSS are not shared
+    results = []
+    for backend in args.backends:
+        for mode in args.modes:
+            process = subprocess.run(
+                [sys.executable, __file__, '--worker', backend, '--worker_mode', mode, '--entries', str(args.entries), '--queries', str(args.queries), '--pages', str(args.pages), '--widgets', str(args.widgets)],
+                capture_output=True, text=True
+            )
+            if process.returncode != 0:
+                print(f'{backend} ({mode}): failed\n{process.stderr.strip().splitlines()[-1] if process.stderr.strip() else ""}')
+                continue
+            results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    columns = ['backend', 'mode', 'import_s', 'insert_s', 'upsert_p50_ms', 'query_p50_ms', 'query_p95_ms', 'get_p50_ms', 'max_rss_mb']
+    print(' '.join(f'{c:>13}' for c in columns))
+    for result in results:
+        print(' '.join(f'{result[c]:>13.3f}' if isinstance(result[c], float) else f'{result[c]:>13}' for c in columns))
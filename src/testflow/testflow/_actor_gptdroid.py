@@ -8,6 +8,7 @@ import openai
 
 from .app_state import AppState
 from .config import agent_config
+from .metrics import MetricsRegistry
 from .utils.logger import Logger
 from .types.action import *
 from .prompts.act_gptdroid_style import prompt_first_action, prompt_next_action
@@ -32,7 +33,8 @@ class GPTDroidActor():
         self.performed_actions = []
 
     def decide_first_action(self):
-        action = prompt_first_action(self.memory, self.current_prompt)
+        with MetricsRegistry.component('actor'):
+            action = prompt_first_action(self.memory, self.current_prompt)
         self.performed_actions.append(action)
         self.memory.spatial_memory.add_widget_wise_observation(
             AppState.current_activity, 
@@ -54,7 +56,8 @@ class GPTDroidActor():
         while action is None:
             try:
                 original_prompt = copy.deepcopy(self.current_prompt)
-                action = prompt_next_action(self.memory, error_message=None, full_prompt=self.current_prompt, contain_feedback=contain_feedback)
+                with MetricsRegistry.component('actor'):
+                    action = prompt_next_action(self.memory, error_message=None, full_prompt=self.current_prompt, contain_feedback=contain_feedback)
             except (openai.BadRequestError) as e:
                 # exceed max token limit: initialize prompt
                 logger.info(f'Exceeded max token limit. Initialize prompt.')
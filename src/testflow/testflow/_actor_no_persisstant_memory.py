@@ -7,6 +7,7 @@ from .app_state import AppState
 
 from .types.action import *
 from .utils.stringutil import add_period
+from .metrics import MetricsRegistry
 from .utils.logger import Logger
 from .prompts.act import prompt_action
 from .prompts.critique_during_task import prompt_critique
@@ -34,7 +35,8 @@ class ActorNonPM:
         # Inject critique periodically
         if self.critique_countdown == 0:
             self.critique_countdown = CRITIQUE_COUNTDOWN
-            critique, workaround = prompt_critique(self.memory, self.prompt_recorder)
+            with MetricsRegistry.component('critique'):
+                critique, workaround = prompt_critique(self.memory, self.prompt_recorder)
             full_critique = ''
             if critique is not None:
                 full_critique += f'{add_period(critique)}'
@@ -49,7 +51,8 @@ class ActorNonPM:
 
         self.critique_countdown -= 1
 
-        action = prompt_action(self.memory, self.prompt_recorder, "", "")
+        with MetricsRegistry.component('actor'):
+            action = prompt_action(self.memory, self.prompt_recorder, "", "")
 
         if action is not None:
             self.action_count += 1
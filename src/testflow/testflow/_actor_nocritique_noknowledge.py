@@ -4,6 +4,7 @@ import logging
 import time
 
 from .app_state import AppState
+from .metrics import MetricsRegistry
 
 from .utils import *
 from .types.action import *
@@ -26,7 +27,8 @@ class NoCritiqueActor:
     def act(self): # use function call for selecting the action
         assert self.memory.working_memory.task is not None, 'No task is registered'
 
-        action = prompt_action(self.memory, self.prompt_recorder)
+        with MetricsRegistry.component('actor'):
+            action = prompt_action(self.memory, self.prompt_recorder)
 
         if action is not None:
             self.action_count += 1
@@ -5,6 +5,7 @@ import time
 
 from .app_state import AppState
 from .utils.stringutil import add_period
+from .metrics import MetricsRegistry
 from .utils.logger import Logger
 from .types.action import *
 
@@ -34,7 +35,8 @@ class NoKnowledgeActor:
         # Inject critique periodically
         if self.critique_countdown == 0:
             self.critique_countdown = CRITIQUE_COUNTDOWN
-            critique, workaround = prompt_critique(self.memory, self.prompt_recorder)
+            with MetricsRegistry.component('critique'):
+                critique, workaround = prompt_critique(self.memory, self.prompt_recorder)
             full_critique = ''
             if critique is not None:
                 full_critique += f'{add_period(critique)}'
@@ -49,7 +51,8 @@ class NoKnowledgeActor:
 
         self.critique_countdown -= 1
 
-        action = prompt_action(self.memory, self.prompt_recorder)
+        with MetricsRegistry.component('actor'):
+            action = prompt_action(self.memory, self.prompt_recorder)
 
         if action is not None:
             self.action_count += 1
@@ -7,6 +7,7 @@ from .app_state import AppState
 
 from .types.action import *
 from .types.task import Task
+from .metrics import MetricsRegistry
 from .utils.logger import Logger
 from .prompts.plan_noknowledge import *
 from .memories.working_memory import WorkingMemory
@@ -26,7 +27,9 @@ class NoKnowledgePlanner:
     Task-based planning (independence between planner and actor)
     """
     def plan_task(self):
-        task_desc, task_end_condition, plan, first_action = prompt_new_task(self.memory, self.prompt_recorder)
+        MetricsRegistry.set_task(None) # planning is not attributed to the previous task
+        with MetricsRegistry.component('planner'):
+            task_desc, task_end_condition, plan, first_action = prompt_new_task(self.memory, self.prompt_recorder)
 
         if task_desc is None or first_action is None:
             return None
@@ -40,6 +43,7 @@ class NoKnowledgePlanner:
         task.entry_id = self.memory.task_memory.record_task(f'{agent_config.persona_name} planned a new task: {task.summary}')
         
         self.memory.working_memory = WorkingMemory(task)
+        MetricsRegistry.set_task(task.summary)
         self.memory.working_memory.add_step(first_action, AppState.current_activity, 'ACTION')
         
         return first_action
@@ -2,8 +2,8 @@ import os
 import logging
 
 from .config import agent_config
-from .model import APIUsageManager
 from .types.action import *
+from .metrics import MetricsRegistry
 from .utils.logger import Logger
 from .prompts.verify_task import verify_task
 
@@ -19,7 +19,8 @@ class Verifier:
     def verify_action_result(self):
         task = self.memory.working_memory.task
 
-        screen_description, task_done = verify_task(self.memory, self.prompt_recorder)
+        with MetricsRegistry.component('verifier'):
+            screen_description, task_done = verify_task(self.memory, self.prompt_recorder)
         
         # task.add_result(task_result, task_result_summary)
         # self.memory.task_memory.record_task_result(task, reflections, self.memory.working_memory.steps)
@@ -12,10 +12,12 @@ from pathlib import Path
 
 from .app_state import AppState
 from .types.gui_state import GUIState
-from .memories.memory import Memory
+from .memories.memory import Memory, PersistentStorageManager, storage_name, STORAGE_PER_APK
+from .memories.memory_journal import MemoryJournal, MEMORY_JOURNAL_FILE
 from .utils.prompt_recorder import PromptRecorder
 from .utils.logger import Logger
-from .model import APIUsageManager
+from .metrics import MetricsRegistry
+from .routing import ModelRouter
 
 from .config import agent_config
 
@@ -63,22 +65,29 @@ class Agent:
             # log agent_config app name
             logger.info(f"Agent Config App Name: {agent_config.app_name}")
 
-            # exp_id is app name for memory to create persistent data every run time
-            # safe_exp_id = agent_config.app_name.replace(' ', '_').replace('.', '_')
-            safe_exp_id = "test"
+            # storages are named (and, if persistent, stored) per app, so that runs on the same app share knowledge
+            storage_dir = PersistentStorageManager.open_app_storage(
+                agent_config.package_name,
+                apk_hash=app.hashes[2] if STORAGE_PER_APK else None,
+            )
+            if storage_dir is not None:
+                logger.info(f"Using persistent memory storage: {storage_dir}")
+
             self.exp_id = agent_config.app_name
             self.prompt_recorder = PromptRecorder()
-            self.memory = Memory(name=safe_exp_id)
+            self.memory = Memory(name=storage_name(agent_config.package_name))
+            self.memory_journal = None
 
         AppState.initialize(agent_config.app_name, agent_config.app_activities)
         logger.info(f"Initialized an Agent with ID: {agent_config.app_name}")
 
     def save_memory_snapshot(self):
-        memory_snapshot_dir = os.path.join(
-            agent_config.agent_output_dir, "memory_snapshots", f"step_{self.step_count}"
-        )
-        os.makedirs(memory_snapshot_dir, exist_ok=True)
-        self.memory.save_snapshot(memory_snapshot_dir)
+        # only the changes of the step are appended to the journal; the snapshot of a step is
+        # rebuilt on demand with `python -m testflow.materialize_memory`
+        journal_path = os.path.join(agent_config.agent_output_dir, MEMORY_JOURNAL_FILE)
+        if self.memory_journal is None or self.memory_journal.path != journal_path:
+            self.memory_journal = MemoryJournal(journal_path)
+        self.memory.journal_step(self.memory_journal, self.step_count)
 
     def step(self, droidbot_state=None):
         raise NotImplementedError
@@ -93,10 +102,20 @@ class Agent:
             "app_activities": AppState.activities,
             "visited_activities": AppState.visited_activities,
             "task_results": self.memory.task_memory.task_results,
-            "API_usage": APIUsageManager.usage,
-            "API_response_time": APIUsageManager.response_time,
+            "API_usage": MetricsRegistry.usage_by_model(),
+            "API_metrics": MetricsRegistry.snapshot(),
+            "API_escalations": ModelRouter.escalation_summary(),
         }
 
+    def save_exp_data(self):
+        # runs at every step boundary: the memory writes the entries buffered during the step
+        self.memory.flush()
+        with open(
+            os.path.join(agent_config.agent_output_dir, "exp_data.json"), "w"
+        ) as f:
+            json.dump(self.exp_data, f, indent=2)
+        MetricsRegistry.export(agent_config.agent_output_dir)
+
 
 class TaskBasedAgent(Agent):
     """
@@ -156,10 +175,7 @@ class TaskBasedAgent(Agent):
         if droidbot_state is not None:
             self.set_current_gui_state(droidbot_state)
 
-        with open(
-            os.path.join(agent_config.agent_output_dir, "exp_data.json"), "w"
-        ) as f:
-            json.dump(self.exp_data, f, indent=2)
+        self.save_exp_data()
 
         if self.mode == MODE_PLAN:
             """
@@ -196,10 +212,7 @@ class TaskBasedAgent(Agent):
             self.mode = MODE_PLAN
             # Stop if run time is reached
             if self.run_count >= MAX_RUN or task_result:
-                with open(
-                    os.path.join(agent_config.agent_output_dir, "exp_data.json"), "w"
-                ) as f:
-                    json.dump(self.exp_data, f, indent=2)
+                self.save_exp_data()
                 return True
             return None
 
@@ -327,10 +340,7 @@ class SpecificTaskBasedAgent(Agent):
         if droidbot_state is not None:
             self.set_current_gui_state(droidbot_state)
 
-        with open(
-            os.path.join(agent_config.agent_output_dir, "exp_data.json"), "w"
-        ) as f:
-            json.dump(self.exp_data, f, indent=2)
+        self.save_exp_data()
 
         if self.mode == MODE_PLAN:
             """
@@ -427,8 +437,7 @@ class SpecificTaskBasedAgent(Agent):
                         
             # Stop if run time is reached
             if self.run_count >= MAX_RUN or task_result and (agent_config.train is not None or agent_config.evaluate is not None):
-                with open(os.path.join(agent_config.agent_output_dir, 'exp_data.json'), 'w') as f:
-                    json.dump(self.exp_data, f, indent=2)
+                self.save_exp_data()
                 result = True if task_result == 'SUCCESS' else False
 
                 # reset app back to main activity
@@ -577,8 +586,7 @@ class NonVerifySpecificTaskBasedAgent(Agent):
         if droidbot_state is not None:
             self.set_current_gui_state(droidbot_state)
 
-        with open(os.path.join(agent_config.agent_output_dir, 'exp_data.json'), 'w') as f:
-            json.dump(self.exp_data, f, indent=2)
+        self.save_exp_data()
 
         if self.mode == MODE_PLAN:
             """
@@ -675,8 +683,7 @@ class NonVerifySpecificTaskBasedAgent(Agent):
                         
             # Stop if run time is reached
             if self.run_count >= MAX_RUN or task_result and (agent_config.train is not None or agent_config.evaluate is not None):
-                with open(os.path.join(agent_config.agent_output_dir, 'exp_data.json'), 'w') as f:
-                    json.dump(self.exp_data, f, indent=2)
+                self.save_exp_data()
                 result = True if task_result == 'SUCCESS' else False
 
                 # reset app back to main activity
@@ -823,8 +830,7 @@ class NonPMSpecificTaskBasedAgent(Agent):
         if droidbot_state is not None:
             self.set_current_gui_state(droidbot_state)
 
-        with open(os.path.join(agent_config.agent_output_dir, 'exp_data.json'), 'w') as f:
-            json.dump(self.exp_data, f, indent=2)
+        self.save_exp_data()
 
         if self.mode == MODE_PLAN:
             """
@@ -921,8 +927,7 @@ class NonPMSpecificTaskBasedAgent(Agent):
                         
             # Stop if run time is reached
             if self.run_count >= MAX_RUN or task_result and (agent_config.train is not None or agent_config.evaluate is not None):
-                with open(os.path.join(agent_config.agent_output_dir, 'exp_data.json'), 'w') as f:
-                    json.dump(self.exp_data, f, indent=2)
+                self.save_exp_data()
                 result = True if task_result == 'SUCCESS' else False
 
                 # reset app back to main activity
@@ -1098,10 +1103,7 @@ class TaskBasedAgentNoCritiqueNoKnowledge(Agent):
             f"Current Activity Coverage: {len(AppState.visited_activities)} / {len(agent_config.app_activities)}"
         )
 
-        with open(
-            os.path.join(agent_config.agent_output_dir, "exp_data.json"), "w"
-        ) as f:
-            json.dump(self.exp_data, f, indent=2)
+        self.save_exp_data()
 
         if droidbot_state is not None:
             self.set_current_gui_state(droidbot_state)
@@ -1230,10 +1232,7 @@ class TaskBasedAgentNoKnowledge(Agent):
         if droidbot_state is not None:
             self.set_current_gui_state(droidbot_state)
 
-        with open(
-            os.path.join(agent_config.agent_output_dir, "exp_data.json"), "w"
-        ) as f:
-            json.dump(self.exp_data, f, indent=2)
+        self.save_exp_data()
 
         if self.mode == MODE_PLAN:
             """
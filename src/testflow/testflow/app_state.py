@@ -26,7 +26,7 @@ class AppState:
 
     @classmethod
     def set_current_gui_state(cls, droidbot_state):
-        cls._set_current_gui_state(GUIState().from_droidbot_state(droidbot_state))
+        cls._set_current_gui_state(GUIState().from_droidbot_state(droidbot_state, previous_state=cls.current_gui_state))
         app_activity_depth = cls.current_gui_state.get_app_activity_depth()
         if app_activity_depth != 0:
             logger.warning(f'App is not in the foreground. Current activity stack: {cls.current_gui_state.activity_stack}')
@@ -52,7 +52,8 @@ class AppState:
 
     @classmethod
     def capture_temporary_message(cls, droidbot_state):
-        gui_state = GUIState().from_droidbot_state(droidbot_state)
+        # the intermediate screen mostly shares its subtrees with the current one
+        gui_state = GUIState().from_droidbot_state(droidbot_state, previous_state=cls.current_gui_state)
 
         _, appeared_widgets, _ = cls.current_gui_state.diff_widgets(gui_state)
 
@@ -7,6 +7,7 @@ from .utils.activity_name_manager import ActivityNameManager
 
 file_dir = os.path.dirname(os.path.realpath(__file__))
 GPT_4O = "gpt-4o"
+GPT_4O_MINI = "gpt-4o-mini"
 GPT_4 = "gpt-4-turbo"
 GPT_3_5 = "gpt-3.5-turbo-0125"
 # GPT_3_5 = 'gpt-3.5-turbo-0613'
@@ -71,6 +72,17 @@ class AgentConfig:
         self.knowledge_summary_model = GPT_4O
         self.verifier_model = GPT_4O
 
+        # select the actor's action, reasoning and text input in one structured call
+        self.single_call_action = True
+
+        # try low-stakes prompts on a cheaper model first (see routing.py)
+        self.model_cascade = True
+        self.cascade_model = GPT_4O_MINI
+
+        # text format of the screen in prompts (see types/screen_encoders.py), optionally overridden per prompt
+        self.screen_encoder = "json"
+        self.prompt_screen_encoders = {}  # prompt name (e.g. "act", "plan") -> encoder name
+
     @cached_property
     def persona_name(self):
         if self.persona is None:
@@ -109,6 +121,11 @@ class AgentConfig:
             "planner_model": self.planner_model,
             "reflector_model": self.reflector_model,
             "verifier_model": self.verifier_model,
+            "single_call_action": self.single_call_action,
+            "model_cascade": self.model_cascade,
+            "cascade_model": self.cascade_model,
+            "screen_encoder": self.screen_encoder,
+            "prompt_screen_encoders": self.prompt_screen_encoders,
             "activity_name_map": ActivityNameManager.activity_name_restore_map,
         }
         if self.persona is not None:
@@ -127,8 +144,16 @@ class AgentConfig:
         self.planner_model = saved_dict["planner_model"]
         self.reflector_model = saved_dict["reflector_model"]
         self.verifier_model = saved_dict["verifier_model"]
+        self.single_call_action = saved_dict.get("single_call_action", True)
+        self.model_cascade = saved_dict.get("model_cascade", True)
+        self.cascade_model = saved_dict.get("cascade_model", GPT_4O_MINI)
+        self.screen_encoder = saved_dict.get("screen_encoder", "json")
+        self.prompt_screen_encoders = saved_dict.get("prompt_screen_encoders", {})
         self.persona = Persona(saved_dict["persona"])
 
+    def screen_encoder_for(self, prompt):
+        return self.prompt_screen_encoders.get(prompt, self.screen_encoder)
+
     def set_debug_mode(self):
         self.actor_model = GPT_4O
         self.observer_model = GPT_4O
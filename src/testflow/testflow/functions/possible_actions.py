@@ -14,6 +14,32 @@ def initialize_possible_actions():
 
     return possible_action_functions, function_map
 
+def initialize_single_call_actions():
+    """
+    Action functions for selecting an action in one round trip: every function also takes the
+    reasoning for the choice, and set_text takes the text to fill in
+    """
+    possible_action_functions = {}
+    function_map = {}
+    current_context.set_widgets(AppState.current_gui_state.actiontype2widgets)
+    function_creators = [create_touch_action_definition, create_set_text_self_contained_action_definition, create_scroll_action_definition, create_long_touch_action_definition, create_go_back_action_definition, create_end_task_definition, create_wait_definition]
+
+    for function_creator in function_creators:
+        function_def, func = function_creator()
+        parameters = function_def['function']['parameters']
+        parameters['properties'] = {
+            'reasoning': {
+                'type': 'string',
+                'description': 'The filled-out reasoning template for selecting this action.',
+            },
+            **parameters['properties'],
+        }
+        parameters['required'] = ['reasoning'] + parameters.get('required', [])
+        possible_action_functions[function_def['function']['name']] = function_def
+        function_map[function_def['function']['name']] = func
+
+    return possible_action_functions, function_map
+
 class Context:
     def __init__(self):
         self.actiontype2widgets = {}
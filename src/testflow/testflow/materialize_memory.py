@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import argparse
+
+from .memories.memory import PersistentStorage
+from .memories.memory_journal import (
+    MemoryJournal,
+    MEMORY_JOURNAL_FILE,
+    SCRATCH_FILE,
+    LONG_TERM_MEMORY_FILE,
+)
+
+
+def materialize_snapshot(journal_path, step=None, output_dir=None):
+    """
+    Write the memory snapshot (scratch.json and long_term_memory.txt) of a step from the memory journal
+    :param step: int, the step of the snapshot (the last journaled step if None)
+    :param output_dir: str, defaults to `memory_snapshots/step_<step>` next to the journal
+    :return: str, the directory of the snapshot
+    """
+    working_memory_record, history_entries, last_step = MemoryJournal.replay(
+        journal_path, step=step
+    )
+    if last_step is None:
+        raise ValueError(f"No journaled step up to step {step} in {journal_path}")
+
+    if output_dir is None:
+        output_dir = os.path.join(
+            os.path.dirname(os.path.abspath(journal_path)),
+            "memory_snapshots",
+            f"step_{step if step is not None else last_step}",
+        )
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(os.path.join(output_dir, SCRATCH_FILE), "w") as f:
+        json.dump(working_memory_record, f, indent=2)
+
+    task_history_record = PersistentStorage.stringify_entries(
+        history_entries, mode="task_history"
+    )
+    with open(os.path.join(output_dir, LONG_TERM_MEMORY_FILE), "w") as f:
+        f.write(task_history_record)
+
+    return output_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild the memory snapshot of a step from the memory journal of a run"
+    )
+    parser.add_argument("path", help=f"output directory of a run, or its {MEMORY_JOURNAL_FILE}")
+    parser.add_argument("--step", type=int, default=None, help="step of the snapshot (default: the last step)")
+    parser.add_argument("--output", type=str, default=None, help="directory to write the snapshot to (default: memory_snapshots/step_<step>)")
+    args = parser.parse_args()
+
+    journal_path = args.path
+    if os.path.isdir(journal_path):
+        journal_path = os.path.join(journal_path, MEMORY_JOURNAL_FILE)
+    if not os.path.exists(journal_path):
+        sys.exit(f"No memory journal found at {journal_path}")
+
+    try:
+        snapshot_dir = materialize_snapshot(journal_path, step=args.step, output_dir=args.output)
+    except ValueError as e:
+        sys.exit(str(e))
+    print(f"Memory snapshot written to {snapshot_dir}")
@@ -0,0 +1,96 @@
+"""
+Embeds each distinct text once: state signatures are queried for every widget of a screen and stored
+with every observation, so the memories embed the same long texts over and over otherwise.
+"""
+
+import os
+import hashlib
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get('TESTFLOW_EMBEDDING_CACHE_SIZE', 2048)) # embeddings kept in memory
+EMBEDDING_CACHE_DIR = os.environ.get('TESTFLOW_EMBEDDING_CACHE_DIR', None) # also keeps embeddings on disk across runs if set
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class CachedEmbeddingFunction:
+    """
+    Wraps an embedding function (texts -> vectors) with an LRU cache keyed by the hash of the text,
+    and optionally a directory of `<hash>.npy` files shared between runs
+    """
+    def __init__(self, embedding_function, capacity=EMBEDDING_CACHE_SIZE, cache_dir=EMBEDDING_CACHE_DIR):
+        """
+        :param cache_dir: str, root of the on-disk tier; embeddings of different functions are kept apart
+        """
+        self.embedding_function = embedding_function
+        self.capacity = capacity
+        self.cache = OrderedDict() # content hash -> float32 vector, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = os.path.join(cache_dir, type(embedding_function).__name__)
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        if self.cache_dir is not None:
+            try:
+                embedding = np.load(os.path.join(self.cache_dir, f'{key}.npy'))
+            except (OSError, ValueError):
+                return None
+            self._store(key, embedding, persist=False)
+            return embedding
+        return None
+
+    def _store(self, key, embedding, persist=True):
+        with self._lock:
+            self.cache[key] = embedding
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+        if persist and self.cache_dir is not None:
+            # write then rename, so that concurrent runs never read a partial file
+            path = os.path.join(self.cache_dir, f'{key}.npy')
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, embedding)
+            os.replace(tmp_path, path)
+
+    def __call__(self, input):
+        """
+        :param input: list of str
+        :return: list of embeddings (lists of floats), as Chroma expects from an embedding function
+        """
+        keys = [content_hash(text) for text in input]
+        embeddings = [self._lookup(key) for key in keys]
+
+        # each distinct missing text is embedded once, in a single batch
+        missing = list(OrderedDict((key, text) for key, text, embedding in zip(keys, input, embeddings) if embedding is None).items())
+        self.hits += len(keys) - sum(1 for embedding in embeddings if embedding is None)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            computed = self.embedding_function([text for _, text in missing])
+            new_embeddings = {}
+            for (key, _), embedding in zip(missing, computed):
+                new_embeddings[key] = np.asarray(embedding, dtype=np.float32)
+                self._store(key, new_embeddings[key])
+            embeddings = [embedding if embedding is not None else new_embeddings[key] for key, embedding in zip(keys, embeddings)]
+
+        return [embedding.tolist() for embedding in embeddings]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache)}
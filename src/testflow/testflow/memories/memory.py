@@ -1,5 +1,8 @@
-from collections import defaultdict
-import chromadb
+import hashlib
+import threading
+import weakref
+import atexit
+import copy
 import time
 import os
 import re
@@ -8,84 +11,253 @@ import json
 from .working_memory import WorkingMemory
 from .task_memory import TaskMemory
 from .spatial_memory import SpatialMemory
+from .embedding_cache import CachedEmbeddingFunction
+from .memory_journal import SCRATCH_FILE, LONG_TERM_MEMORY_FILE
+
+
+STORAGE_DIR = os.environ.get('TESTFLOW_MEMORY_DIR', None) # root of the persistent per-app storages; in-memory if unset
+BACKEND_CHROMA = 'chroma'
+BACKEND_NUMPY = 'numpy' # in-process flat index, see vector_store.py
+STORAGE_BACKEND = os.environ.get('TESTFLOW_MEMORY_BACKEND', BACKEND_CHROMA)
+STORAGE_PER_APK = os.environ.get('TESTFLOW_MEMORY_PER_APK', '0') == '1' # separate storages for each build of an app
+SNAPSHOT_FIELDS = ['documents', 'metadatas'] # embeddings are recomputed (through the embedding cache) on restore
+WRITE_BATCH_SIZE = int(os.environ.get('TESTFLOW_MEMORY_WRITE_BATCH', 64)) # buffered entries that force a flush; 1 writes through
+
+
+def storage_name(name):
+    """
+    :return: str, a valid collection name (3-63 characters of [a-zA-Z0-9._-], starting and ending with an alphanumeric)
+    """
+    name = re.sub(r'[^a-zA-Z0-9._-]', '_', name).strip('._-')
+    if len(name) > 63:
+        name = f'{name[:54]}_{hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]}'
+    return name.ljust(3, '0')
+
+
+def make_client(path=None, backend=STORAGE_BACKEND):
+    """
+    :param path: str, directory of a persistent client (in-memory if None)
+    :return: a client whose collections implement vector_store.Collection
+    """
+    if backend == BACKEND_NUMPY:
+        from .vector_store import NumpyClient
+        return NumpyClient(path=path)
+    if backend == BACKEND_CHROMA:
+        import chromadb
+        return chromadb.PersistentClient(path=path) if path is not None else chromadb.Client()
+    raise ValueError(f'Unsupported storage backend: {backend}')
+
+
+def make_embedding_function(backend=STORAGE_BACKEND):
+    """
+    :return: the embedding function the backend uses by default, behind an embedding cache
+    """
+    if backend == BACKEND_NUMPY:
+        from .vector_store import HashingEmbeddingFunction
+        return CachedEmbeddingFunction(HashingEmbeddingFunction())
+    if backend == BACKEND_CHROMA:
+        from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+        return CachedEmbeddingFunction(DefaultEmbeddingFunction())
+    raise ValueError(f'Unsupported storage backend: {backend}')
 
 
 class PersistentStorageManager:
-    chroma_client = chromadb.Client()
-    
-    # Use persistent to load data from previous sessions    
-    # current_path = os.getcwd()
-    # chroma_client = chromadb.PersistentClient(current_path + "/chroma/data")
-    active_storages = {
-        'primary': None,
-        'knowledge': None
-    }
-    
+    """
+    Owns the Chroma client of the process: in-memory by default, or one persistent directory per app
+    (`<root>/<package name>[/<APK hash>]`) so that the knowledge of earlier runs (e.g. the training phase) is reused
+    """
+    client = make_client()
+    embedding_function = make_embedding_function() # shared by all collections, so a text is embedded once per process
+    storage_dir = None
+    active_storages = {}
+    buffered_storages = weakref.WeakSet() # PersistentStorages that may hold unwritten entries
+
+    @classmethod
+    def open_app_storage(cls, package_name, apk_hash=None, root_dir=STORAGE_DIR):
+        """
+        :param apk_hash: str, keeps the storages of different builds of the app apart if given
+        :return: str, the directory of the storages, or None if they are kept in memory
+        """
+        if root_dir is None:
+            return None
+
+        storage_dir = os.path.join(root_dir, storage_name(package_name))
+        if apk_hash is not None:
+            storage_dir = os.path.join(storage_dir, apk_hash)
+        os.makedirs(storage_dir, exist_ok=True)
+
+        if storage_dir != cls.storage_dir:
+            cls.client = make_client(path=storage_dir)
+            cls.storage_dir = storage_dir
+            cls.active_storages = {}
+
+        return storage_dir
+
     @classmethod
     def create_storage(cls, storage_id):
-        # try:
-        #     cls.chroma_client.delete_collection(name=storage_id)
-        # except ValueError:
-        #     pass
+        # an existing collection (of a persistent storage) is reopened with its entries
+        cls.active_storages[storage_id] = cls.client.get_or_create_collection(name=storage_name(storage_id), embedding_function=cls.embedding_function)
+        return cls.active_storages[storage_id]
 
-        # try:
-        #     cls.chroma_client.delete_collection(name=f'{storage_id}')
-        # except ValueError:
-        #     pass
+    @classmethod
+    def list_storages(cls):
+        return [collection.name for collection in cls.client.list_collections()]
 
-        # cls.active_storages[storage_id] = cls.chroma_client.create_collection(name=storage_id)
+    @classmethod
+    def drop_storage(cls, storage_id):
+        try:
+            cls.client.delete_collection(name=storage_name(storage_id))
+        except ValueError: # no such collection
+            pass
+        cls.active_storages.pop(storage_id, None)
 
-        # return cls.active_storages[storage_id]
-        
-        print(cls.chroma_client.list_collections())
-        print(storage_id)
-        
-        # Create a new collection
-        cls.active_storages[storage_id] = cls.chroma_client.get_or_create_collection(name=storage_id)
-        return cls.active_storages[storage_id]
+    @classmethod
+    def flush_all(cls):
+        for storage in list(cls.buffered_storages):
+            storage.flush()
+
+    @classmethod
+    def snapshot(cls, snapshot_path):
+        """
+        Write the entries of every collection to a JSON file
+        """
+        cls.flush_all()
+        snapshot = {}
+        for collection in cls.client.list_collections():
+            entries = cls.client.get_collection(name=collection.name).get(include=SNAPSHOT_FIELDS)
+            snapshot[collection.name] = {'ids': entries['ids'], **{field: entries[field] for field in SNAPSHOT_FIELDS}}
+
+        os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok=True)
+        with open(snapshot_path, 'w') as f:
+            json.dump(snapshot, f)
+
+    @classmethod
+    def restore(cls, snapshot_path):
+        """
+        Replace the collections of the snapshot with its entries (storages opened before must be reopened);
+        embeddings are recomputed from the documents unless the snapshot has them
+        """
+        with open(snapshot_path, 'r') as f:
+            snapshot = json.load(f)
+
+        cls.flush_all()
+        for name, entries in snapshot.items():
+            try:
+                cls.client.delete_collection(name=name)
+            except ValueError:
+                pass
+            collection = cls.client.create_collection(name=name, embedding_function=cls.embedding_function)
+            if len(entries['ids']) > 0:
+                collection.add(ids=entries['ids'], embeddings=entries.get('embeddings'), **{field: entries[field] for field in SNAPSHOT_FIELDS})
+        cls.active_storages = {}
 
 
 class PersistentStorage:
-    def __init__(self, name):
+    def __init__(self, name, write_batch_size=WRITE_BATCH_SIZE, track_writes=False):
+        """
+        :param track_writes: bool, keep the written entries until `pop_written_entries` (for the memory journal)
+        """
         self.name = name
-        self.entry_id = 0
         self.db = PersistentStorageManager.create_storage(name)
+        # continue numbering after the entries of earlier runs instead of overwriting them
+        self.entry_id = max([int(i) for i in self.db.get(include=[])['ids'] if i.isdigit()], default=0)
+
+        # write-behind buffer of add_entry: ID -> (document, metadata), written with one upsert at step
+        # boundaries (Memory.flush), when it is full, or before any read of the storage
+        self.write_batch_size = write_batch_size
+        self.pending_entries = {}
+        self._lock = threading.RLock()
+        self.track_writes = track_writes
+        self.written_entries = {}
+        PersistentStorageManager.buffered_storages.add(self)
+
+    def flush(self):
+        with self._lock:
+            if len(self.pending_entries) == 0:
+                return
+            ids = list(self.pending_entries)
+            documents, metadatas = zip(*self.pending_entries.values())
+            self.db.upsert(documents=list(documents), metadatas=list(metadatas), ids=ids)
+            if self.track_writes:
+                self.written_entries.update(self.pending_entries)
+            self.pending_entries = {}
+
+    def pop_written_entries(self):
+        """
+        :return: list of (id, document, metadata) written through add_entry/update_metadata since the last call
+        """
+        self.flush()
+        with self._lock:
+            written_entries = [(entry_id, document, metadata) for entry_id, (document, metadata) in self.written_entries.items()]
+            self.written_entries = {}
+        return written_entries
+
+    def count(self):
+        self.flush()
+        return self.db.count()
 
     def get(self, **kwargs):
+        self.flush()
         return self.db.get(**kwargs)
     
     def add(self, **kwargs):
+        self.flush()
         item_count = len(kwargs['documents'])
-        ids = list(map(str, range(self.entry_id, self.entry_id + item_count)))
+        ids = list(map(str, range(self.entry_id + 1, self.entry_id + 1 + item_count)))
         self.entry_id += item_count
 
         return self.db.add(documents=kwargs['documents'], metadatas=kwargs['metadatas'], ids=ids)
 
     def upsert(self, **kwargs):
+        self.flush()
         self.db.upsert(**kwargs)
 
+    def embed(self, texts):
+        return PersistentStorageManager.embedding_function(texts)
+
     def query(self, **kwargs):
+        self.flush()
+        # the query texts go through the embedding cache instead of being embedded again by the backend
+        if 'query_texts' in kwargs:
+            kwargs['query_embeddings'] = self.embed(kwargs.pop('query_texts'))
         return self.db.query(**kwargs)
 
     def add_entry(self, document, metadata, entry_id=None):
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-        if entry_id is None:
-            self.entry_id += 1
-        else:
-            self.entry_id = entry_id
+        with self._lock:
+            if entry_id is None:
+                self.entry_id += 1
+            else:
+                self.entry_id = entry_id
 
-        self.db.upsert(
-            documents = [document],
-            metadatas = [{
+            self.pending_entries[str(self.entry_id)] = (document, {
                 'timestamp': timestamp,
                 **metadata
-            }],
-            ids = [str(self.entry_id)]
-        )
+            })
+            if len(self.pending_entries) >= self.write_batch_size:
+                self.flush()
+
+            return str(self.entry_id)
+
+    def update_metadata(self, entry_id, **fields):
+        """
+        Set metadata fields of an entry; the update is buffered like a new entry
+        """
+        with self._lock:
+            entry_id = str(entry_id)
+            if entry_id in self.pending_entries:
+                document, metadata = self.pending_entries[entry_id]
+            else:
+                saved_entry = self.db.get(ids=[entry_id])
+                assert len(saved_entry['ids']) > 0, f'No entry found for {entry_id} in {self.name}'
+                document, metadata = saved_entry['documents'][0], saved_entry['metadatas'][0]
 
-        return str(self.entry_id)
+            self.pending_entries[entry_id] = (document, {**metadata, **fields})
+            if len(self.pending_entries) >= self.write_batch_size:
+                self.flush()
 
-    def _stringify_entry(self, memory_id, metadata, doc, show_timestamp=True, show_type=True):
+    @staticmethod
+    def _stringify_entry(memory_id, metadata, doc, show_timestamp=True, show_type=True):
         if show_type:
             doc = f'[{metadata["type"]}] {doc}\n'
         else:
@@ -96,7 +268,8 @@ class PersistentStorage:
         else:
             return (int(memory_id), f'{memory_id}. {doc}')
 
-    def stringify_entries(self, raw_entries, mode='widget_knowledge', show_timestamp=True, show_type=True, max_len=None):
+    @staticmethod
+    def stringify_entries(raw_entries, mode='widget_knowledge', show_timestamp=True, show_type=True, max_len=None):
         assert mode in ['task_history', 'widget_knowledge', 'task_knowledge']
 
         entries = []
@@ -104,7 +277,7 @@ class PersistentStorage:
             if mode == 'task_history':
                 if len(doc) == 0:
                     continue
-                entries.append(self._stringify_entry(memory_id, metadata, doc, show_timestamp=show_timestamp, show_type=show_type))
+                entries.append(PersistentStorage._stringify_entry(memory_id, metadata, doc, show_timestamp=show_timestamp, show_type=show_type))
             elif mode == 'widget_knowledge':
                 knowledge = metadata['observation']
                 if len(knowledge) == 0:
@@ -136,23 +309,36 @@ class PersistentStorage:
         return memory_str.strip()
 
     def stringify_all_entries(self, mode='widget_knowledge'):
-        raw_entries = self.db.get()
+        raw_entries = self.get()
         return self.stringify_entries(raw_entries, mode=mode)
 
 
+# entries buffered during the last step are written when the process exits
+atexit.register(PersistentStorageManager.flush_all)
+
+
 class Memory:
     def __init__(self, name):
-        self.history = PersistentStorage(f'{name}_primary')
+        self.history = PersistentStorage(f'{name}_primary', track_writes=True)
         self.knowledge = PersistentStorage(f'{name}_knowledge')
         self.activity = PersistentStorage(f'{name}_activity_knowledge')
         self.working_memory = WorkingMemory()
         self.task_memory = TaskMemory(self.history, self.knowledge)
         self.widget_knowledge = SpatialMemory(self.knowledge)
+        if self.knowledge.count() > 0:
+            self.widget_knowledge.load_from_storage()
         
         # long memory for reserve reflections and optimizations
         self.evaluate_optimized_steps = None
         self.evaluate_rules = None
         
+    def flush(self):
+        """
+        Write the buffered entries of the storages (called at every step boundary)
+        """
+        for storage in [self.history, self.knowledge, self.activity]:
+            storage.flush()
+
     def set_for_evaluation(self, optimized_steps, rules):
         self.evaluate_optimized_steps = optimized_steps
         self.evaluate_rules = rules
@@ -167,40 +353,47 @@ class Memory:
 
     def save_snapshot(self, output_dir):
         working_memory_record = self.working_memory.to_dict()
-        with open(os.path.join(output_dir, 'scratch.json'), 'w') as f:
+        with open(os.path.join(output_dir, SCRATCH_FILE), 'w') as f:
             json.dump(working_memory_record, f, indent=2)
 
         task_history_record = self.history.stringify_all_entries(mode='task_history')
-        with open(os.path.join(output_dir, 'long_term_memory.txt'), 'w') as f:
+        with open(os.path.join(output_dir, LONG_TERM_MEMORY_FILE), 'w') as f:
             f.write(task_history_record)
 
+    def journal_step(self, journal, step):
+        """
+        Append the changes of the memory since the previous step to a MemoryJournal
+        """
+        written_entries = self.history.pop_written_entries()
+        if not journal.needs_base:
+            journal.record_step(step, self.working_memory, written_entries)
+        else:
+            # a new journal starts from the whole task history
+            entries = self.history.get(include=['documents', 'metadatas'])
+            journal.record_step(step, self.working_memory, list(zip(entries['ids'], entries['documents'], entries['metadatas'])), base=True)
+
     def collect_knowledge(self):
-        widget_knowledge_entries = self.knowledge.get({'where': {'type': 'WIDGET'}})
-        task_knowledge_entries = self.knowledge.get({'where': {'type': 'TASK'}})
+        task_knowledge_entries = self.knowledge.get(where={'type': 'TASK'}, include=['metadatas'])
 
         task_knowledge = []
-        widget_knowledge = defaultdict(lambda: defaultdict(list))
-
-        for memory_id, metadata, state in zip(widget_knowledge_entries['ids'], widget_knowledge_entries['metadatas'], widget_knowledge_entries['documents']):
-            if len(metadata['observation']) == 0:
-                continue
-
-            action_type = metadata['action']
-            widget_knowledge[metadata['page']][metadata['widget']].append((int(memory_id), (action_type, metadata['observation'])))
-
-        for memory_id, metadata, state in zip(task_knowledge_entries['ids'], task_knowledge_entries['metadatas'], task_knowledge_entries['documents']):
+        for memory_id, metadata in zip(task_knowledge_entries['ids'], task_knowledge_entries['metadatas']):
             if len(metadata['reflection']) == 0:
                 continue
 
             task_knowledge.append((int(memory_id), (metadata['task'], metadata['reflection'])))
 
-        widget_knowledge_map = copy.deepcopy(self.widget_knowledge.knowledge_map)
+        widget_knowledge_map = copy.deepcopy(self.widget_knowledge.widget_knowledge_map)
+
+        # widget observations come from the observation index of the spatial memory
+        for page, widgets in self.widget_knowledge.observation_index.items():
+            for widget_signature in widgets:
+                ids, metadatas = self.widget_knowledge.get_widget_observations(page, widget_signature)
+                observations = [(int(memory_id), (metadata['action'], metadata['observation'])) for memory_id, metadata in zip(ids, metadatas) if len(metadata['observation']) > 0]
+                if len(observations) == 0:
+                    continue
 
-        for page, widgets in widget_knowledge.items():
-            for widget_signature, w_knowledge in widgets.items():
-                observations = widget_knowledge[page][widget_signature]
-                widget_knowledge_map[page][widget_signature] = {
-                    'summary': w_knowledge,
+                widget_knowledge_map.setdefault(page, {})[widget_signature] = {
+                    'summary': observations,
                     'entries': [obs_entry[1] for obs_entry in observations]
                 }
 
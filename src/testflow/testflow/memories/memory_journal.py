@@ -0,0 +1,94 @@
+"""
+Append-only journal of the agent's memory: one JSON line per step with only what changed during the step
+(new working memory steps and written task history entries), from which the memory snapshot of any step
+can be materialized
+"""
+
+import os
+import json
+
+MEMORY_JOURNAL_FILE = 'memory_journal.jsonl'
+SCRATCH_FILE = 'scratch.json'
+LONG_TERM_MEMORY_FILE = 'long_term_memory.txt'
+
+
+def working_memory_entry(step):
+    desc, item_type, timestamp, page = step
+    return {
+        'description': str(desc),
+        'type': item_type,
+        'timestamp': timestamp,
+        'page': page,
+    }
+
+
+class MemoryJournal:
+    """
+    Each record is {'step': int, 'base': bool, 'task': {...} (when the working memory was replaced),
+    'working_memory': [new entries], 'history': [[id, document, metadata], ...]}. The first record written by
+    a journal is a base record holding the whole task history.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.needs_base = True
+        self.working_memory = None # the working memory whose steps are journaled
+        self.journaled_steps = 0
+
+    def record_step(self, step, working_memory, history_entries, base=False):
+        """
+        :param history_entries: list of (id, document, metadata), the task history entries written during the step
+            (all of them for a base record)
+        """
+        record = {'step': step, 'base': base}
+        self.needs_base = self.needs_base and not base
+
+        if working_memory is not self.working_memory:
+            self.working_memory = working_memory
+            self.journaled_steps = 0
+            record['task'] = {
+                'task': working_memory.task.summary if working_memory.task else None,
+                'task_end_condition': working_memory.task.end_condition if working_memory.task else None,
+            }
+        record['working_memory'] = [working_memory_entry(s) for s in working_memory.steps[self.journaled_steps:]]
+        self.journaled_steps = len(working_memory.steps)
+
+        record['history'] = [list(entry) for entry in history_entries]
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    @staticmethod
+    def replay(path, step=None):
+        """
+        :param step: int, the last step to apply (the end of the journal if None)
+        :return: (working memory record as in WorkingMemory.to_dict, raw task history entries as returned by a storage get,
+            the last applied step)
+        """
+        working_memory = {'task': None, 'task_end_condition': None, 'working_memory': []}
+        history = {}
+        last_step = None
+
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if step is not None and record['step'] > step:
+                    break
+
+                if record['base']:
+                    history = {}
+                if 'task' in record:
+                    working_memory = {**record['task'], 'working_memory': []}
+                working_memory['working_memory'].extend(record['working_memory'])
+                for entry_id, document, metadata in record['history']:
+                    history[entry_id] = (document, metadata)
+                last_step = record['step']
+
+        entries = {
+            'ids': list(history),
+            'documents': [document for document, _ in history.values()],
+            'metadatas': [metadata for _, metadata in history.values()],
+        }
+        return working_memory, entries, last_step
@@ -1,42 +1,188 @@
 from ..prompts.summarize_widget_knowledge import prompt_summarized_widget_knowledge
+from ..metrics import MetricsRegistry
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import json
+import hashlib
+import contextvars
+
+MAX_SUMMARY_WORKERS = int(os.environ.get('TESTFLOW_KNOWLEDGE_WORKERS', 4)) # concurrent widget role summaries per screen
+ROLE_CACHE_FILE = os.environ.get('TESTFLOW_ROLE_CACHE_FILE', None) # keeps widget role summaries across runs if set
+
+
+def observation_fingerprint(ids, metadatas):
+    """
+    :return: str, a hash of the observations a role summary is inferred from
+    """
+    observations = sorted([str(memory_id), metadata['action'], metadata['observation']] for memory_id, metadata in zip(ids, metadatas))
+    return hashlib.sha1(json.dumps(observations).encode('utf-8')).hexdigest()
+
 
 class SpatialMemory:    # Akin to human's long-term spatial memory and is stored in the permanent storage
-    def __init__(self, storage):
+    def __init__(self, storage, role_cache_file=ROLE_CACHE_FILE):
         self.storage = storage
         self.widget_knowledge_map = {}
 
+        # page -> widget signature -> IDs of its observations, oldest first; together with the metadata of
+        # each ID, it answers exact page/widget lookups without going through the vector store
+        self.observation_index = {}
+        self.observation_metadata = {}
+
+        # page -> widget signature -> observation fingerprint -> role summary
+        self.role_cache_file = role_cache_file
+        self.role_inference_cache = {}
+        if role_cache_file is not None and os.path.exists(role_cache_file):
+            with open(role_cache_file, 'r') as f:
+                self.role_inference_cache = json.load(f)
+
+    def load_from_storage(self):
+        """
+        Warm start: rebuild the per-widget action and observation counts and the observation index
+        from the observations and unobserved actions of earlier runs
+        """
+        entries = self.storage.get(where={'$or': [{'type': 'WIDGET'}, {'type': 'WIDGET_ACTION'}]}, include=['metadatas'])
+        for memory_id, metadata in sorted(zip(entries['ids'], entries['metadatas']), key=lambda entry: int(entry[0])):
+            page, widget_signature = metadata['page'], metadata['widget']
+            if page not in self.widget_knowledge_map:
+                self.widget_knowledge_map[page] = {}
+            if widget_signature not in self.widget_knowledge_map[page]:
+                self.widget_knowledge_map[page][widget_signature] = {
+                    'action_count': defaultdict(lambda: 0),
+                    'observation_count': 0,
+                    'role_inference': None
+                }
+
+            # entries of older runs only store the action type signature, e.g. "scroll down" for a scroll event
+            event_type = metadata.get('event_type', metadata['action'].split(' ')[0])
+            self.widget_knowledge_map[page][widget_signature]['action_count'][event_type] += 1
+            if metadata['type'] == 'WIDGET':
+                self._index_observation(memory_id, metadata)
+                self.widget_knowledge_map[page][widget_signature]['observation_count'] += 1
+
+    def _index_observation(self, memory_id, metadata):
+        self.observation_index.setdefault(metadata['page'], {}).setdefault(metadata['widget'], []).append(memory_id)
+        self.observation_metadata[memory_id] = metadata
+
+    def get_widget_observations(self, page, widget_signature):
+        """
+        :return: (list of IDs, list of metadatas) of the observations of a widget, oldest first
+        """
+        ids = self.observation_index.get(page, {}).get(widget_signature, [])
+        return list(ids), [self.observation_metadata[memory_id] for memory_id in ids]
+
     def has_widget_knowledge(self, page, widget_signature):
-        if page not in self.widget_knowledge_map:
-            return False
-        if widget_signature not in self.widget_knowledge_map[page]:
-            return False
+        return len(self.observation_index.get(page, {}).get(widget_signature, [])) > 0
 
-        return self.widget_knowledge_map[page][widget_signature]['observation_count'] > 0
-    
     def retrieve_widget_knowledge(self, state, widget, N=5, prompt_recorder=None):
-        relevant_entries = self.storage.query(
-            query_texts=[state.signature],
-            n_results=N,
-            where={'$and': [{'type': 'WIDGET'}, {'page': state.activity}, {'widget': widget.signature}]}
-        )
-
-        relevant_entries = {
-            'ids': relevant_entries['ids'][0],
-            'metadatas': relevant_entries['metadatas'][0],
-            'documents': relevant_entries['documents'][0]
-        }
-
-        if len(relevant_entries) == 0:
-            return None
-
-        relevant_widget_observations = self.storage.stringify_entries(relevant_entries, mode='widget_knowledge')
-
-        widget_role_summary = prompt_summarized_widget_knowledge(widget.stringify(), relevant_widget_observations, prompt_recorder=prompt_recorder)
-
-        self.update_widget_role_inference(state.activity, widget.signature, widget_role_summary)
+        return self.retrieve_widgets_knowledge(state, [widget], N=N, prompt_recorder=prompt_recorder).get(widget.signature)
+
+    def retrieve_widgets_knowledge(self, state, widgets, N=5, prompt_recorder=None):
+        """
+        Summarize the role of several widgets of a state: their observations are looked up in the observation
+        index (ranked with one vector query for widgets that have more than N), then the summaries that are not cached for the same observations are inferred concurrently
+        :return: dict, widget signature -> role summary (widgets without observations are left out)
+        """
+        widgets = list({widget.signature: widget for widget in widgets}.values())
+        observations = self.query_widget_observations(state, widgets, N=N)
+
+        widget_role_summaries = {}
+        pending = []
+        for widget in widgets:
+            if widget.signature not in observations or len(observations[widget.signature][1]) == 0:
+                continue
+            fingerprint = observations[widget.signature][0]
+            cached_summary = self.role_inference_cache.get(state.activity, {}).get(widget.signature, {}).get(fingerprint)
+            if cached_summary is not None:
+                widget_role_summaries[widget.signature] = cached_summary
+            else:
+                pending.append(widget)
+
+        if len(pending) == 0:
+            return widget_role_summaries
+
+        def summarize(widget):
+            with MetricsRegistry.component('widget_knowledge'):
+                return prompt_summarized_widget_knowledge(widget.stringify(), observations[widget.signature][1], prompt_recorder=prompt_recorder)
+
+        if len(pending) == 1:
+            summaries = [summarize(pending[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(MAX_SUMMARY_WORKERS, len(pending))) as pool:
+                # each call runs in a copy of this context so that metrics keep the current task
+                futures = [pool.submit(contextvars.copy_context().run, summarize, widget) for widget in pending]
+                summaries = [future.result() for future in futures]
+
+        for widget, summary in zip(pending, summaries):
+            self.update_widget_role_inference(state.activity, widget.signature, summary)
+            fingerprint = observations[widget.signature][0]
+            self.role_inference_cache.setdefault(state.activity, {}).setdefault(widget.signature, {})[fingerprint] = summary
+            widget_role_summaries[widget.signature] = summary
+        self.save_role_inference_cache()
+
+        return widget_role_summaries
+
+    def save_role_inference_cache(self):
+        if self.role_cache_file is None:
+            return
 
-        return widget_role_summary
+        os.makedirs(os.path.dirname(os.path.abspath(self.role_cache_file)), exist_ok=True)
+        with open(self.role_cache_file, 'w') as f:
+            json.dump(self.role_inference_cache, f)
+
+    def query_widget_observations(self, state, widgets, N=5):
+        """
+        :return: dict, widget signature -> (fingerprint, its N observations most relevant to the state, stringified)
+        """
+        entries = {} # widget signature -> (IDs, metadatas)
+        ranked = [] # widgets with more than N observations, whose most relevant ones are picked by vector search
+        for widget in widgets:
+            ids, metadatas = self.get_widget_observations(state.activity, widget.signature)
+            if len(ids) > N:
+                ranked.append(widget.signature)
+            elif len(ids) > 0:
+                entries[widget.signature] = (ids, metadatas)
+
+        if len(ranked) > 0:
+            # the state signature is embedded once (and cached) for all the queries of the screen
+            query_embeddings = self.storage.embed([state.signature])
+
+            def query(signatures, n_results):
+                widget_filter = {'widget': signatures[0]} if len(signatures) == 1 else {'$or': [{'widget': s} for s in signatures]}
+                results = self.storage.query(
+                    query_embeddings=query_embeddings,
+                    n_results=n_results,
+                    where={'$and': [{'type': 'WIDGET'}, {'page': state.activity}, widget_filter]},
+                    include=['metadatas']
+                )
+                return zip(results['ids'][0], results['metadatas'][0])
+
+            # a shared top-k can be crowded out by widgets with many observations; those that got fewer
+            # than N are queried on their own
+            ranked_entries = defaultdict(list)
+            for entry in query(ranked, N * len(ranked)):
+                if len(ranked_entries[entry[1]['widget']]) < N:
+                    ranked_entries[entry[1]['widget']].append(entry)
+
+            for signature in ranked:
+                if len(ranked) > 1 and len(ranked_entries[signature]) < N:
+                    ranked_entries[signature] = list(query([signature], N))
+                if len(ranked_entries[signature]) > 0:
+                    ids, metadatas = zip(*ranked_entries[signature])
+                    entries[signature] = (list(ids), list(metadatas))
+
+        observations = {}
+        for signature, (ids, metadatas) in entries.items():
+            observations[signature] = (
+                observation_fingerprint(ids, metadatas),
+                self.storage.stringify_entries({'ids': ids, 'metadatas': metadatas, 'documents': [''] * len(ids)}, mode='widget_knowledge')
+            )
+
+        return observations
+
+    def get_observation_count(self, page, widget_signature):
+        return len(self.observation_index.get(page, {}).get(widget_signature, []))
 
     def get_performed_action_counts(self, page, widget_signature):
         if page not in self.widget_knowledge_map:
@@ -60,24 +206,33 @@ class SpatialMemory:    # Akin to human's long-term spatial memory and is stored
         action_count_map = self.widget_knowledge_map[page][widget_signature]['action_count']
         action_count_map[action.event_type] += 1
 
-        self.widget_knowledge_map[page][widget_signature]['action_count'][action.event_type] += 1
-        
         if observation is None:
+            # still stored, so that a warm start counts the actions performed on the widget as this run does
+            self.storage.add_entry(document=state_signature.strip(), metadata={
+                'type': 'WIDGET_ACTION',
+                'page': page,
+                'widget': widget_signature,
+                'action': action.action_type_signature,
+                'event_type': action.event_type,
+                'task': task.summary if task is not None else '',
+            })
             return
 
         self.widget_knowledge_map[page][widget_signature]['observation_count'] += 1
-
-        self.storage.add_entry(
-            document=state_signature.strip(),
-            metadata={
-                'type': 'WIDGET',
-                'observation': observation,
-                'page': page,
-                'widget': widget_signature,
-                'action': action.action_type_signature, 
-                'task': task.summary,
-            }
-        )
+        # summaries inferred before this observation are outdated
+        self.role_inference_cache.get(page, {}).pop(widget_signature, None)
+
+        metadata = {
+            'type': 'WIDGET',
+            'observation': observation,
+            'page': page,
+            'widget': widget_signature,
+            'action': action.action_type_signature,
+            'event_type': action.event_type,
+            'task': task.summary,
+        }
+        memory_id = self.storage.add_entry(document=state_signature.strip(), metadata=metadata)
+        self._index_observation(memory_id, metadata)
 
     def update_widget_role_inference(self, page, widget_signature, inference):
         if page not in self.widget_knowledge_map:
@@ -55,12 +55,8 @@ class TaskMemory:
             self._add_task_reflection_to_storage(task, reflection)
 
     def _add_task_result_to_storage(self, task):
-        saved_task_entry = self.storage.get(ids=[str(task.entry_id)])
-        assert saved_task_entry is not None and len(saved_task_entry['metadatas']) > 0 , f'No task entry found for {task.entry_id} (task: {task.summary})'
-
-        # Update task metadata
-        saved_task_entry['metadatas'][0]['task_result'] = task.assessment
-        self.storage.upsert(**saved_task_entry)
+        # Update task metadata (buffered with the entries below)
+        self.storage.update_metadata(task.entry_id, task_result=task.assessment)
 
         # Add a task result summary 
         result_entry_id = self.storage.add_entry(
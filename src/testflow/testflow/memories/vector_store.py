@@ -0,0 +1,439 @@
+"""
+In-process vector store implementing the part of the Chroma client/collection API used by the memories.
+Collections are small (thousands of entries) and mostly read through exact metadata filters, so a flat
+NumPy index with inverted metadata indexes answers them without an embedding model or a database.
+"""
+
+import os
+import re
+import json
+import zlib
+import uuid
+import threading
+
+import numpy as np
+
+from abc import ABC, abstractmethod
+from collections import defaultdict
+
+EMBEDDING_DIM = 512
+DEFAULT_GET_INCLUDE = ['metadatas', 'documents']
+DEFAULT_QUERY_INCLUDE = ['metadatas', 'documents', 'distances']
+INDEXED_OPERATORS = ['$eq', '$in']
+
+
+class Collection(ABC):
+    """
+    Interface of a PersistentStorage backend (implemented by Chroma collections and NumpyCollection).
+    Results follow Chroma: `get` returns {'ids': [...], <included fields>: [...]}, and `query` returns the same
+    fields with one list per query.
+    """
+    @abstractmethod
+    def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        pass
+
+    @abstractmethod
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        pass
+
+    @abstractmethod
+    def get(self, ids=None, where=None, limit=None, offset=None, include=DEFAULT_GET_INCLUDE):
+        pass
+
+    @abstractmethod
+    def query(self, query_texts=None, query_embeddings=None, n_results=10, where=None, include=DEFAULT_QUERY_INCLUDE):
+        pass
+
+    @abstractmethod
+    def count(self):
+        pass
+
+
+class HashingEmbeddingFunction:
+    """
+    Embeds texts as L2-normalized hashed counts of their words and word bigrams (stable across processes)
+    """
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+
+    def __call__(self, texts):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = re.findall(r'\w+', text.lower())
+            for feature in words + [f'{a} {b}' for a, b in zip(words, words[1:])]:
+                h = zlib.crc32(feature.encode('utf-8'))
+                embeddings[i, h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms > 0, norms, 1.0)
+
+
+def _compare(value, operator, operand):
+    if operator == '$eq':
+        return value == operand
+    if operator == '$ne':
+        return value != operand
+    if operator == '$in':
+        return value in operand
+    if operator == '$nin':
+        return value not in operand
+    if value is None:
+        return False
+    if operator == '$gt':
+        return value > operand
+    if operator == '$gte':
+        return value >= operand
+    if operator == '$lt':
+        return value < operand
+    if operator == '$lte':
+        return value <= operand
+    raise ValueError(f'Unsupported where operator: {operator}')
+
+
+def match_where(metadata, where):
+    """
+    :param where: dict, a Chroma where filter ({'key': value}, {'key': {'$op': value}}, {'$and': [...]}, {'$or': [...]})
+    """
+    for key, condition in where.items():
+        if key == '$and':
+            if not all(match_where(metadata, c) for c in condition):
+                return False
+        elif key == '$or':
+            if not any(match_where(metadata, c) for c in condition):
+                return False
+        elif isinstance(condition, dict):
+            if not all(_compare(metadata.get(key), op, operand) for op, operand in condition.items()):
+                return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+class NumpyCollection(Collection):
+    """
+    Flat index: rows of a float32 matrix searched by cosine distance, plus an inverted index of
+    (metadata key, value) -> rows for equality filters.
+
+    When the client has a path, writes are appended: the embeddings to `<name>.<generation>.emb` (raw float32
+    rows) and then one record per entry to `<name>.jsonl` (id, document, metadata, row in the embedding file),
+    where the last record of an ID wins. The files are compacted (rewritten into a new generation, committed by
+    replacing the JSONL file) on delete, or when loading if most rows are stale.
+    """
+    def __init__(self, name, path=None, embedding_function=None):
+        self.name = name
+        self.path = path
+        self.embedding_function = embedding_function or HashingEmbeddingFunction()
+        self._lock = threading.RLock()
+
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.rows = {} # id -> row
+        self.index = defaultdict(set) # (key, value) -> rows
+        self.embeddings = np.zeros((0, getattr(self.embedding_function, 'dim', EMBEDDING_DIM)), dtype=np.float32)
+
+        self.generation = None # of the embedding file
+        self.file_rows = 0 # rows in the embedding file, including stale ones
+
+        if path is not None and os.path.exists(self._file('jsonl')):
+            self._load()
+
+    def _file(self, extension):
+        return os.path.join(self.path, f'{self.name}.{extension}')
+
+    def _embedding_file(self, generation):
+        return self._file(f'{generation}.emb')
+
+    def _index_row(self, row, add=True):
+        for key, value in (self.metadatas[row] or {}).items():
+            if add:
+                self.index[(key, value)].add(row)
+            else:
+                self.index[(key, value)].discard(row)
+
+    def _reserve(self, n):
+        if n <= len(self.embeddings):
+            return
+        grown = np.zeros((max(n, 2 * len(self.embeddings), 64), self.embeddings.shape[1]), dtype=np.float32)
+        grown[:len(self.ids)] = self.embeddings[:len(self.ids)]
+        self.embeddings = grown
+
+    def _write(self, ids, documents, metadatas, embeddings, overwrite):
+        documents = documents if documents is not None else [None] * len(ids)
+        metadatas = metadatas if metadatas is not None else [None] * len(ids)
+        if embeddings is None:
+            embeddings = self.embedding_function([d or '' for d in documents])
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        with self._lock:
+            written_rows = []
+            for i, entry_id in enumerate(ids):
+                row = self.rows.get(entry_id)
+                if row is None:
+                    row = len(self.ids)
+                    self._reserve(row + 1)
+                    self.ids.append(entry_id)
+                    self.documents.append(None)
+                    self.metadatas.append(None)
+                    self.rows[entry_id] = row
+                elif not overwrite:
+                    continue # like Chroma, adding an existing ID is ignored
+                else:
+                    self._index_row(row, add=False)
+
+                self.documents[row] = documents[i]
+                self.metadatas[row] = metadatas[i]
+                self.embeddings[row] = embeddings[i]
+                self._index_row(row)
+                written_rows.append(row)
+
+            self._append(written_rows)
+
+    def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._write(ids, documents, metadatas, embeddings, overwrite=False)
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._write(ids, documents, metadatas, embeddings, overwrite=True)
+
+    def _indexed_rows(self, where):
+        """
+        :return: set of rows matching a filter made of equalities, or None if the filter needs a scan
+        """
+        if '$and' in where or '$or' in where:
+            if len(where) > 1:
+                return None
+            parts = [self._indexed_rows(c) for c in next(iter(where.values()))]
+            if any(part is None for part in parts):
+                return None
+            if '$and' in where:
+                return set.intersection(*parts) if len(parts) > 0 else set(self.rows.values())
+            return set.union(*parts) if len(parts) > 0 else set()
+
+        rows = None
+        for key, condition in where.items():
+            if isinstance(condition, dict):
+                if len(condition) != 1 or next(iter(condition)) not in INDEXED_OPERATORS:
+                    return None
+                operator, operand = next(iter(condition.items()))
+                values = [operand] if operator == '$eq' else operand
+                matched = set().union(*[self.index.get((key, v), set()) for v in values])
+            else:
+                matched = self.index.get((key, condition), set())
+            rows = matched if rows is None else rows & matched
+        return rows if rows is not None else set(self.rows.values())
+
+    def _select(self, ids=None, where=None):
+        """
+        :return: list of rows in insertion order
+        """
+        if ids is not None:
+            rows = [self.rows[i] for i in ids if i in self.rows]
+        else:
+            rows = None
+
+        if where:
+            matched = self._indexed_rows(where)
+            if matched is None:
+                candidates = rows if rows is not None else range(len(self.ids))
+                matched = set(r for r in candidates if match_where(self.metadatas[r] or {}, where))
+            rows = [r for r in rows if r in matched] if rows is not None else sorted(matched)
+
+        return rows if rows is not None else list(range(len(self.ids)))
+
+    def _fields(self, rows, include):
+        result = {'ids': [self.ids[r] for r in rows]}
+        if 'documents' in include:
+            result['documents'] = [self.documents[r] for r in rows]
+        if 'metadatas' in include:
+            result['metadatas'] = [self.metadatas[r] for r in rows]
+        if 'embeddings' in include:
+            result['embeddings'] = self.embeddings[rows].tolist() if len(rows) > 0 else []
+        return result
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=DEFAULT_GET_INCLUDE):
+        with self._lock:
+            rows = self._select(ids, where)
+            rows = rows[offset or 0:]
+            if limit is not None:
+                rows = rows[:limit]
+            return self._fields(rows, include)
+
+    def query(self, query_texts=None, query_embeddings=None, n_results=10, where=None, include=DEFAULT_QUERY_INCLUDE):
+        if query_embeddings is None:
+            query_embeddings = self.embedding_function(query_texts)
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+
+        with self._lock:
+            rows = np.asarray(self._select(where=where), dtype=np.int64)
+            results = {'ids': []}
+            for field in include:
+                results[field] = []
+
+            for query_embedding in query_embeddings:
+                n = min(n_results, len(rows))
+                if n > 0:
+                    distances = 1.0 - self.embeddings[rows] @ query_embedding
+                    top = np.argpartition(distances, n - 1)[:n] if n < len(rows) else np.arange(len(rows))
+                    top = top[np.argsort(distances[top], kind='stable')]
+                    selected = rows[top].tolist()
+                else:
+                    distances, top, selected = np.zeros(0), [], []
+
+                fields = self._fields(selected, include)
+                for field, values in fields.items():
+                    results[field].append(values)
+                if 'distances' in include:
+                    results['distances'].append(distances[top].tolist())
+
+            return results
+
+    def count(self):
+        with self._lock:
+            return len(self.ids)
+
+    def delete(self, ids=None, where=None):
+        with self._lock:
+            removed = set(self._select(ids, where))
+            if len(removed) == 0:
+                return
+            kept = [r for r in range(len(self.ids)) if r not in removed]
+            self.ids = [self.ids[r] for r in kept]
+            self.documents = [self.documents[r] for r in kept]
+            self.metadatas = [self.metadatas[r] for r in kept]
+            self.embeddings = self.embeddings[kept]
+            self.rows = {entry_id: row for row, entry_id in enumerate(self.ids)}
+            self.index = defaultdict(set)
+            for row in range(len(self.ids)):
+                self._index_row(row)
+            self._compact()
+
+    def _append(self, rows):
+        """
+        Persist written rows: their embeddings first, then their records, so that a record never refers to a
+        missing embedding (a torn last record is skipped when loading)
+        """
+        if self.path is None or len(rows) == 0:
+            return
+        if self.generation is None:
+            self._compact()
+            return
+
+        with open(self._embedding_file(self.generation), 'ab') as f:
+            f.write(self.embeddings[rows].tobytes())
+        with open(self._file('jsonl'), 'a') as f:
+            for i, row in enumerate(rows):
+                f.write(json.dumps({'id': self.ids[row], 'document': self.documents[row], 'metadata': self.metadatas[row], 'row': self.file_rows + i}) + '\n')
+        self.file_rows += len(rows)
+
+    def _compact(self):
+        """
+        Rewrite the live entries into a new generation of files; replacing the JSONL file commits it atomically
+        """
+        if self.path is None:
+            return
+
+        generation = uuid.uuid4().hex[:12]
+        with open(self._embedding_file(generation), 'wb') as f:
+            f.write(self.embeddings[:len(self.ids)].tobytes())
+
+        tmp_path = self._file('jsonl.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'generation': generation, 'dim': self.embeddings.shape[1]}) + '\n')
+            for row, (entry_id, document, metadata) in enumerate(zip(self.ids, self.documents, self.metadatas)):
+                f.write(json.dumps({'id': entry_id, 'document': document, 'metadata': metadata, 'row': row}) + '\n')
+        os.replace(tmp_path, self._file('jsonl'))
+
+        previous_generation = self.generation
+        self.generation = generation
+        self.file_rows = len(self.ids)
+        if previous_generation is not None and os.path.exists(self._embedding_file(previous_generation)):
+            os.remove(self._embedding_file(previous_generation))
+
+    def _load(self):
+        with open(self._file('jsonl'), 'r') as f:
+            lines = f.read().split('\n')
+        header = json.loads(lines[0])
+        self.generation = header['generation']
+
+        embedding_file = self._embedding_file(self.generation)
+        dim = header['dim']
+        file_embeddings = np.fromfile(embedding_file, dtype=np.float32) if os.path.exists(embedding_file) else np.zeros(0, dtype=np.float32)
+        self.file_rows = len(file_embeddings) // dim
+        torn = len(file_embeddings) % dim != 0 # interrupted append of embeddings
+        file_embeddings = file_embeddings[:self.file_rows * dim].reshape(self.file_rows, dim)
+
+        entries = {} # id -> record; the last record of an ID wins
+        for line in lines[1:]:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                torn = True # interrupted write at the end of the file
+                break
+            if record['row'] < self.file_rows:
+                entries[record['id']] = record
+
+        self.ids = list(entries)
+        self.documents = [record['document'] for record in entries.values()]
+        self.metadatas = [record['metadata'] for record in entries.values()]
+        self.embeddings = file_embeddings[[record['row'] for record in entries.values()]].copy() if len(entries) > 0 else np.zeros((0, dim), dtype=np.float32)
+        self.rows = {entry_id: row for row, entry_id in enumerate(self.ids)}
+        for row in range(len(self.ids)):
+            self._index_row(row)
+
+        # drop embedding files of interrupted compactions, and compact if most rows are stale (or the last
+        # record is torn, so that new records are not appended to it)
+        for file_name in os.listdir(self.path):
+            if file_name.startswith(f'{self.name}.') and file_name.endswith('.emb') and file_name != os.path.basename(embedding_file):
+                if file_name.count('.') == self.name.count('.') + 2:
+                    os.remove(os.path.join(self.path, file_name))
+        if torn or self.file_rows > 2 * len(self.ids):
+            self._compact()
+
+    def remove_files(self):
+        if self.path is None:
+            return
+        for file_path in [self._file('jsonl'), self._file('jsonl.tmp')] + ([self._embedding_file(self.generation)] if self.generation else []):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+class NumpyClient:
+    """
+    Drop-in for the Chroma client: in-memory, or persisted in `path` if given
+    """
+    def __init__(self, path=None, embedding_function=None):
+        self.path = path
+        self.embedding_function = embedding_function
+        self.collections = {}
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            for file_name in sorted(os.listdir(path)):
+                if file_name.endswith('.jsonl'):
+                    name = file_name[:-len('.jsonl')]
+                    self.collections[name] = NumpyCollection(name, path, embedding_function)
+
+    def get_or_create_collection(self, name, embedding_function=None):
+        if name not in self.collections:
+            self.collections[name] = NumpyCollection(name, self.path, embedding_function or self.embedding_function)
+        elif embedding_function is not None:
+            self.collections[name].embedding_function = embedding_function
+        return self.collections[name]
+
+    def create_collection(self, name, embedding_function=None):
+        if name in self.collections:
+            raise ValueError(f'Collection {name} already exists')
+        return self.get_or_create_collection(name, embedding_function=embedding_function)
+
+    def get_collection(self, name):
+        if name not in self.collections:
+            raise ValueError(f'Collection {name} does not exist')
+        return self.collections[name]
+
+    def list_collections(self):
+        return list(self.collections.values())
+
+    def delete_collection(self, name):
+        self.get_collection(name).remove_files()
+        del self.collections[name]
@@ -8,7 +8,28 @@ import time
 import re
 
 
+FEEDBACK_QUESTION = "What should be the next action?"
+
+
+def basic_feedback_message(page_change=None):
+    if page_change is None:
+        return f"I performed the action you suggested. {FEEDBACK_QUESTION}"
+    return f"I performed the action you suggested. The page changed from {page_change[0]} to {page_change[1]}. {FEEDBACK_QUESTION}"
+
+
+def collapse_feedback_message(feedback_message):
+    """
+    :return: str, the feedback message without its observation (only a page change is kept), as given for earlier steps
+    """
+    m = re.search(r"(\(page changed from (.+) to (.+)\))", feedback_message)
+    return basic_feedback_message((m.group(2), m.group(3)) if m is not None else None)
+
+
 class WorkingMemory:
+    """
+    The steps of the current task. Each step is rendered once when it is added: the step histories and
+    the drafts of the virtual conversation grow with add_step instead of being rebuilt on every prompt.
+    """
     def __init__(self, task=None):
         self.task = task
         self.steps = []
@@ -16,6 +37,23 @@ class WorkingMemory:
         self.is_done = False
         self.next_step_suggestion = None
 
+        # rendered step histories (CRITIQUE steps are hidden in all of them)
+        self.action_count = 0
+        self.history_lines = []
+        self.action_lines = []
+        self.action_result_lines = []
+        self._rendered = {}  # method name -> joined history, until the next step
+
+        # virtual conversation drafts: [feedback message, critique, page, collapsed feedback message]
+        self.assistant_messages = []
+        self.user_messages_draft = []
+        self.last_critique_draft = None  # index of the latest draft with a critique
+        self.prev_critique = None
+        self.previous_item_type = None
+        self.has_critique = False
+        self.need_feedback_message = False
+        self.observation_out_of_order = False
+
     def register_task(self, task: Task):
         self.task = task
 
@@ -41,66 +79,41 @@ class WorkingMemory:
         timestamp = time.strftime("%H:%M:%S", time.localtime())
         self.steps.append((step_description, step_type, timestamp, page))
 
-    def stringify(self):
-        action_index = 1
-        if len(self.steps) == 0:
-            return "<no interactions performed>"
-        memory_str = ""
-        for i, (entry, item_type, timestamp, page) in enumerate(self.steps):
-            if isinstance(entry, Action):
-                entry = entry.get_action_record_str()
-            if item_type == "CRITIQUE":
-                continue  # hide previous critiques to avoid bias
-
-            if item_type == "ACTION":
-                memory_str += (
-                    f"{timestamp}:{page}: [{item_type} - {action_index}] {entry}\n"
-                )
-                action_index += 1
-            else:
-                memory_str += (
-                    f"{timestamp}:{page}: Result after action {action_index}: {entry}\n"
-                )
-
-        return memory_str.strip()
+        self._render_history(step_description, step_type, timestamp, page)
+        self._draft_conversation(step_description, step_type, page)
+        self._rendered = {}
 
-    def stringify_action(self):
-        action_index = 1
-        if len(self.steps) == 0:
-            return "<no interactions performed>"
-        memory_str = ""
-        for i, (entry, item_type, timestamp, page) in enumerate(self.steps):
-            if isinstance(entry, Action):
-                entry = entry.get_action_record_str()
-            if item_type == "CRITIQUE":
-                continue
+    def _render_history(self, entry, item_type, timestamp, page):
+        if item_type == "CRITIQUE":
+            return  # hide previous critiques to avoid bias
 
-            if item_type == "ACTION":
-                memory_str += f"- {item_type} {action_index}: {entry}\n"
-                action_index += 1
-            else:
-                continue
+        if isinstance(entry, Action):
+            entry = entry.get_action_record_str()
 
-        return memory_str.strip()
+        if item_type == "ACTION":
+            self.action_count += 1
+            self.history_lines.append(f"{timestamp}:{page}: [{item_type} - {self.action_count}] {entry}")
+            self.action_lines.append(f"- {item_type} {self.action_count}: {entry}")
+            self.action_result_lines.append(f"- {item_type} {self.action_count}: {entry}")
+        else:
+            self.history_lines.append(f"{timestamp}:{page}: Result after action {self.action_count + 1}: {entry}")
+            self.action_result_lines.append(f"Result after action: {entry}")
 
-    def stringify_action_with_result(self):
-        action_index = 1
+    def _joined(self, name, lines):
         if len(self.steps) == 0:
             return "<no interactions performed>"
-        memory_str = ""
-        for i, (entry, item_type, timestamp, page) in enumerate(self.steps):
-            if isinstance(entry, Action):
-                entry = entry.get_action_record_str()
-            if item_type == "CRITIQUE":
-                continue
+        if name not in self._rendered:
+            self._rendered[name] = "\n".join(lines).strip()
+        return self._rendered[name]
 
-            if item_type == "ACTION":
-                memory_str += f"- {item_type} {action_index}: {entry}\n"
-                action_index += 1
-            else:
-                memory_str += f"Result after action: {entry}\n"
+    def stringify(self):
+        return self._joined("stringify", self.history_lines)
 
-        return memory_str.strip()
+    def stringify_action(self):
+        return self._joined("stringify_action", self.action_lines)
+
+    def stringify_action_with_result(self):
+        return self._joined("stringify_action_with_result", self.action_result_lines)
 
     def to_dict(self):
         task_execution_entries = []
@@ -121,101 +134,69 @@ class WorkingMemory:
             "working_memory": task_execution_entries,
         }
 
-    def make_virtual_conversation(self):
-        # This should be called when we need a next action from the LLM
-        WM = list(enumerate(self.steps))
-
-        user_messages_draft = []
-        user_messages = []
-        assistant_messages = []
-
-        BASIC_FEEDBACK_MESSAGE = lambda page_change: (
-            f"I performed the action you suggested. What should be the next action?"
-            if page_change is None
-            else f"I performed the action you suggested. The page changed from {page_change[0]} to {page_change[1]}. What should be the next action?"
+    def _append_draft(self, feedback_message, critique, page):
+        self.user_messages_draft.append(
+            [feedback_message, critique, page, collapse_feedback_message(feedback_message)]
         )
-
-        prev_critique = None
-        previous_item_type = None
-        has_critique = False
-
-        need_feedback_message = False
-
-        for i, (entry, item_type, timestamp, page) in WM:
-            if item_type == "ACTION":
-                if need_feedback_message:
-                    user_messages_draft.append(
-                        (BASIC_FEEDBACK_MESSAGE(None), prev_critique, page)
-                    )
-                    prev_critique = None
-                if isinstance(entry, Action):
-                    assistant_messages.append(entry.get_action_str())
-                else:
-                    assistant_messages.append(str(entry))
-                need_feedback_message = True
-
-            elif item_type == "CRITIQUE":
-                # append to the last observation
-                if previous_item_type == "OBSERVATION":
-                    user_messages_draft[-1] = (
-                        user_messages_draft[-1][0],
-                        entry,
-                        user_messages_draft[-1][2],
-                    )
-                elif previous_item_type == "ACTION":
-                    prev_critique = entry
-                has_critique = True
-
-            elif item_type == "OBSERVATION":
-                assert previous_item_type == "ACTION"
-                user_messages_draft.append(
-                    (
-                        f"""
-I performed the action, and as a result, {entry[0].lower() + add_period(entry[1:])} What should be the next action?""".strip(),
-                        None,
-                        page,
-                    )
-                )
-
-                need_feedback_message = False
-
-            previous_item_type = item_type
-
-        if need_feedback_message:
-            user_messages_draft.append(
-                (BASIC_FEEDBACK_MESSAGE(None), prev_critique, WM[-1][1][3])
+        if critique is not None:
+            self.last_critique_draft = len(self.user_messages_draft) - 1
+
+    def _draft_conversation(self, entry, item_type, page):
+        if item_type == "ACTION":
+            if self.need_feedback_message:
+                self._append_draft(basic_feedback_message(None), self.prev_critique, page)
+                self.prev_critique = None
+            if isinstance(entry, Action):
+                self.assistant_messages.append(entry.get_action_str())
+            else:
+                self.assistant_messages.append(str(entry))
+            self.need_feedback_message = True
+
+        elif item_type == "CRITIQUE":
+            # append to the last observation
+            if self.previous_item_type == "OBSERVATION":
+                self.user_messages_draft[-1][1] = entry
+                self.last_critique_draft = len(self.user_messages_draft) - 1
+            elif self.previous_item_type == "ACTION":
+                self.prev_critique = entry
+            self.has_critique = True
+
+        elif item_type == "OBSERVATION":
+            if self.previous_item_type != "ACTION":
+                self.observation_out_of_order = True
+            self._append_draft(
+                f"""
+I performed the action, and as a result, {entry[0].lower() + add_period(entry[1:])} {FEEDBACK_QUESTION}""".strip(),
+                None,
+                page,
             )
+            self.need_feedback_message = False
 
-        # Final conversation generation: only include the last observation and last critique (if there is not critique, mention the initial plan made by planner)
-        ignore_observations = False
-        ignore_critiques = False
-
-        for feedback_message, critique, page in user_messages_draft[::-1]:
-            if ignore_observations:
-                page_change = None
-                m = re.search(r"(\(page changed from (.+) to (.+)\))", feedback_message)
-                if m is not None:
-                    page_change = (m.group(2), m.group(3))
+        self.previous_item_type = item_type
 
-                feedback_message = BASIC_FEEDBACK_MESSAGE(page_change)
+    def make_virtual_conversation(self):
+        # This should be called when we need a next action from the LLM
+        assert not self.observation_out_of_order, "An observation must follow an action"
 
-            else:
-                ignore_observations = True
+        drafts = self.user_messages_draft
+        critique_draft = self.last_critique_draft
+        if self.need_feedback_message:
+            drafts = drafts + [[basic_feedback_message(None), self.prev_critique, self.steps[-1][3], basic_feedback_message(None)]]
+            if self.prev_critique is not None:
+                critique_draft = len(drafts) - 1
 
-            if not ignore_critiques and critique is not None:
-                feedback_message = feedback_message.replace(
-                    "What should be the next action?",
-                    f"""
+        # Final conversation generation: only include the last observation and last critique (if there is not critique, mention the initial plan made by planner)
+        user_messages = [draft[3] for draft in drafts[:-1]] + [draft[0] for draft in drafts[-1:]]
+        if critique_draft is not None:
+            user_messages[critique_draft] = user_messages[critique_draft].replace(
+                FEEDBACK_QUESTION,
+                f"""
 However, I got the following critique for my actions so far: 
-> Criticizer: "{add_period(critique)}" 
+> Criticizer: "{add_period(drafts[critique_draft][1])}" 
 Considering the critique, what should be the next action?""".strip(),
-                )
-
-                ignore_critiques = True
-
-            user_messages.insert(0, feedback_message)
+            )
 
-        initial_plan = f"{add_period(self.task.plan)} " if not has_critique else ""
+        initial_plan = f"{add_period(self.task.plan)} " if not self.has_critique else ""
 
         first_user_message = f"""
 My name is {agent_config.persona_name} and I am using an application named {agent_config.app_name} to accomplish the following task: 
@@ -226,4 +207,4 @@ I'm currently on the {self.task.start_state.activity} page. {initial_plan}What s
 
         user_messages.insert(0, first_user_message)
 
-        return user_messages, assistant_messages
+        return user_messages, list(self.assistant_messages)
@@ -0,0 +1,262 @@
+import os
+import json
+import math
+import threading
+import contextvars
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+MAX_SAMPLES = 10000  # most recent observations kept per series for percentiles
+PERCENTILES = [0.5, 0.95, 0.99]
+
+DEFAULT_COMPONENT = "other"
+NO_TASK = "-"
+
+_current_component = contextvars.ContextVar("component", default=DEFAULT_COMPONENT)
+_current_task = contextvars.ContextVar("task", default=NO_TASK)
+
+
+def _usage_value(usage, *path):
+    """
+    Read a (possibly nested) field of an API usage payload, which is either an SDK object or a dict
+    """
+    value = usage
+    for key in path:
+        if value is None:
+            return 0
+        value = value.get(key) if isinstance(value, dict) else getattr(value, key, None)
+    return value or 0
+
+
+def escape_label_value(value):
+    """
+    Escape a Prometheus label value (backslashes, double quotes and newlines), as the text format requires
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=MAX_SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        self.samples.extend(other.samples)
+
+    def percentile(self, q):
+        if len(self.samples) == 0:
+            return 0.0
+        values = sorted(self.samples)
+        return values[min(len(values) - 1, math.ceil(q * len(values)) - 1)]
+
+    def to_dict(self):
+        summary = {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count > 0 else 0.0,
+            "max": self.max,
+        }
+        for q in PERCENTILES:
+            summary[f"p{int(q * 100)}"] = self.percentile(q)
+        return summary
+
+
+class Series:
+    """
+    LLM call statistics of one (component, task, model) combination
+    """
+
+    COUNTERS = [
+        "calls",
+        "cache_hits",
+        "retries",
+        "prompt_tokens",
+        "completion_tokens",
+        "cached_tokens",
+    ]
+
+    def __init__(self):
+        self.counters = {name: 0 for name in self.COUNTERS}
+        self.latency = Histogram()
+        self.queue_wait = Histogram()
+
+    def merge(self, other):
+        for name in self.COUNTERS:
+            self.counters[name] += other.counters[name]
+        self.latency.merge(other.latency)
+        self.queue_wait.merge(other.queue_wait)
+
+    def to_dict(self):
+        return {
+            **self.counters,
+            "total_tokens": self.counters["prompt_tokens"]
+            + self.counters["completion_tokens"],
+            # share of prompt tokens served from the provider's prefix cache
+            "cached_token_ratio": self.counters["cached_tokens"]
+            / self.counters["prompt_tokens"]
+            if self.counters["prompt_tokens"] > 0
+            else 0.0,
+            "latency": self.latency.to_dict(),
+            "queue_wait": self.queue_wait.to_dict(),
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread-safe registry of LLM call counts, token usage, retries and latency/queue-wait histograms,
+    broken down by agent component (planner, actor, observer, ...), task and model.
+    The component and task of a call are taken from the calling context (see `component` and `set_task`).
+    """
+
+    _lock = threading.Lock()
+    _series = defaultdict(Series)
+
+    @classmethod
+    @contextmanager
+    def component(cls, name):
+        token = _current_component.set(name)
+        try:
+            yield
+        finally:
+            _current_component.reset(token)
+
+    @classmethod
+    def current_component(cls):
+        return _current_component.get()
+
+    @classmethod
+    def set_task(cls, task):
+        _current_task.set(task if task is not None else NO_TASK)
+
+    @classmethod
+    def _get_series(cls, model):
+        return cls._series[(_current_component.get(), _current_task.get(), model)]
+
+    @classmethod
+    def record_call(cls, model, latency, usage=None):
+        with cls._lock:
+            series = cls._get_series(model)
+            series.counters["calls"] += 1
+            series.latency.observe(latency)
+            if usage is not None:
+                series.counters["prompt_tokens"] += _usage_value(usage, "prompt_tokens")
+                series.counters["completion_tokens"] += _usage_value(
+                    usage, "completion_tokens"
+                )
+                series.counters["cached_tokens"] += _usage_value(
+                    usage, "prompt_tokens_details", "cached_tokens"
+                )
+
+    @classmethod
+    def record_cache_hit(cls, model):
+        with cls._lock:
+            cls._get_series(model).counters["cache_hits"] += 1
+
+    @classmethod
+    def record_retry(cls, model):
+        with cls._lock:
+            cls._get_series(model).counters["retries"] += 1
+
+    @classmethod
+    def record_queue_wait(cls, model, wait_time):
+        with cls._lock:
+            cls._get_series(model).queue_wait.observe(wait_time)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._series = defaultdict(Series)
+
+    @classmethod
+    def _aggregate(cls, key_index):
+        aggregated = defaultdict(Series)
+        for key, series in cls._series.items():
+            aggregated[key[key_index]].merge(series)
+        return aggregated
+
+    @classmethod
+    def snapshot(cls):
+        with cls._lock:
+            total = Series()
+            for series in cls._series.values():
+                total.merge(series)
+
+            return {
+                "total": total.to_dict(),
+                "by_component": {
+                    k: v.to_dict() for k, v in cls._aggregate(0).items()
+                },
+                "by_task": {k: v.to_dict() for k, v in cls._aggregate(1).items()},
+                "by_model": {k: v.to_dict() for k, v in cls._aggregate(2).items()},
+            }
+
+    @classmethod
+    def usage_by_model(cls):
+        with cls._lock:
+            return {
+                model: {
+                    "prompt_tokens": series.counters["prompt_tokens"],
+                    "completion_tokens": series.counters["completion_tokens"],
+                    "total_tokens": series.counters["prompt_tokens"]
+                    + series.counters["completion_tokens"],
+                }
+                for model, series in cls._aggregate(2).items()
+            }
+
+    @classmethod
+    def to_prometheus(cls):
+        lines = []
+        with cls._lock:
+            by_component_model = defaultdict(Series)
+            for (component, _, model), series in cls._series.items():
+                by_component_model[(component, model)].merge(series)
+
+        # series are labelled by component and model only: free-text task summaries would make
+        # one series per task (they stay in the JSON snapshot)
+        def labels(component, model, **extra):
+            label_items = [("component", component), ("model", model), *extra.items()]
+            return ",".join(f'{k}="{escape_label_value(v)}"' for k, v in label_items)
+
+        for name in Series.COUNTERS:
+            metric = f"testflow_llm_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (component, model), series in sorted(by_component_model.items()):
+                lines.append(
+                    f"{metric}{{{labels(component, model)}}} {series.counters[name]}"
+                )
+
+        for name in ["latency", "queue_wait"]:
+            metric = f"testflow_llm_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for (component, model), series in sorted(by_component_model.items()):
+                histogram = getattr(series, name)
+                for q in PERCENTILES:
+                    lines.append(
+                        f"{metric}{{{labels(component, model, quantile=q)}}} {histogram.percentile(q)}"
+                    )
+                lines.append(f"{metric}_sum{{{labels(component, model)}}} {histogram.sum}")
+                lines.append(
+                    f"{metric}_count{{{labels(component, model)}}} {histogram.count}"
+                )
+
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def export(cls, output_dir):
+        with open(os.path.join(output_dir, "metrics.json"), "w") as f:
+            json.dump(cls.snapshot(), f, indent=2)
+
+        with open(os.path.join(output_dir, "metrics.prom"), "w") as f:
+            f.write(cls.to_prometheus())
@@ -1,50 +1,25 @@
 import openai
 import time
-from openai import OpenAI
-from dotenv import load_dotenv
+import asyncio
 
 from .config import agent_config
+from .metrics import MetricsRegistry
+from .transport import LLMTransport
+from .response_cache import ResponseCache
+from .scheduler import RequestScheduler, estimate_request_tokens
+from .utils.image_encoder import DETAIL_LOW
 from .utils.logger import Logger
-
-load_dotenv()
-client = OpenAI()
+from .utils.token_budget import count_message_tokens, get_context_window
 
 TIMEOUT = 60
 MAX_TOKENS = 500
 MAX_RETRY = 1000
 TEMPERATURE = 0.6
+VISION_DETAIL = DETAIL_LOW
 
 logger = Logger(__name__)
 
 
-class APIUsageManager:
-    usage = {}
-    response_time = {}
-
-    @classmethod
-    def record_usage(cls, model, usage):
-        if model not in cls.usage:
-            cls.usage[model] = {
-                "prompt_tokens": 0,
-                "completion_tokens": 0,
-                "total_tokens": 0,
-            }
-        if "prompt_tokens" in usage:
-            cls.usage[model]["prompt_tokens"] += usage["prompt_tokens"]
-            cls.usage[model]["completion_tokens"] += usage["completion_tokens"]
-            cls.usage[model]["total_tokens"] += usage["total_tokens"]
-        else:
-            cls.usage[model]["prompt_tokens"] += usage.prompt_tokens
-            cls.usage[model]["completion_tokens"] += usage.completion_tokens
-            cls.usage[model]["total_tokens"] += usage.total_tokens
-
-    @classmethod
-    def record_response_time(cls, model, response_time):
-        if model not in cls.response_time:
-            cls.response_time[model] = []
-        cls.response_time[model].append(response_time)
-
-
 def stringify_prompt(prompt):
     prompt_str = ""
 
@@ -65,42 +40,36 @@ def zip_messages(system_message, user_messages, assistant_messages):
     return {"system_message": system_message, "conversation": conversation}
 
 
-def get_next_assistant_message(
-    system_message,
-    user_messages,
-    assistant_messages=[],
-    functions=[],
-    model="gpt-3.5-turbo-16k-0613",
-    max_tokens=MAX_TOKENS,
-    function_call_option=None,
-):
-    # If model is gpt-3.5-turbo-16k-0613 but the tokens in the prompt are less than 4000 tokens, use gpt-3.5-turbo-0613 instead
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    openai.RateLimitError,
+)
+
+
+def select_model(model, messages, max_tokens=MAX_TOKENS):
+    prompt_tokens = count_message_tokens(messages, model)
+
+    # If model is gpt-3.5-turbo-16k-0613 but the prompt fits in the window of gpt-3.5-turbo-0613, use gpt-3.5-turbo-0613 instead
     if (
         model == "gpt-3.5-turbo-16k-0613"
-        and len(
-            stringify_prompt(
-                zip_messages(system_message, user_messages, assistant_messages)
-            )
-        )
-        < 8000
-    ):  # approximately 4000 tokens
+        and prompt_tokens + max_tokens <= get_context_window("gpt-3.5-turbo-0613")
+    ):
         model = "gpt-3.5-turbo-0613"
         logger.info(f"Using {model} instead of gpt-3.5-turbo-16k-0613")
 
     if (
         model == "gpt-4-0613"
-        and len(
-            stringify_prompt(
-                zip_messages(system_message, user_messages, assistant_messages)
-            )
-        )
-        > 16000
-    ):  # approximately 8000 tokens
+        and prompt_tokens + max_tokens > get_context_window("gpt-4-0613")
+    ):
         model = "gpt-3.5-turbo-16k-0613"
         logger.info(f"Using {model} instead of gpt-4-0613 (context limit exceeded)")
 
-    start_time = time.time()
+    return model
+
 
+def build_messages(system_message, user_messages, assistant_messages):
     messages = [{"role": "system", "content": system_message}]
     if len(user_messages) != len(assistant_messages) + 1:
         with open("errored_prompt.txt", "w") as f:
@@ -137,7 +106,6 @@ def get_next_assistant_message(
         else:
             messages.append({"role": "assistant", "content": assistant_message})
 
-    function_name = None
     user_message = user_messages[-1]
     if not isinstance(user_messages[-1], str) and "tool_call_id" in user_message:
         messages.append(
@@ -151,65 +119,53 @@ def get_next_assistant_message(
     else:
         messages.append({"role": "user", "content": user_message})
 
-    response = None
-    for _ in range(MAX_RETRY):
-        try:
-            if len(functions) > 0:
-                if function_call_option is not None:
-                    response = client.chat.completions.create(
-                        model=model,
-                        temperature=TEMPERATURE,
-                        max_tokens=max_tokens,
-                        tools=functions,
-                        tool_choice=function_call_option,
-                        messages=messages,
-                        timeout=TIMEOUT,
-                    )
-                else:
-                    response = client.chat.completions.create(
-                        model=model,
-                        temperature=TEMPERATURE,
-                        max_tokens=max_tokens,
-                        tools=functions,
-                        messages=messages,
-                        timeout=TIMEOUT,
-                    )
-            else:
-                response = client.chat.completions.create(
-                    model=model,
-                    temperature=TEMPERATURE,
-                    max_tokens=max_tokens,
-                    messages=messages,
-                    timeout=TIMEOUT,
-                )
-        except (
-            openai.APITimeoutError,
-            openai.APIConnectionError,
-            openai.InternalServerError,
-            openai.RateLimitError,
-        ):
-            logger.info(f"OpenAI API request errored. Retrying...")
-            time.sleep(3)
-            continue
-        except KeyboardInterrupt as e:
-            raise e
-        except Exception as e:
-            with open("errored_prompt.txt", "w") as f:
-                f.write(
-                    stringify_prompt(
-                        zip_messages(system_message, user_messages, assistant_messages)
-                    )
-                )
-            raise e
+    return messages
+
 
-        break
+def build_vision_messages(system_message, user_messages, base64_image):
+    messages = [{"role": "system", "content": system_message}]
+    images_messages = []
 
-    if response is None:
-        raise TimeoutError("OpenAI API request errored multiple times")
+    for image, text in zip(base64_image, user_messages):
+        # images are either data URLs from ImageEncoder or raw base64 PNG payloads
+        url = image if image.startswith("data:") else f"data:image/png;base64,{image}"
+        images_messages.append({"type": "text", "text": text})
+        images_messages.append(
+            {
+                "type": "image_url",
+                "image_url": {"url": url, "detail": VISION_DETAIL},
+            }
+        )
+
+    messages.append({"role": "user", "content": images_messages})
+    return messages
 
-    APIUsageManager.record_usage(model, response.usage)
-    APIUsageManager.record_response_time(model, time.time() - start_time)
 
+def build_request(
+    model,
+    messages,
+    functions=[],
+    max_tokens=MAX_TOKENS,
+    function_call_option=None,
+    temperature=TEMPERATURE,
+):
+    request = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "messages": messages,
+        "timeout": TIMEOUT,
+    }
+    if temperature is not None:
+        request["temperature"] = temperature
+    if len(functions) > 0:
+        request["tools"] = functions
+        if function_call_option is not None:
+            request["tool_choice"] = function_call_option
+
+    return request
+
+
+def parse_response(response):
     response_message = response.choices[0].message
     tool_calls = response_message.tool_calls
 
@@ -223,109 +179,187 @@ def get_next_assistant_message(
             },
         }
 
+    if response_message.content is None:
+        return ""
+
     return response_message.content.strip()
 
 
-def get_vision_assistant_message(
-    system_message,
-    user_messages,
-    assistant_messages=[],
-    functions=[],
-    model="gpt-4-turbo-2024-04-09",
-    max_tokens=MAX_TOKENS,
-    base64_image=[],
-):
-    start_time = time.time()
-
-    messages = [{"role": "system", "content": system_message}]
-    # if len(user_messages) != len(assistant_messages) + 1:
-    #     with open('errored_prompt.txt', 'w') as f:
-    #         f.write(stringify_prompt(zip_messages(system_message, user_messages, assistant_messages)))
-
-    #     raise ValueError('Number of user messages should be one more than the number of assistant messages: refer to `errored_prompt.txt`')
-    # for user_message, assistant_message in zip(user_messages[:-1], assistant_messages):
-    #     if not isinstance(user_message, str):
-    #         messages.append({"role": "tool", "tool_call_id": user_message['tool_call_id'], "name": user_message['name'], "content": user_message['return_value']})
-    #     else:
-    #         messages.append({"role": "user", "content": user_message})
-
-    #     if not isinstance(assistant_message, str):
-    #         messages.append({"role": "assistant", "content": None, "tool_calls": [assistant_message]})
-    #     else:
-    #         messages.append({"role": "assistant", "content": assistant_message})
-
-    # function_name = None
-    # user_message = user_messages[-1]
-    # if not isinstance(user_messages[-1], str):
-    #     messages.append({"role": "tool", "tool_call_id": user_message['tool_call_id'], "name": user_message['name'], "content": user_message['return_value']})
-    # else:
-    #     messages.append({"role": "user", "content": user_message})
-    import os
-
-    api_key = os.environ["OPENAI_API_KEY"]
-    images_messages = []
+def create_completion(request, prompt=None):
+    """
+    Send a chat-completions request over the shared transport once the scheduler admits it,
+    retrying transient errors with backoff
+    :param request: dict, keyword arguments for `chat.completions.create`
+    :param prompt: dict, zipped prompt dumped to `errored_prompt.txt` on a non-retryable error
+    """
+    model = request["model"]
+    estimated_tokens = estimate_request_tokens(request)
+    for attempt in range(MAX_RETRY):
+        slots = RequestScheduler.acquire(model, estimated_tokens)
+        try:
+            return LLMTransport.client().chat.completions.create(**request)
+        except RETRYABLE_ERRORS as e:
+            MetricsRegistry.record_retry(model)
+            delay = RequestScheduler.backoff(model, attempt, e)
+            logger.info(
+                f"OpenAI API request errored ({type(e).__name__}). Retrying in {delay:.1f}s..."
+            )
+        except KeyboardInterrupt as e:
+            raise e
+        except Exception as e:
+            if prompt is not None:
+                with open("errored_prompt.txt", "w") as f:
+                    f.write(stringify_prompt(prompt))
+            raise e
+        finally:
+            RequestScheduler.release(slots)
 
-    for image, text in zip(base64_image, user_messages):
+        time.sleep(delay)
 
-        images_messages.append({"type": "text", "text": text})
-        images_messages.append(
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{image}", "detail": "low"},
-            }
-        )
+    raise TimeoutError("OpenAI API request errored multiple times")
 
-    messages.append({"role": "user", "content": images_messages})
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
-    payload = {"model": model, "messages": messages, "max_tokens": MAX_TOKENS}
 
-    response = None
-    for _ in range(MAX_RETRY):
+async def acreate_completion(request, prompt=None):
+    model = request["model"]
+    estimated_tokens = estimate_request_tokens(request)
+    for attempt in range(MAX_RETRY):
+        slots = await RequestScheduler.aacquire(model, estimated_tokens)
         try:
-            import requests
-
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=payload,
+            return await LLMTransport.async_client().chat.completions.create(
+                **request
+            )
+        except RETRYABLE_ERRORS as e:
+            MetricsRegistry.record_retry(model)
+            delay = RequestScheduler.backoff(model, attempt, e)
+            logger.info(
+                f"OpenAI API request errored ({type(e).__name__}). Retrying in {delay:.1f}s..."
             )
-
-        except (
-            openai.APITimeoutError,
-            openai.APIConnectionError,
-            openai.InternalServerError,
-            openai.RateLimitError,
-        ):
-            logger.info(f"OpenAI API request errored. Retrying...")
-            time.sleep(3)
-            continue
-        except KeyboardInterrupt as e:
-            raise e
         except Exception as e:
+            if prompt is not None:
+                with open("errored_prompt.txt", "w") as f:
+                    f.write(stringify_prompt(prompt))
             raise e
+        finally:
+            RequestScheduler.release(slots)
+
+        await asyncio.sleep(delay)
+
+    raise TimeoutError("OpenAI API request errored multiple times")
+
+
+def record_response(model, response, start_time):
+    MetricsRegistry.record_call(model, time.time() - start_time, usage=response.usage)
+
+
+def complete(request, prompt=None):
+    """
+    Serve a request from the response cache, or send it and record the usage and the answer
+    :return: str or dict, the assistant text or the first tool call
+    """
+    cache_key = ResponseCache.make_key(request)
+    hit, result = ResponseCache.get(cache_key)
+    if hit:
+        MetricsRegistry.record_cache_hit(request["model"])
+        return result
+
+    start_time = time.time()
+    response = create_completion(request, prompt=prompt)
+    record_response(request["model"], response, start_time)
+
+    result = parse_response(response)
+    ResponseCache.put(cache_key, result, model=request["model"])
+    return result
+
+
+async def acomplete(request, prompt=None):
+    cache_key = ResponseCache.make_key(request)
+    hit, result = ResponseCache.get(cache_key)
+    if hit:
+        MetricsRegistry.record_cache_hit(request["model"])
+        return result
+
+    start_time = time.time()
+    response = await acreate_completion(request, prompt=prompt)
+    record_response(request["model"], response, start_time)
+
+    result = parse_response(response)
+    ResponseCache.put(cache_key, result, model=request["model"])
+    return result
+
+
+def get_next_assistant_message(
+    system_message,
+    user_messages,
+    assistant_messages=[],
+    functions=[],
+    model="gpt-3.5-turbo-16k-0613",
+    max_tokens=MAX_TOKENS,
+    function_call_option=None,
+):
+    messages = build_messages(system_message, user_messages, assistant_messages)
+    model = select_model(model, messages, max_tokens=max_tokens)
+    request = build_request(
+        model,
+        messages,
+        functions=functions,
+        max_tokens=max_tokens,
+        function_call_option=function_call_option,
+    )
+
+    return complete(
+        request, prompt=zip_messages(system_message, user_messages, assistant_messages)
+    )
+
+
+async def aget_next_assistant_message(
+    system_message,
+    user_messages,
+    assistant_messages=[],
+    functions=[],
+    model="gpt-3.5-turbo-16k-0613",
+    max_tokens=MAX_TOKENS,
+    function_call_option=None,
+):
+    messages = build_messages(system_message, user_messages, assistant_messages)
+    model = select_model(model, messages, max_tokens=max_tokens)
+    request = build_request(
+        model,
+        messages,
+        functions=functions,
+        max_tokens=max_tokens,
+        function_call_option=function_call_option,
+    )
 
-        break
+    return await acomplete(
+        request, prompt=zip_messages(system_message, user_messages, assistant_messages)
+    )
 
-    if response is None:
-        raise TimeoutError("OpenAI API request errored multiple times")
 
-    response = response.json()
-    print(response)
-    try:
-        APIUsageManager.record_usage(model, response["usage"])
-    except KeyError:
-        pass
-    APIUsageManager.record_response_time(model, time.time() - start_time)
+def get_vision_assistant_message(
+    system_message,
+    user_messages,
+    assistant_messages=[],
+    functions=[],
+    model="gpt-4-turbo-2024-04-09",
+    max_tokens=MAX_TOKENS,
+    base64_image=[],
+):
+    messages = build_vision_messages(system_message, user_messages, base64_image)
+    request = build_request(model, messages, max_tokens=max_tokens, temperature=None)
+
+    return complete(request)
 
-    try:
-        response_message = response["choices"][0]["message"]
-    except KeyError:
-        pass
 
-    ret_data = ""
-    try:
-        ret_data = response_message["content"].strip()
-    except KeyError:
-        pass
+async def aget_vision_assistant_message(
+    system_message,
+    user_messages,
+    assistant_messages=[],
+    functions=[],
+    model="gpt-4-turbo-2024-04-09",
+    max_tokens=MAX_TOKENS,
+    base64_image=[],
+):
+    messages = build_vision_messages(system_message, user_messages, base64_image)
+    request = build_request(model, messages, max_tokens=max_tokens, temperature=None)
 
-    return ret_data
+    return await acomplete(request)
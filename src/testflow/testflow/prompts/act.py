@@ -1,94 +1,161 @@
 from ..config import agent_config
 from ..app_state import AppState
+from ..types.screen_encoders import get_screen_format
 
-from ..model import get_next_assistant_message, zip_messages
+from ..model import get_next_assistant_message, zip_messages, MAX_TOKENS
+from ..utils.token_budget import PromptBudget, truncate_to_tokens, TRIM_LINES_HEAD
+from .layout import PromptLayout, STATIC, TASK
+from ..routing import get_routed_assistant_message, is_confident, TIER_LOW
 from ..functions.possible_actions import *
 from ..utils import *
+from ..utils.logger import Logger
 
 QUERY_COUNT = 3
+REFLECTION_TOKEN_LIMIT = 600 # per list (optimization steps, rules)
+TEXT_INPUT_TIER = TIER_LOW
+
+logger = Logger(__name__)
 
 
 def prompt_action(memory, prompt_recorder=None, reflections=None, optimizations=None):
+    screen_encoder = agent_config.screen_encoder_for('act')
+    screen_format = get_screen_format(screen_encoder)
     possible_action_functions, function_map = initialize_possible_actions()
-    if optimizations is not None or optimizations != "":
-        optimization = "\n".join([f"- {opt}" for opt in optimizations])
-    if reflections is not None or reflections != "":
-        reflection = "\n".join([f"- {ref}" for ref in reflections])
-        
-    system_message = ""
-    if reflections == "" or reflections is None:
-        system_message = f'''
-    You are a helpful assistant to guide a user named {agent_config.persona_name} to select an appropriate GUI action to accomplish a task on an Android mobile application named {agent_config.app_name}.
-
-    {agent_config.persona_name} can perform the following types of actions:
-    - Scroll on a scrollable widget
-    - Touch on a clickable widget
-    - Long touch on a long-clickable widget
-    - Fill in an editable widget
-    - Navigate back by pressing the back button
-    '''.strip()
-    # *Important: Senior software engineer had watch your previous actions and provided guide for the next step. You must consider it:
-    # Next step suggestion: {memory.working_memory.get_next_step_suggestion()}
-    
-    # '''.strip()
-    
-    else:
-        system_message = f'''
-    You are a helpful assistant to guide a user named {agent_config.persona_name} to select an appropriate GUI action to accomplish a task on an Android mobile application named {agent_config.app_name}.
-
-    {agent_config.persona_name} can perform the following types of actions:
-    - Scroll on a scrollable widget
-    - Touch on a clickable widget
-    - Long touch on a long-clickable widget
-    - Fill in an editable widget
-    - Navigate back by pressing the back button
-    
-    ===
-    *Important: {agent_config.persona_name} had done this task before and received the following reflections, you must strictly follow and consider the rules to guide {agent_config.persona_name} effectively and avoid previous mistakes:
-    Optimization steps:
-    {optimization}
-    Rules to follow:
-    {reflection}
-    ===
-    '''.strip()
-    # Next step suggestion: {memory.working_memory.get_next_step_suggestion()}
-    # ===
-    # '''.strip()
+    optimization = "\n".join([f"- {opt}" for opt in optimizations or []])
+    reflection = "\n".join([f"- {ref}" for ref in reflections or []])
 
-    user_messages, assistant_messages = memory.working_memory.make_virtual_conversation()
+    # reflections only change between tasks, so they are capped on their own instead of sharing the budget with the page content
+    optimization = truncate_to_tokens(optimization, REFLECTION_TOKEN_LIMIT, policy=TRIM_LINES_HEAD, model=agent_config.actor_model)
+    reflection = truncate_to_tokens(reflection, REFLECTION_TOKEN_LIMIT, policy=TRIM_LINES_HEAD, model=agent_config.actor_model)
 
-    # extract the observation from the last user message (this time, the user query is "real" so we need to be more in detail)
-    last_observation = user_messages[-1].strip()
+    layout = PromptLayout()
+    layout.add(f'''
+You are a helpful assistant to guide a user named {agent_config.persona_name} to select an appropriate GUI action to accomplish a task on an Android mobile application named {agent_config.app_name}.
 
-    user_messages.pop()
-    user_messages.append(f'''
-{last_observation}
+{agent_config.persona_name} can perform the following types of actions:
+- Scroll on a scrollable widget
+- Touch on a clickable widget
+- Long touch on a long-clickable widget
+- Fill in an editable widget
+- Navigate back by pressing the back button
 
-This time, I'll give you the full content of the current page as follows (I organized the page content as a hierarchical structure):
-```json
-{AppState.current_gui_state.describe_screen_w_memory(memory, prompt_recorder=prompt_recorder)}
-```
+For each step, I will give you the full content of the current page (organized as a {screen_format.structure}).
 
 Guideline for selecting the next action:
 - I don't want to do the same actions repeatedly except it is clearly needed for the task (e.g., navigating back to the first page of the app), so guide me to perform effective actions to complete the task.
+- Select the next suitable action to perform, or end the task if the task is already completed. Do not perform any unnecessary actions that are not related to the task (eg, if the task is create somethings, just end the task when that thing is created, do not need to verify it by searhing or clicking anywhere)
 
-Recall that my current task is: {memory.working_memory.task.summary}
-Select the next suitable action to perform, or end the task if the task is already completed. Do not perform any unnecessary actions that are not related to the task (eg, if the task is create somethings, just end the task when that thing is created, do not need to verify it by searhing or clicking anywhere)
-
-This time, I am going to provide a template for your output to let you think about my next action step by step. Fill out the <...> parts in the template with your own words. Do not include anything else in your answer except the text to fill out the template. Preserve the formatting and overall template.
+When I ask for the next action, fill out the template below to think about my next action step by step. Fill out the <...> parts in the template with your own words. Do not include anything else in your answer except the text to fill out the template. Preserve the formatting and overall template.
 
 === Below is the template for your answer ===
 1. Summary of my previous interactions for the task: <1~2 sentences according to the task execution history and current app state. Reflect criticizer's feedback if I mentioned any. Be careful not to include any actions that haven't been performed yet>
-2. Description of the current app state: <1~2 sentences, briefly describe in one line according to the hierarchical structure I provided above>
+2. Description of the current app state: <1~2 sentences, briefly describe in one line according to the {screen_format.structure} I provided above>
 3. Inference on the remaining steps needed to complete the task: <1~2 sentences according to the task execution history and current app state. Do not immediately judge the next action here>
 4. Reasoning for the next action: <1 sentence reasoning the most logical action to take next on the current state (or justification for ending the task). Refer to the guideline above>
-'''.strip())
+''', STATIC)
+    layout.add(f'My current task is: {memory.working_memory.task.summary}', TASK)
+    if len(optimization) > 0 or len(reflection) > 0:
+        layout.add(f'''
+===
+*Important: {agent_config.persona_name} had done this task before and received the following reflections, you must strictly follow and consider the rules to guide {agent_config.persona_name} effectively and avoid previous mistakes:
+Optimization steps:
+{optimization}
+Rules to follow:
+{reflection}
+===
+''', TASK)
+    system_message = layout.render(STATIC, TASK)
+
+    def make_user_message(last_observation, screen_description):
+        return f'''
+{last_observation}
+
+This time, I'll give you the full content of the current page as follows (I organized the page content as a {screen_format.structure}):
+```{screen_format.fence}
+{screen_description}
+```
+
+Recall that my current task is: {memory.working_memory.task.summary}
+Select the next action by filling out the template given at the beginning.
+'''.strip()
+
+    user_messages, assistant_messages = memory.working_memory.make_virtual_conversation()
+
+    # extract the observation from the last user message (this time, the user query is "real" so we need to be more in detail)
+    last_observation = user_messages[-1].strip()
+    user_messages.pop()
+
+    screen = AppState.current_gui_state.prunable_screen_w_memory(memory, encoder=screen_encoder, prompt_recorder=prompt_recorder)
+
+    # the system prompt and the earlier turns are the cached prefix and are kept as-is; the page content gets what is left
+    budget = PromptBudget(agent_config.actor_model, max_completion_tokens=MAX_TOKENS)
+    budget.reserve(system_message, make_user_message(last_observation, ''), *user_messages, *assistant_messages)
+    fitted = budget.fit({
+        'screen': (screen.describe(), screen.describe),
+    })
+
+    user_messages.append(make_user_message(last_observation, fitted['screen']))
+
+    if agent_config.single_call_action:
+        selected, action = prompt_action_single_call(memory, system_message, user_messages[:], assistant_messages[:], prompt_recorder=prompt_recorder)
+        if selected:
+            return action
+        logger.info('Single-call action selection failed. Falling back to separate reasoning and function calls.')
 
     assistant_messages.append(get_next_assistant_message(system_message, user_messages, assistant_messages, model=agent_config.actor_model, functions=list(possible_action_functions.values()), function_call_option="none")) # just reasoning this time
 
     return prompt_action_function(memory, system_message, user_messages, assistant_messages, possible_action_functions, function_map, prompt_recorder=prompt_recorder)
 
 
+def prompt_action_single_call(memory, system_message, user_messages, assistant_messages, prompt_recorder=None):
+    """
+    Select the next action with one structured tool call carrying the reasoning, the action and its text input
+    :return: (bool, Action), whether a valid selection was made and the selected action (None to end the task)
+    """
+    possible_action_functions, function_map = initialize_single_call_actions()
+
+    if memory.working_memory.get_task_done() == True:
+        instruction = 'This task has been completed. You must end the task now by calling the function that corresponds to the end of the task, and put your reasoning in its "reasoning" argument.'
+    else:
+        instruction = f'Answer by calling exactly one of the given functions that corresponds to the next action (or to the end of the task). Put the filled-out template in the "reasoning" argument of the function. If you select set_text, also provide the concrete text that {agent_config.persona_name} would input, inferred from their profile, in the "text" argument.'
+    user_messages[-1] = f'{user_messages[-1]}\n\n{instruction}'
+
+    assistant_messages.append(get_next_assistant_message(system_message, user_messages, assistant_messages, model=agent_config.actor_model, functions=list(possible_action_functions.values()), function_call_option="required"))
+    response = assistant_messages[-1]
+
+    if isinstance(response, str) or response['function']['name'] not in possible_action_functions:
+        return False, None
+
+    try:
+        function_args = json.loads(response['function']['arguments'])
+    except json.decoder.JSONDecodeError:
+        return False, None
+
+    function_name = response['function']['name']
+    processed_function_args = {}
+    for param_name in possible_action_functions[function_name]['function']['parameters']['properties']:
+        arg_value = function_args.get(param_name)
+        if arg_value is None:
+            return False, None
+        if param_name == 'reasoning':
+            continue
+        if param_name == 'target_widget_ID':
+            try:
+                arg_value = int(arg_value)
+            except ValueError:
+                return False, None
+        processed_function_args[param_name] = arg_value
+
+    action, error_message = function_map[function_name](**processed_function_args)
+    if error_message is not None:
+        return False, None
+
+    if prompt_recorder is not None:
+        prompt_recorder.record(zip_messages(system_message, user_messages, assistant_messages), 'action')
+
+    return True, action
+
+
 def prompt_action_function(memory, system_message, user_messages, assistant_messages, possible_action_functions, function_map, error_message=None, prompt_recorder=None, query_count=QUERY_COUNT):
     if query_count == 0:
         if prompt_recorder is not None:
@@ -197,6 +264,16 @@ def prompt_action_function(memory, system_message, user_messages, assistant_mess
     return action
 
 
+def parse_text_input(answer):
+    if not isinstance(answer, str):
+        return None
+    for l in answer.split('\n'):
+        l = l.strip()
+        if l.startswith('Text:'):
+            return l.removeprefix('Text:').strip().strip('"').strip()
+    return None
+
+
 def prompt_text_input(memory, system_message, user_messages, assistant_messages, target_widget, prompt_recorder=None, caller='actor'):
     response = assistant_messages[-1]
 
@@ -232,13 +309,8 @@ Text: {agent_config.persona_name}
 
     received_text = None
     for _ in range(QUERY_COUNT):
-        assistant_messages.append(get_next_assistant_message(system_message, user_messages, assistant_messages, model=agent_config.actor_model, function_call_option="none"))
-        response = assistant_messages[-1]
-        for l in response.split('\n'):
-            l = l.strip()
-            if l.startswith('Text:'):
-                received_text = l.strip().removeprefix('Text:').strip().strip('"').strip()
-                break
+        assistant_messages.append(get_routed_assistant_message(TEXT_INPUT_TIER, 'text_input', lambda answer: parse_text_input(answer) is not None and is_confident(answer), system_message, user_messages, assistant_messages, model=agent_config.actor_model, function_call_option="none"))
+        received_text = parse_text_input(assistant_messages[-1])
         if received_text is not None:
             break
         
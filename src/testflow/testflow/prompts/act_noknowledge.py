@@ -1,5 +1,6 @@
 from ..config import agent_config
 from ..app_state import AppState
+from ..types.screen_encoders import get_screen_format
 from ..model import get_next_assistant_message, zip_messages
 from ..functions.possible_actions import *
 from ..utils import *
@@ -11,6 +12,8 @@ QUERY_COUNT = 3
 
 
 def prompt_action(memory, prompt_recorder=None):
+    screen_encoder = agent_config.screen_encoder_for('act')
+    screen_format = get_screen_format(screen_encoder)
     possible_action_functions, function_map = initialize_possible_actions()
 
     system_message = f'''
@@ -34,9 +37,9 @@ or end the task if the task is already completed.
     user_messages.append(f'''
 {last_observation}
 
-This time, I'll give you the full content of the current page as follows (I organized the page content as a hierarchical structure):
-```json
-{AppState.current_gui_state.describe_screen_w_memory(memory, include_widget_knowledge=False)}
+This time, I'll give you the full content of the current page as follows (I organized the page content as a {screen_format.structure}):
+```{screen_format.fence}
+{AppState.current_gui_state.describe_screen_w_memory(memory, encoder=screen_encoder, include_widget_knowledge=False)}
 ```
 Note that `num_prev_actions` property means the number of times the widget has been interacted with so far.
 
@@ -47,7 +50,7 @@ This time, I am going to provide a template for your output to let you think abo
 
 === Below is the template for your answer ===
 1. Summary of my previous interactions for the task: <1~2 sentences according to the task execution history and current app state. Be careful not to include any actions that haven't been performed yet>
-2. Description of the current app state: <1~2 sentences, briefly describe in one line according to the hierarchical structure I provided above>
+2. Description of the current app state: <1~2 sentences, briefly describe in one line according to the {screen_format.structure} I provided above>
 3. Inference on the remaining steps needed to complete the task: <1~2 sentences according to the task execution history and current app state. Do not immediately judge the next action here>
 4. Reasoning for the next action: <1 sentence reasoning the most logical action to take next on the current state (or justification for ending the task). Refer to the guideline above>
 '''.strip())
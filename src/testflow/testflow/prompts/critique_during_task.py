@@ -1,11 +1,15 @@
 from ..config import agent_config
 from ..app_state import AppState
+from ..types.screen_encoders import get_screen_format
 
-from ..model import get_next_assistant_message, zip_messages
+from ..model import get_next_assistant_message, zip_messages, MAX_TOKENS
+from ..utils.token_budget import PromptBudget, TRIM_LINES_TAIL
 from ..utils.stringutil import add_period
 
 
 def prompt_critique(memory, prompt_recorder=None):
+    screen_encoder = agent_config.screen_encoder_for('critique')
+    screen_format = get_screen_format(screen_encoder)
     system_message = f'''
 You are a helpful inspector who can review the GUI actions performed on an Android mobile app named {agent_config.app_name}. The actions are done by a person named "{agent_config.persona_name}" to accomplish the target task: {add_period(memory.working_memory.task.summary)} {add_period(memory.working_memory.task.end_condition)}
 
@@ -15,18 +19,19 @@ You are going to provide helpful feedback and suggest a revised plan to help {ag
     assistant_messages = []
     user_messages = []
 
-    user_messages.append(f'''
+    def make_user_message(task_history, screen_description):
+        return f'''
 Critique the actions done by {agent_config.persona_name} with respect to the current task, and give a helpful workaround if {agent_config.persona_name} is struggling to accomplish the task.
 
 Task execution history so far (listed in chronological order):
 ===
-{memory.working_memory.stringify()}
+{task_history}
 ===
 
 Current page: {AppState.current_activity} 
 Widgets in current page:
-```json
-{AppState.current_gui_state.describe_screen_w_memory(memory, show_id=False, prompt_recorder=prompt_recorder)}
+```{screen_format.fence}
+{screen_description}
 ```
 Guideline for criticizing the actions:
 - Note that `num_prev_actions` property means the number of times the widget has been interacted with so far.
@@ -40,7 +45,18 @@ I am going to provide a template for your output to reason about your choice ste
 Critique of task execution so far: <1~2 sentences in one line, say "okay" if everything seems fine.>
 Need a workaround plan?: <yes/no, do not include any other word except "yes" or "no">
 Workaround plan for {agent_config.persona_name}: <Start with "{agent_config.persona_name} needs to", and describe in one line. Say just "none" if {agent_config.persona_name} is doing well and no workaround is needed.>
-    '''.strip())
+    '''.strip()
+
+    screen = AppState.current_gui_state.prunable_screen_w_memory(memory, encoder=screen_encoder, show_id=False, prompt_recorder=prompt_recorder)
+
+    budget = PromptBudget(agent_config.reflector_model, max_completion_tokens=MAX_TOKENS)
+    budget.reserve(system_message, make_user_message('', ''))
+    fitted = budget.fit({
+        'history': (memory.working_memory.stringify(), TRIM_LINES_TAIL),
+        'screen': (screen.describe(), screen.describe),
+    })
+
+    user_messages.append(make_user_message(fitted['history'], fitted['screen']))
 
     assistant_messages.append(get_next_assistant_message(system_message, user_messages, assistant_messages, model=agent_config.reflector_model))
 
@@ -1,10 +1,13 @@
 from ..config import agent_config
 from ..app_state import AppState
+from ..types.screen_encoders import get_screen_format
 from ..model import get_next_assistant_message, zip_messages
 from ..utils.stringutil import add_period
 
 
 def prompt_critique(memory, prompt_recorder=None):
+    screen_encoder = agent_config.screen_encoder_for('critique')
+    screen_format = get_screen_format(screen_encoder)
     system_message = f'''
 You are a helpful inspector who can review the GUI actions performed on an Android mobile app named {agent_config.app_name}. The actions are done by a person named "{agent_config.persona_name}" to accomplish the target task: {add_period(memory.working_memory.task.summary)} {add_period(memory.working_memory.task.end_condition)}
 
@@ -24,8 +27,8 @@ Task execution history so far (listed in chronological order):
 
 Current page: {AppState.current_activity} 
 Widgets in current page:
-```json
-{AppState.current_gui_state.describe_screen_w_memory(memory, include_widget_knowledge=False, show_id=False)}
+```{screen_format.fence}
+{AppState.current_gui_state.describe_screen_w_memory(memory, encoder=screen_encoder, include_widget_knowledge=False, show_id=False)}
 ```
 Guideline for criticizing the actions:
 - Note that `num_prev_actions` property means the number of times the widget has been interacted with so far.
@@ -0,0 +1,30 @@
+STATIC = 'static' # identical for the whole run: role, persona, app, page list, instructions and answer templates
+TASK = 'task' # identical for every step of a task: task description, end condition, reflections
+STEP = 'step' # changes every step: current page, visit counts, history, observations
+STABILITY_ORDER = [STATIC, TASK, STEP]
+
+
+class PromptLayout:
+    """
+    Assembles a prompt from sections ordered from the most static to the most dynamic.
+    Providers cache prompt prefixes, so consecutive requests only share a cached prefix if nothing
+    that changes per step is placed before content that does not.
+    """
+    def __init__(self):
+        self.sections = []
+
+    def add(self, text, stability=STATIC):
+        assert stability in STABILITY_ORDER, f'Unknown section stability: {stability}'
+        if text is None or len(text.strip()) == 0:
+            return self
+
+        self.sections.append((STABILITY_ORDER.index(stability), len(self.sections), text.strip()))
+        return self
+
+    def render(self, *stabilities):
+        """
+        :param stabilities: stability levels to include (all of them if none is given)
+        :return: str, the sections joined in stability order (insertion order within a level)
+        """
+        levels = [STABILITY_ORDER.index(s) for s in stabilities] if len(stabilities) > 0 else range(len(STABILITY_ORDER))
+        return '\n\n'.join(text for level, _, text in sorted(self.sections) if level in levels)
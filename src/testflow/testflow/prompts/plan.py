@@ -1,9 +1,12 @@
 from ..config import agent_config
 from ..app_state import AppState
-from ..model import get_next_assistant_message, zip_messages
+from ..types.screen_encoders import get_screen_format
+from ..model import get_next_assistant_message, zip_messages, MAX_TOKENS
+from ..utils.token_budget import PromptBudget, TRIM_LINES_HEAD, TRIM_LINES_TAIL
 from ..functions.possible_actions import *
 from ..utils.stringutil import *
 from .act import prompt_text_input, initialize_possible_actions
+from .layout import PromptLayout, STATIC
 
 QUERY_COUNT = 3
 
@@ -11,56 +14,75 @@ QUERY_COUNT = 3
 1. Persona-based exploration w/ custom testing objective
 """
 def prompt_new_task(memory, prompt_recorder=None):
+    screen_encoder = agent_config.screen_encoder_for('plan')
+    screen_format = get_screen_format(screen_encoder)
     # TODO: refer to spatial memory - what is the current page? what are the widgets in the current page?
     # TODO: refer to temporal memory - what are the memorable tasks so far?
-    unvisited_pages = list(set(AppState.activities) - set(AppState.visited_activities.keys()))
+    unvisited_pages = sorted(set(AppState.activities) - set(AppState.visited_activities.keys()))
 
-    system_message = f'''
-You are a helpful task planner for using an Android mobile application named {agent_config.app_name}. 
+    layout = PromptLayout()
+    layout.add(f'''
+You are a helpful task planner for using an Android mobile application named {agent_config.app_name}.
 
 {agent_config.persona_name}'s task is: {agent_config.ultimate_goal}. You need to help {agent_config.persona_name} to successfully complete the task.
 - {agent_config.app_name} app has following pages: {remove_quotes(str(AppState.activities))} (Note that the pages are listed in random order)
-- Currently, {agent_config.persona_name} has visited the following pages with the following number of times: {remove_quotes(json.dumps(AppState.visited_activities))}
-- Currently, {agent_config.persona_name} is on the {AppState.current_gui_state.activity} page.
-- Pages never visited yet: {remove_quotes(str(unvisited_pages))} 
-'''.strip()
+
+{agent_config.persona_name} can perform the following types of actions:
+- Scroll on a scrollable widget
+- Touch on a clickable widget
+- Long touch on a long-clickable widget
+- Fill in an editable widget
+- Navigate back by pressing the back button
+
+In the page content, `num_prev_actions` means the number of times the widget has been interacted with during the previous tasks. If `num_prev_actions` property is not included in the widget dictionary, {agent_config.persona_name} has never performed any action on the widget yet.
+
+I am going to provide a template for your output to reason about your next task step by step. Fill out only the <...> parts in the template with your own words. Do not include anything else in your answer except the text to fill out the template. Remember to remove the "<>" bracket. Preserve the formatting and overall template.
+
+=== Below is the template for your answer ===
+End condition of {agent_config.persona_name}'s next task: <1 sentence, start with "The task is known to be completed when">
+Reasoning of the first action of the {agent_config.persona_name}'s next task: <reasoning and description of the first action initiating the task>
+Rough plan for the task in {agent_config.persona_name}'s perspective: <1 sentence, start with "I plan to"; pretend that you are {agent_config.persona_name}>
+''', STATIC)
+    system_message = layout.render(STATIC)
 
     assistant_messages = []
 
     # set of user messages for planner
-    user_messages = [f'''
-{agent_config.persona_name}'s task is: {agent_config.ultimate_goal}.
-
+    def make_user_message(task_history, task_reflections, screen_description):
+        return f'''
 {agent_config.persona_name}'s prior knowledge and history of previous tasks so far (listed in chronological order):
 ===
-{memory.task_memory.retrieve_task_history()}
+{task_history}
 ===
 
 {agent_config.persona_name}'s learnt knowledge from previous tasks (which may be relevant to the current context):
 ===
-{memory.task_memory.retrieve_task_reflections(AppState.current_gui_state)}
+{task_reflections}
 ===
 
-Current page (organized in a hierarchical structure):
-```json
-{AppState.current_gui_state.describe_screen_w_memory(memory, prompt_recorder=prompt_recorder)}
+- Currently, {agent_config.persona_name} has visited the following pages with the following number of times: {remove_quotes(json.dumps(AppState.visited_activities))}
+- Pages never visited yet: {remove_quotes(str(unvisited_pages))}
+- Currently, {agent_config.persona_name} is on the {AppState.current_gui_state.activity} page.
+
+Current page (organized in a {screen_format.structure}):
+```{screen_format.fence}
+{screen_description}
 ```
-Note that `num_prev_actions` means the number of times the widget has been interacted with during the previous tasks. If `num_prev_actions` property is not included in the widget dictionary, {agent_config.persona_name} has never performed any action on the widget yet.
 
-{agent_config.persona_name} can perform the following types of actions:
-- Scroll on a scrollable widget
-- Touch on a clickable widget
-- Long touch on a long-clickable widget
-- Fill in an editable widget
-- Navigate back by pressing the back button
+Fill out the template given at the beginning to plan {agent_config.persona_name}'s next task.
+'''.strip()
 
-I am going to provide a template for your output to reason about your next task step by step. Fill out only the <...> parts in the template with your own words. Do not include anything else in your answer except the text to fill out the template. Remember to remove the "<>" bracket. Preserve the formatting and overall template.
+    screen = AppState.current_gui_state.prunable_screen_w_memory(memory, encoder=screen_encoder, prompt_recorder=prompt_recorder)
 
-=== Below is the template for your answer ===
-End condition of {agent_config.persona_name}'s next task: <1 sentence, start with "The task is known to be completed when">
-Reasoning of the first action of the {agent_config.persona_name}'s next task: <reasoning and description of the first action initiating the task>
-Rough plan for the task in {agent_config.persona_name}'s perspective: <1 sentence, start with "I plan to"; pretend that you are {agent_config.persona_name}>
-'''.strip()]
+    budget = PromptBudget(agent_config.planner_model, max_completion_tokens=MAX_TOKENS)
+    budget.reserve(system_message, make_user_message('', '', ''))
+    fitted = budget.fit({
+        'history': (memory.task_memory.retrieve_task_history(), TRIM_LINES_TAIL),
+        'knowledge': (memory.task_memory.retrieve_task_reflections(AppState.current_gui_state), TRIM_LINES_HEAD),
+        'screen': (screen.describe(), screen.describe),
+    })
+
+    user_messages = [make_user_message(fitted['history'], fitted['knowledge'], fitted['screen'])]
 
     # Let the planner select the first action
     possible_action_functions, function_map = initialize_possible_actions()
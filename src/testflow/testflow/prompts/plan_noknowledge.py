@@ -1,5 +1,6 @@
 from ..config import agent_config
 from ..app_state import AppState
+from ..types.screen_encoders import get_screen_format
 from ..model import get_next_assistant_message, zip_messages
 from ..functions.possible_actions import *
 from ..utils.stringutil import remove_quotes
@@ -20,6 +21,8 @@ QUERY_COUNT = 3
 1. Persona-based exploration w/ custom testing objective
 """
 def prompt_new_task(memory, prompt_recorder=None):
+    screen_encoder = agent_config.screen_encoder_for('plan')
+    screen_format = get_screen_format(screen_encoder)
     # TODO: refer to spatial memory - what is the current page? what are the widgets in the current page?
     # TODO: refer to temporal memory - what are the memorable tasks so far?
     unvisited_pages = list(set(AppState.activities) - set(AppState.visited_activities.keys()))
@@ -54,9 +57,9 @@ Plan {agent_config.persona_name}'s next task based on the following information.
 {memory.task_memory.retrieve_task_history()}
 ===
 
-Current page (organized in a hierarchical structure):
-```json
-{AppState.current_gui_state.describe_screen_w_memory(memory, include_widget_knowledge=False)}
+Current page (organized in a {screen_format.structure}):
+```{screen_format.fence}
+{AppState.current_gui_state.describe_screen_w_memory(memory, encoder=screen_encoder, include_widget_knowledge=False)}
 ```
 Note that `num_prev_actions` means the number of times the widget has been interacted with during the previous tasks. If `num_prev_actions` property is not included in the widget dictionary, {agent_config.persona_name} has never performed any action on the widget yet.
 
@@ -1,7 +1,9 @@
 from ..config import agent_config
 from ..app_state import AppState
-from ..model import get_next_assistant_message, zip_messages
+from ..model import get_next_assistant_message, zip_messages, MAX_TOKENS
+from ..utils.token_budget import PromptBudget, TRIM_LINES_HEAD, TRIM_LINES_TAIL
 from ..utils.stringutil import remove_quotes
+from .layout import PromptLayout, STATIC
 
 import re
 import json
@@ -10,31 +12,14 @@ MAX_RETRY = 1
 
 def reflect_task(memory, prompt_recorder=None):
     task = memory.working_memory.task.summary
-    system_message = f'''You are a helpful task reflector for a person named "{agent_config.persona_name}" who is using an Android mobile application named {agent_config.app_name}.
+    layout = PromptLayout()
+    layout.add(f'''
+You are a helpful task reflector for a person named "{agent_config.persona_name}" who is using an Android mobile application named {agent_config.app_name}.
 
 {agent_config.persona_name} is performing the task: "{agent_config.ultimate_goal}".
     - The app has following pages: {remove_quotes(str(agent_config.app_activities))}
-    - Currently, {agent_config.persona_name} is on the {AppState.current_gui_state.activity} page.
 
-Currently, {agent_config.persona_name} has performed actions to accomplish the following task: {task}
-
-{agent_config.persona_name} wants to summarize the result of the task and 
-    '''.strip()
-
-    assistant_messages = []
-    user_messages = []
-    user_messages.append(f'''
-Summarize the result of the task, and reflect on the task execution.
-
-Full task execution history:
-===
-{memory.working_memory.stringify()}
-===
-
-Widgets in the current page (page name: {AppState.current_gui_state.activity}):
-===
-{AppState.current_gui_state.describe_widgets_NL(length_limit=8000)}
-===
+{agent_config.persona_name} wants to summarize the result of the task and reflect on the task execution.
 
 Guideline for the task reflection based on the task result:
 - If the task is successful, provide a learned knowledge about the app functionality. (e.g., "The app supports the task X by doing Y.")
@@ -52,7 +37,37 @@ Optimized steps to accomplish the task:
 2.  <...provide up to 10 items>
 Rules on the task:
 - <1 sentence for each item, this strict rule will be used to guide chatGPT to avoid previous mistake, or do the task with more accuracy>
-<...provide up to 2 items>'''.strip())
+<...provide up to 2 items>
+''', STATIC)
+    system_message = layout.render(STATIC)
+
+    assistant_messages = []
+    user_messages = []
+    def make_user_message(task_history, widgets_description):
+        return f'''
+Currently, {agent_config.persona_name} has performed actions to accomplish the following task: {task}
+
+Full task execution history:
+===
+{task_history}
+===
+
+Widgets in the current page (page name: {AppState.current_gui_state.activity}):
+===
+{widgets_description}
+===
+
+Summarize the result of the task, and reflect on the task execution by filling out the template given at the beginning.
+'''.strip()
+
+    budget = PromptBudget(agent_config.reflector_model, max_completion_tokens=MAX_TOKENS)
+    budget.reserve(system_message, make_user_message('', ''))
+    fitted = budget.fit({
+        'history': (memory.working_memory.stringify(), TRIM_LINES_TAIL, 0.5),
+        'screen': (AppState.current_gui_state.describe_widgets_NL(token_limit=None), TRIM_LINES_HEAD, 0.5),
+    })
+
+    user_messages.append(make_user_message(fitted['history'], fitted['screen']))
 
     assistant_messages.append(get_next_assistant_message(system_message, user_messages, assistant_messages, model=agent_config.reflector_model))
 
@@ -1,12 +1,12 @@
 from ..config import agent_config
 
-from ..model import get_next_assistant_message, zip_messages, get_vision_assistant_message
+from ..model import get_next_assistant_message, zip_messages, get_vision_assistant_message, VISION_DETAIL
 from ..functions.possible_actions import *
 from ..utils import *
 from ..utils.stringutil import add_period
+from ..utils.image_encoder import ImageEncoder
 
 import os
-import base64
 MAXIMUM_TRAIN_COUNT = 3
 def state_comparation(memory, screens = [],prompt_recorder=None):
     user_message = []
@@ -97,5 +97,4 @@ def get_base64_image_and_description():
     return screen_descriptions, base64_images
 
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    return ImageEncoder.encode(image_path, detail=VISION_DETAIL)
@@ -1,9 +1,11 @@
 from ..config import agent_config
 from ..app_state import AppState
 from ..model import get_next_assistant_message, zip_messages
-import difflib
+from ..routing import get_routed_assistant_message, is_confident, TIER_LOW
+from ..types.state_diff import diff_states, render_state_diff
 
 MAX_RETRY = 1
+MODEL_TIER = TIER_LOW
 
 
 def summarize_state_change(memory, prompt_recorder=None):
@@ -11,13 +13,7 @@ def summarize_state_change(memory, prompt_recorder=None):
     new_state = AppState.current_gui_state
     previous_action = memory.working_memory.previous_action
 
-    diff_str = ''
-    for line in difflib.unified_diff(old_state.describe_widgets_NL().splitlines(), new_state.describe_widgets_NL().splitlines(), fromfile=f'Previous ({old_state.activity})', tofile=f'Current ({new_state.activity})', lineterm=''):
-        if line.startswith('@@'):
-            continue
-        diff_str += line + '\n'
-
-    diff_str = diff_str.strip()
+    diff_str = render_state_diff(diff_states(old_state, new_state), fromfile=f'Previous ({old_state.activity})', tofile=f'Current ({new_state.activity})')
     # if old_state.activity != new_state.activity:
     #     lines = diff_str.split('\n')
     #     plus_lines = [line for line in lines if line.startswith('+')]
@@ -61,7 +57,7 @@ Guidelines:
 === Below is the template for your answer ===
 Action result summary: <Describe in 1~2 sentences.>
 '''.strip())
-    assistant_messages.append(get_next_assistant_message(system_message, user_messages, assistant_messages, model=agent_config.observer_model))
+    assistant_messages.append(get_routed_assistant_message(MODEL_TIER, 'observer', is_valid_summary, system_message, user_messages, assistant_messages, model=agent_config.observer_model))
 
     state_change_summary = assistant_messages[-1].strip().removeprefix('Action result summary: ').strip()
 
@@ -69,3 +65,8 @@ Action result summary: <Describe in 1~2 sentences.>
         prompt_recorder.record(zip_messages(system_message, user_messages, assistant_messages), 'observe')
 
     return state_change_summary
+
+
+def is_valid_summary(answer):
+    summary = answer.strip().removeprefix('Action result summary: ').strip()
+    return len(summary) > 0 and '<' not in summary and is_confident(summary)
@@ -1,7 +1,9 @@
 from ..config import agent_config
 from ..model import get_next_assistant_message, zip_messages
+from ..routing import get_routed_assistant_message, is_confident, TIER_LOW
 
 MAX_RETRY = 1
+MODEL_TIER = TIER_LOW
 
 
 def prompt_summarized_widget_knowledge(widget_description, relevant_widget_observations, prompt_recorder=None):
@@ -19,7 +21,7 @@ Past interactions on the widget:
 
 Describe the role and functionality of the widget briefly in one sentence based on the provided interaction history. Your answer should start with "The widget". If it seems that interacting the widget introduces a new page or widgets, try to include the name of the page or widgets in your answer. (e.g., The widget expands new options X, Y, Z, the widget opens a new page P, etc.) Do not include anything else except the description of the widget role in your answer.'''.strip())
 
-    assistant_messages.append(get_next_assistant_message(system_message, user_messages, assistant_messages, model=agent_config.knowledge_summary_model))
+    assistant_messages.append(get_routed_assistant_message(MODEL_TIER, 'widget_knowledge', is_valid_widget_knowledge, system_message, user_messages, assistant_messages, model=agent_config.knowledge_summary_model))
 
     widget_knowledge = assistant_messages[-1].strip()
 
@@ -27,3 +29,7 @@ Describe the role and functionality of the widget briefly in one sentence based
         prompt_recorder.record(zip_messages(system_message, user_messages, assistant_messages), 'widget_knowledge')
 
     return widget_knowledge
+
+
+def is_valid_widget_knowledge(answer):
+    return answer.strip().startswith('The widget') and is_confident(answer)
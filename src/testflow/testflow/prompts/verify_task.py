@@ -1,43 +1,60 @@
 from ..config import agent_config
 from ..app_state import AppState
-from ..model import get_next_assistant_message, zip_messages, get_vision_assistant_message
+from ..model import get_next_assistant_message, zip_messages, get_vision_assistant_message, MAX_TOKENS, VISION_DETAIL
+from ..utils.token_budget import PromptBudget, TRIM_LINES_TAIL
 from ..utils.stringutil import remove_quotes, add_period
+from ..utils.image_encoder import ImageEncoder
+from ..utils.logger import Logger
+from .layout import PromptLayout, STATIC
 
 import re
 import json
-import base64
 import os
 import datetime
 
 MAX_RETRY = 1
 
+logger = Logger(__name__)
+
 
 def verify_task(memory, prompt_recorder=None):
     user_messages = []
     assistant_messages = []
-    system_messages = f"""You are a helpful senior mobile tester who is using an Android mobile application named {agent_config.app_name}.
-    
+    layout = PromptLayout()
+    layout.add(f"""
+You are a helpful senior mobile tester who is using an Android mobile application named {agent_config.app_name}.
+
 The current task is: "{agent_config.ultimate_goal}". Your goal is base on the history of the task execution, task end condition and the current state of the app in image form to verify the task execution.
-""".strip()
-    
-    user_messages.append(f'''
-The current task is: "{agent_config.ultimate_goal}"
 
+You must take into consideration the task execution history: all the steps must related and the result of action in the final each step should lead to the task end condition. You must pay attention to the all kind of the Apply button ("OK", "apply", "Create", ...), if you want to changes or create something, you must press it to the task to complete.
+
+I am going to provide a template for your output to reason about your next task step by step. Fill out the <...> parts in the template with your own words. Do not include anything else in your answer except the text to fill out the template. Remember to remove the "<>" character and all of my instructions inside that bracket. Preserve the formatting and overall template.
+
+=== Below is the template for your answer ===
+Describe the current screen: <1~2 sentences in one line, you should describe all element as you see>
+Task done: <yes/no, do not include any other word except "yes" or "no">
+""", STATIC)
+    system_messages = layout.render(STATIC)
+
+    def make_user_message(task_history):
+        return f'''
 Task end condition: {add_period(memory.working_memory.task.end_condition)}
 
 The task execution history (listed in chronological order):
 ===
-{memory.working_memory.stringify_action_with_result()}
+{task_history}
 ===
 
-Based on the task execution history, task end condition and the current state of the app, you need to verify the task execution if the task is done or not. You must take into consideration the task execution history: all the steps must related and the result of action in the final each step should lead to the task end condition. You must pay attention to the all kind of the Apply button ("OK", "apply", "Create", ...), if you want to changes or create something, you must press it to the task to complete.
+Based on the task execution history, task end condition and the current state of the app, verify whether the task is done or not by filling out the template given at the beginning.
+'''.strip()
 
-I am going to provide a template for your output to reason about your next task step by step. Fill out the <...> parts in the template with your own words. Do not include anything else in your answer except the text to fill out the template. Remember to remove the "<>" character and all of my instructions inside that bracket. Preserve the formatting and overall template.
+    budget = PromptBudget(agent_config.verifier_model, max_completion_tokens=MAX_TOKENS)
+    budget.reserve(system_messages, make_user_message(''))
+    fitted = budget.fit({
+        'history': (memory.working_memory.stringify_action_with_result(), TRIM_LINES_TAIL),
+    })
 
-=== Below is the template for your answer ===
-Describe the current screen: <1~2 sentences in one line, you should describe all element as you see>
-Task done: <yes/no, do not include any other word except "yes" or "no">
-'''.strip())
+    user_messages.append(make_user_message(fitted['history']))
     
     # call vision API
     base64_image = None
@@ -80,20 +97,20 @@ def get_base64_image(prompt_recorder):
     image_path_state = os.path.join(agent_config.agent_output_dir, "states", f"screen_{prompt_recorder.state_tag}.png")
     try:
         if os.path.exists(image_path_state):
-            return encode_image(image_path=image_path_state)
+            return encode_image(image_path_state, prompt_recorder.state_tag)
         elif os.path.exists(image_path_temp):
-            return encode_image(image_path=image_path_temp)
+            return encode_image(image_path_temp, prompt_recorder.state_tag)
         elif os.path.exists(decrease_time_by_one_second(image_path_temp)):
-            print("Test: " + decrease_time_by_one_second(image_path_temp))
-            return encode_image(decrease_time_by_one_second(image_path_temp))
+            # the screenshot was taken in the second before the state tag
+            logger.debug(f'Using screenshot {decrease_time_by_one_second(image_path_temp)}')
+            return encode_image(decrease_time_by_one_second(image_path_temp), prompt_recorder.state_tag)
         else:
-            raise Exception(f"invalid {image_path_temp} and {image_path_state} and {encode_image(decrease_time_by_one_second(image_path_temp))}")
+            raise Exception(f"invalid {image_path_temp} and {image_path_state} and {decrease_time_by_one_second(image_path_temp)}")
     except FileNotFoundError:
         raise Exception(f"failed to encode image {image_path_temp} and {image_path_state}")
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+def encode_image(image_path, state_tag=None):
+    return ImageEncoder.encode(image_path, detail=VISION_DETAIL, cache_key=state_tag)
 
 def decrease_time_by_one_second(string):
     # Split the string into prefix, time part, and extension
@@ -0,0 +1,205 @@
+import os
+import json
+import hashlib
+import threading
+
+from collections import OrderedDict, defaultdict
+
+from .utils.logger import Logger
+
+CACHE_MODE_PASSTHROUGH = "passthrough"
+CACHE_MODE_RECORD = "record"
+CACHE_MODE_REPLAY = "replay"
+CACHE_MODES = [CACHE_MODE_PASSTHROUGH, CACHE_MODE_RECORD, CACHE_MODE_REPLAY]
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "testflow", "llm_responses"
+)
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# request fields that determine the response (timeouts and transport options do not)
+KEY_FIELDS = ["model", "messages", "tools", "tool_choice", "temperature", "max_tokens"]
+
+logger = Logger(__name__)
+
+
+class CacheMissError(Exception):
+    pass
+
+
+def _normalize(value):
+    """
+    Canonicalize a request value for hashing: strip surrounding whitespace of texts and
+    replace inline base64 images with the hash of their payload
+    """
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, str):
+        if value.startswith("data:image/") and ";base64," in value:
+            payload = value.split(";base64,", 1)[1]
+            return f"image-sha256:{hashlib.sha256(payload.encode('ascii')).hexdigest()}"
+        return value.strip()
+    return value
+
+
+def request_digest(request):
+    """
+    :param request: dict, keyword arguments for `chat.completions.create` (or the request body)
+    :return: str, sha256 of the fields that determine the response
+    """
+    content = {field: _normalize(request.get(field)) for field in KEY_FIELDS}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of LLM responses
+    - passthrough: the cache is not used at all
+    - record: cached responses are served, and every live response is stored
+    - replay: only cached responses are served; a miss raises CacheMissError
+    Identical requests issued several times in one run are keyed by their occurrence, so a
+    replayed run receives the same sequence of answers as the recorded one.
+    """
+
+    mode = os.environ.get("TESTFLOW_LLM_CACHE_MODE", CACHE_MODE_PASSTHROUGH)
+    cache_dir = os.environ.get("TESTFLOW_LLM_CACHE_DIR", DEFAULT_CACHE_DIR)
+    max_bytes = int(os.environ.get("TESTFLOW_LLM_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+    hits = 0
+    misses = 0
+
+    _lock = threading.Lock()
+    _index = None  # key -> file size, in LRU order (oldest first)
+    _total_bytes = 0
+    _occurrences = defaultdict(int)
+
+    @classmethod
+    def configure(cls, mode=CACHE_MODE_PASSTHROUGH, cache_dir=None, max_bytes=None):
+        assert mode in CACHE_MODES, f"Unsupported LLM cache mode: {mode}"
+        with cls._lock:
+            cls.mode = mode
+            if cache_dir is not None:
+                cls.cache_dir = cache_dir
+            if max_bytes is not None:
+                cls.max_bytes = max_bytes
+            cls._index = None
+            cls._total_bytes = 0
+            cls._occurrences = defaultdict(int)
+
+    @classmethod
+    def enabled(cls):
+        return cls.mode != CACHE_MODE_PASSTHROUGH
+
+    @classmethod
+    def make_key(cls, request):
+        """
+        :param request: dict, keyword arguments for `chat.completions.create`
+        :return: str, the cache key, or None if the cache is disabled
+        """
+        if not cls.enabled():
+            return None
+
+        digest = request_digest(request)
+        with cls._lock:
+            occurrence = cls._occurrences[digest]
+            cls._occurrences[digest] += 1
+
+        return f"{digest}_{occurrence}"
+
+    @classmethod
+    def _path(cls, key):
+        return os.path.join(cls.cache_dir, key[:2], f"{key}.json")
+
+    @classmethod
+    def _load_index(cls):
+        if cls._index is not None:
+            return
+
+        entries = []
+        if os.path.isdir(cls.cache_dir):
+            for subdir in os.listdir(cls.cache_dir):
+                subdir_path = os.path.join(cls.cache_dir, subdir)
+                if not os.path.isdir(subdir_path):
+                    continue
+                for filename in os.listdir(subdir_path):
+                    if not filename.endswith(".json"):
+                        continue
+                    stat = os.stat(os.path.join(subdir_path, filename))
+                    entries.append((stat.st_mtime, filename[: -len(".json")], stat.st_size))
+
+        entries.sort()
+        cls._index = OrderedDict((key, size) for _, key, size in entries)
+        cls._total_bytes = sum(cls._index.values())
+
+    @classmethod
+    def get(cls, key):
+        """
+        :return: (bool, object), whether the key was found and the cached response
+        """
+        if key is None:
+            return False, None
+
+        with cls._lock:
+            cls._load_index()
+            if key not in cls._index:
+                cls.misses += 1
+                if cls.mode == CACHE_MODE_REPLAY:
+                    raise CacheMissError(
+                        f"No recorded LLM response for {key} in {cls.cache_dir}"
+                    )
+                return False, None
+
+            path = cls._path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    record = json.load(f)
+            except (OSError, json.decoder.JSONDecodeError):
+                cls._total_bytes -= cls._index.pop(key)
+                cls.misses += 1
+                return False, None
+
+            cls._index.move_to_end(key)
+            os.utime(path)
+            cls.hits += 1
+
+        logger.debug(f"LLM response cache hit: {key}")
+        return True, record["response"]
+
+    @classmethod
+    def put(cls, key, response, model=None):
+        if key is None or cls.mode != CACHE_MODE_RECORD:
+            return
+
+        path = cls._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(
+            {"model": model, "response": response}, ensure_ascii=False
+        ).encode("utf-8")
+
+        with cls._lock:
+            cls._load_index()
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            if key in cls._index:
+                cls._total_bytes -= cls._index.pop(key)
+            cls._index[key] = len(data)
+            cls._total_bytes += len(data)
+
+            cls._evict()
+
+    @classmethod
+    def _evict(cls):
+        while cls._total_bytes > cls.max_bytes and len(cls._index) > 1:
+            key, size = cls._index.popitem(last=False)
+            cls._total_bytes -= size
+            try:
+                os.remove(cls._path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,116 @@
+import threading
+
+from .config import agent_config
+from .model import get_next_assistant_message, MAX_TOKENS
+from .utils.logger import Logger
+
+TIER_LOW = "low"  # short, well-specified answers that a cheaper model handles most of the time
+TIER_HIGH = "high"  # always answered by the configured model
+
+# hedges that signal the cheaper model was unsure, so the stronger model should answer instead
+LOW_CONFIDENCE_PHRASES = [
+    "not sure",
+    "unclear",
+    "cannot determine",
+    "can't determine",
+    "unable to determine",
+    "not possible to determine",
+    "i don't know",
+]
+
+logger = Logger(__name__)
+
+
+def is_confident(answer, phrases=LOW_CONFIDENCE_PHRASES):
+    """
+    :param phrases: list of str, the hedges that make an answer of the route unsure (lowercase)
+    """
+    if not isinstance(answer, str):
+        return True
+    answer = answer.lower()
+    return not any(phrase in answer for phrase in phrases)
+
+
+class ModelRouter:
+    """
+    Cascade routing: prompts of the low tier are first answered by the cheaper model and only
+    escalated to the configured model when the answer cannot be parsed or looks unsure.
+    Escalation rates are kept per route to check whether the cheaper model is good enough.
+    """
+
+    _lock = threading.Lock()
+    stats = {}  # route -> {"calls": int, "escalations": int}
+
+    @classmethod
+    def models_for(cls, tier, model):
+        if (
+            tier == TIER_LOW
+            and agent_config.model_cascade
+            and agent_config.cascade_model is not None
+            and agent_config.cascade_model != model
+        ):
+            return [agent_config.cascade_model, model]
+        return [model]
+
+    @classmethod
+    def record(cls, route, escalated):
+        with cls._lock:
+            if route not in cls.stats:
+                cls.stats[route] = {"calls": 0, "escalations": 0}
+            cls.stats[route]["calls"] += 1
+            if escalated:
+                cls.stats[route]["escalations"] += 1
+
+    @classmethod
+    def escalation_summary(cls):
+        with cls._lock:
+            return {
+                route: {
+                    **stat,
+                    "escalation_rate": stat["escalations"] / stat["calls"],
+                }
+                for route, stat in cls.stats.items()
+                if stat["calls"] > 0
+            }
+
+
+def get_routed_assistant_message(
+    tier,
+    route,
+    accept,
+    system_message,
+    user_messages,
+    assistant_messages=[],
+    functions=[],
+    model=None,
+    max_tokens=MAX_TOKENS,
+    function_call_option=None,
+):
+    """
+    Like `get_next_assistant_message`, but tries the models of the tier's cascade in order
+    :param route: str, name under which escalations are counted
+    :param accept: function, whether an answer can be used as-is (parsable and confident)
+    :param model: str, the configured model of the prompt (the last step of the cascade)
+    :return: str or dict, the first accepted answer, or the answer of the configured model
+    """
+    models = ModelRouter.models_for(tier, model)
+
+    answer = None
+    for i, candidate in enumerate(models):
+        answer = get_next_assistant_message(
+            system_message,
+            user_messages,
+            assistant_messages,
+            functions=functions,
+            model=candidate,
+            max_tokens=max_tokens,
+            function_call_option=function_call_option,
+        )
+        if i == len(models) - 1 or accept(answer):
+            break
+        logger.info(f"Escalating {route} from {candidate} to {models[i + 1]}")
+
+    if len(models) > 1:
+        ModelRouter.record(route, escalated=candidate != models[0])
+
+    return answer
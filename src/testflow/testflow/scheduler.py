@@ -0,0 +1,234 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import email.utils
+
+from .metrics import MetricsRegistry
+from .utils.logger import Logger
+from .utils.token_budget import count_message_tokens
+
+# (requests per minute, tokens per minute) for a single API key
+DEFAULT_RATE_LIMITS = {
+    "gpt-4o": (500, 30000),
+    "gpt-4o-mini": (500, 200000),
+    "gpt-4-turbo": (500, 30000),
+    "gpt-4-turbo-2024-04-09": (500, 30000),
+    "gpt-3.5-turbo-0125": (3500, 60000),
+}
+DEFAULT_RATE_LIMIT = (
+    int(os.environ.get("TESTFLOW_RPM_LIMIT", 500)),
+    int(os.environ.get("TESTFLOW_TPM_LIMIT", 30000)),
+)
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("TESTFLOW_MAX_CONCURRENT_REQUESTS", 8))
+
+BASE_BACKOFF = 1
+MAX_BACKOFF = 60
+LOW_DETAIL_IMAGE_TOKENS = 85
+HIGH_DETAIL_IMAGE_TOKENS = 765
+
+logger = Logger(__name__)
+
+
+def estimate_request_tokens(request):
+    """
+    Rough number of tokens a request consumes from the tokens-per-minute budget
+    (prompt tokens plus the completion tokens that can be generated)
+    """
+    prompt_tokens = 0
+    for message in request["messages"]:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                detail = part["image_url"].get("detail", "auto")
+                prompt_tokens += (
+                    LOW_DETAIL_IMAGE_TOKENS
+                    if detail == "low"
+                    else HIGH_DETAIL_IMAGE_TOKENS
+                )
+
+    prompt_tokens += count_message_tokens(request["messages"], request["model"])
+    return prompt_tokens + request.get("max_tokens", 0)
+
+
+def parse_retry_after(error):
+    """
+    Extract the server's retry hint (in seconds) from an OpenAI API error, if any
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+
+    headers = response.headers
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0, retry_date.timestamp() - time.time())
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self, amount, now):
+        """
+        Take `amount` from the bucket, possibly going into debt
+        :return: float, seconds to wait until the reservation is covered
+        """
+        self.level = min(
+            self.capacity, self.level + (now - self.updated_at) * self.refill_per_second
+        )
+        self.updated_at = now
+
+        # a request larger than the whole bucket would never fit otherwise
+        self.level -= min(amount, self.capacity)
+        if self.level >= 0:
+            return 0
+        return -self.level / self.refill_per_second
+
+
+class ModelRateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self.paused_until = 0
+
+    def reserve(self, tokens):
+        now = time.monotonic()
+        return max(
+            self.requests.reserve(1, now),
+            self.tokens.reserve(tokens, now),
+            self.paused_until - now,
+        )
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestScheduler:
+    """
+    Process-wide admission control for LLM requests: a global concurrency limit, per-model
+    request/token buckets, and exponential backoff with jitter that honors server retry hints.
+    A rate-limit error pauses the whole model, so concurrent agents back off together
+    instead of piling more requests onto the same key.
+    """
+
+    rate_limits = dict(DEFAULT_RATE_LIMITS)
+
+    _lock = threading.Lock()
+    _limiters = {}
+    _slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+    @classmethod
+    def set_rate_limit(cls, model, requests_per_minute, tokens_per_minute):
+        with cls._lock:
+            cls.rate_limits[model] = (requests_per_minute, tokens_per_minute)
+            cls._limiters.pop(model, None)
+
+    @classmethod
+    def set_max_concurrency(cls, max_concurrent_requests):
+        # requests in flight keep (and release) the semaphore they were admitted by
+        cls._slots = threading.BoundedSemaphore(max_concurrent_requests)
+
+    @classmethod
+    def _limiter_for(cls, model):
+        # the caller holds cls._lock
+        if model not in cls._limiters:
+            cls._limiters[model] = ModelRateLimiter(
+                *cls.rate_limits.get(model, DEFAULT_RATE_LIMIT)
+            )
+        return cls._limiters[model]
+
+    @classmethod
+    def _reserve(cls, model, tokens):
+        with cls._lock:
+            return cls._limiter_for(model).reserve(tokens)
+
+    @classmethod
+    def acquire(cls, model, tokens):
+        """
+        Block until a request of `tokens` tokens may be sent to `model`.
+        Must be paired with `release` once the request is finished.
+        :return: the concurrency slot taken, to be passed to `release`
+        """
+        start_time = time.monotonic()
+        slots = cls._slots
+        slots.acquire()
+        try:
+            delay = cls._reserve(model, tokens)
+            if delay > 0:
+                time.sleep(delay)
+        except BaseException:
+            slots.release()
+            raise
+        MetricsRegistry.record_queue_wait(model, time.monotonic() - start_time)
+        return slots
+
+    @classmethod
+    async def aacquire(cls, model, tokens):
+        start_time = time.monotonic()
+        slots = cls._slots
+        # wait in a worker thread: the semaphore is shared with the synchronous path, and the event loop keeps running
+        acquiring = asyncio.get_running_loop().run_in_executor(None, slots.acquire)
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # the worker still takes the slot once it is free, so give it back then
+            acquiring.add_done_callback(lambda _: slots.release())
+            raise
+        try:
+            delay = cls._reserve(model, tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            slots.release()
+            raise
+        MetricsRegistry.record_queue_wait(model, time.monotonic() - start_time)
+        return slots
+
+    @classmethod
+    def release(cls, slots):
+        """
+        :param slots: the slot returned by `acquire`/`aacquire`, even if the concurrency limit changed since
+        """
+        slots.release()
+
+    @classmethod
+    def backoff(cls, model, attempt, error=None):
+        """
+        :return: float, seconds to wait before retrying a failed request
+        """
+        retry_after = parse_retry_after(error) if error is not None else None
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, BASE_BACKOFF)
+        else:
+            delay = random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2**attempt))
+
+        if getattr(error, "status_code", None) == 429:
+            # pause even a model that has no limiter yet, so that its other in-flight requests back off too
+            with cls._lock:
+                cls._limiter_for(model).pause(delay)
+
+        return delay
+
@@ -0,0 +1,126 @@
+import os
+import sys
+import glob
+import json
+import argparse
+
+from .types.gui_state import GUIState
+from .types.screen_encoders import SCREEN_ENCODERS, JSON_ENCODER
+from .utils.token_budget import count_tokens
+
+DEFAULT_MODEL = "gpt-4o"
+
+
+class SavedState:
+    """
+    A DroidBot state loaded from `states/state_<tag>.json`, with the view tree rebuilt from the view list
+    (the fields GUIState.from_droidbot_state reads)
+    """
+
+    def __init__(self, state_dict):
+        self.tag = state_dict["tag"]
+        self.foreground_activity = state_dict["foreground_activity"]
+        self.activity_stack = state_dict.get("activity_stack", [])
+        self.width = state_dict.get("width")
+        self.height = state_dict.get("height")
+        self.views = state_dict["views"]
+        self.view_tree = self._assemble_view_tree(self.views)
+
+    @staticmethod
+    def _assemble_view_tree(views):
+        if len(views) == 0:
+            return {}
+
+        nodes = [dict(view) for view in views]
+        for node in nodes:
+            node["children"] = [nodes[i] for i in node.get("children", [])]
+        return nodes[0]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls(json.load(f))
+
+
+def find_state_files(paths):
+    """
+    :param paths: list of str, state files or directories searched recursively for `states/state_*.json`
+    """
+    state_files = []
+    for path in paths:
+        if os.path.isfile(path):
+            state_files.append(path)
+        else:
+            state_files.extend(
+                glob.glob(os.path.join(path, "**", "state_*.json"), recursive=True)
+            )
+    return sorted(set(state_files))
+
+
+def token_report(state_files, encoders=None, model=DEFAULT_MODEL, show_id=True):
+    """
+    :return: dict, encoder -> {"states", "total_tokens", "mean_tokens", "max_tokens", "ratio_to_json"}
+    """
+    encoders = encoders or sorted(GUIState.screen_encoders)
+    token_counts = {encoder: [] for encoder in encoders}
+
+    previous_state = None
+    for state_file in state_files:
+        try:
+            gui_state = GUIState().from_droidbot_state(
+                SavedState.load(state_file), previous_state=previous_state
+            )
+        except (KeyError, IndexError, ValueError) as e:
+            print(f"Skipping {state_file}: {e!r}", file=sys.stderr)
+            continue
+        previous_state = gui_state
+
+        for encoder in encoders:
+            description = gui_state.describe_screen(
+                token_limit=None, show_id=show_id, encoder=encoder
+            )
+            token_counts[encoder].append(count_tokens(description, model=model))
+
+    json_total = sum(token_counts.get(JSON_ENCODER, []))
+    report = {}
+    for encoder, counts in token_counts.items():
+        total = sum(counts)
+        report[encoder] = {
+            "states": len(counts),
+            "total_tokens": total,
+            "mean_tokens": total / len(counts) if len(counts) > 0 else 0.0,
+            "max_tokens": max(counts) if len(counts) > 0 else 0,
+            "ratio_to_json": total / json_total if json_total > 0 else None,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Count the prompt tokens each screen encoder spends on saved DroidBot states"
+    )
+    parser.add_argument("paths", nargs="+", help="state_*.json files or result directories")
+    parser.add_argument("--encoders", type=str, nargs="*", default=None, help=f"encoders to compare (default: all of {', '.join(sorted(SCREEN_ENCODERS))})")
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL, help="model whose tokenizer is used")
+    parser.add_argument("--no_id", action="store_true", help="omit widget IDs, as the critique prompt does")
+    parser.add_argument("--output", type=str, default=None, help="also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    state_files = find_state_files(args.paths)
+    if len(state_files) == 0:
+        sys.exit(f"No state_*.json files found in {', '.join(args.paths)}")
+
+    report = token_report(
+        state_files, encoders=args.encoders, model=args.model, show_id=not args.no_id
+    )
+
+    print(f"{'encoder':<10} {'states':>7} {'total':>10} {'mean':>9} {'max':>7} {'vs json':>8}")
+    for encoder, row in sorted(report.items(), key=lambda item: item[1]["total_tokens"]):
+        ratio = f"{row['ratio_to_json']:.2f}" if row["ratio_to_json"] is not None else "-"
+        print(
+            f"{encoder:<10} {row['states']:>7} {row['total_tokens']:>10} {row['mean_tokens']:>9.1f} {row['max_tokens']:>7} {ratio:>8}"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
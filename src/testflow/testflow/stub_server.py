@@ -0,0 +1,362 @@
+import os
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import itertools
+
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .response_cache import request_digest
+from .utils.token_budget import count_message_tokens, count_tokens
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_TEXT = "OK"
+LATENCY_DISTRIBUTIONS = ["constant", "uniform", "normal", "lognormal"]
+
+
+def parse_latency(spec):
+    """
+    :param spec: str, '<distribution>:<params>', e.g. 'constant:0.5', 'uniform:0.2,1.5',
+                 'normal:0.8,0.2' or 'lognormal:-0.5,0.4' (seconds)
+    :return: function that samples a latency in seconds
+    """
+    name, _, params = spec.partition(":")
+    assert name in LATENCY_DISTRIBUTIONS, f"Unsupported latency distribution: {name}"
+    params = [float(p) for p in params.split(",") if p.strip() != ""]
+
+    if name == "constant":
+        return lambda: params[0] if len(params) > 0 else 0
+    if name == "uniform":
+        return lambda: random.uniform(params[0], params[1])
+    if name == "normal":
+        return lambda: max(0, random.gauss(params[0], params[1]))
+    return lambda: random.lognormvariate(params[0], params[1])
+
+
+def _prompt_text(messages):
+    texts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            texts.extend(part.get("text", "") for part in content)
+        elif content is not None:
+            texts.append(content)
+    return "\n".join(texts)
+
+
+def _example_value(schema):
+    """
+    Smallest value that satisfies a JSON schema of a tool parameter
+    """
+    if "enum" in schema:
+        return schema["enum"][0]
+    schema_type = schema.get("type", "string")
+    if schema_type == "object":
+        return {
+            name: _example_value(schema["properties"][name])
+            for name in schema.get("required", [])
+        }
+    if schema_type == "array":
+        return []
+    if schema_type in ["integer", "number"]:
+        return 0
+    if schema_type == "boolean":
+        return False
+    return ""
+
+
+class ScriptedResponses:
+    """
+    Scripted answers, loaded from a JSONL file whose lines look like
+        {"match": "<regex on the prompt text>", "content": "..."}
+        {"match": "<regex>", "tool_call": {"name": "...", "arguments": {...}}}
+    The first entry whose `match` (optional) finds the prompt and whose tool (if any) is offered
+    by the request is served.
+    """
+
+    def __init__(self, path=None):
+        self.entries = []
+        if path is None:
+            return
+
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                entry = json.loads(line)
+                if "match" in entry:
+                    entry["pattern"] = re.compile(entry["match"], re.DOTALL)
+                self.entries.append(entry)
+
+    def find(self, request):
+        prompt_text = _prompt_text(request["messages"])
+        tool_names = [tool["function"]["name"] for tool in request.get("tools") or []]
+
+        for entry in self.entries:
+            if "pattern" in entry and entry["pattern"].search(prompt_text) is None:
+                continue
+            if "tool_call" in entry and entry["tool_call"]["name"] not in tool_names:
+                continue
+            if "tool_call" in entry:
+                return entry["tool_call"]
+            return entry.get("content", DEFAULT_TEXT)
+
+        return None
+
+
+class RecordedResponses:
+    """
+    Responses recorded by `ResponseCache` in record mode, replayed in the order they were recorded
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._occurrences = defaultdict(int)
+
+    def find(self, request):
+        if self.cache_dir is None:
+            return None
+
+        digest = request_digest(request)
+        with self._lock:
+            occurrence = self._occurrences[digest]
+            self._occurrences[digest] += 1
+
+        # a request issued more often than during recording gets the last recorded answer
+        for n in range(occurrence, -1, -1):
+            path = os.path.join(self.cache_dir, digest[:2], f"{digest}_{n}.json")
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    return json.load(f)["response"]
+
+        return None
+
+
+class StubLLMServer:
+    """
+    Local stand-in for the OpenAI chat-completions endpoint (text, tools and vision requests).
+    Answers come from recorded responses, then scripted responses, then a synthesized default
+    (a call of the requested tool with minimal arguments, or a fixed text), after a latency
+    drawn from the configured distribution. Point the agent at it with `use()` or by setting
+    `OPENAI_BASE_URL` to `base_url`.
+    """
+
+    def __init__(
+        self,
+        host=DEFAULT_HOST,
+        port=DEFAULT_PORT,
+        script=None,
+        recordings_dir=None,
+        latency="constant:0",
+        error_rate=0.0,
+        default_text=DEFAULT_TEXT,
+    ):
+        self.script = ScriptedResponses(script)
+        self.recordings = RecordedResponses(recordings_dir)
+        self.sample_latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.default_text = default_text
+
+        self.request_count = 0
+        self.error_count = 0
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def use(self):
+        """
+        Route the agent's LLM calls to this server
+        """
+        from .transport import LLMTransport
+
+        LLMTransport.configure(base_url=self.base_url, api_key="stub")
+        return self
+
+    def answer(self, request):
+        """
+        :return: str or dict, the assistant text or a tool call {name, arguments}
+        """
+        recorded = self.recordings.find(request)
+        if recorded is not None:
+            if isinstance(recorded, dict):
+                return recorded["function"]
+            return recorded
+
+        scripted = self.script.find(request)
+        if scripted is not None:
+            return scripted
+
+        tools = request.get("tools") or []
+        if len(tools) == 0 or request.get("tool_choice") == "none":
+            return self.default_text
+
+        tool = tools[0]["function"]
+        tool_choice = request.get("tool_choice")
+        if isinstance(tool_choice, dict):
+            tool = next(
+                t["function"]
+                for t in tools
+                if t["function"]["name"] == tool_choice["function"]["name"]
+            )
+        return {
+            "name": tool["name"],
+            "arguments": _example_value(tool.get("parameters", {"type": "object"})),
+        }
+
+    def make_completion(self, request):
+        model = request.get("model", "stub")
+        answer = self.answer(request)
+        response_id = next(self._ids)
+
+        if isinstance(answer, dict):
+            arguments = answer["arguments"]
+            if not isinstance(arguments, str):
+                arguments = json.dumps(arguments)
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_stub_{response_id}",
+                        "type": "function",
+                        "function": {"name": answer["name"], "arguments": arguments},
+                    }
+                ],
+            }
+            finish_reason = "tool_calls"
+            completion_tokens = count_tokens(answer["name"] + arguments, model)
+        else:
+            message = {"role": "assistant", "content": answer}
+            finish_reason = "stop"
+            completion_tokens = count_tokens(answer, model)
+
+        prompt_tokens = count_message_tokens(request["messages"], model)
+        return {
+            "id": f"chatcmpl-stub-{response_id}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {"index": 0, "message": message, "finish_reason": finish_reason}
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real endpoint
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, body, headers=None):
+                headers = headers or {}
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/models"):
+                    self._send_json(
+                        200, {"object": "list", "data": [{"id": "stub", "object": "model"}]}
+                    )
+                else:
+                    self._send_json(404, {"error": {"message": "Not found"}})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": "Not found"}})
+                    return
+
+                with server._lock:
+                    server.request_count += 1
+
+                time.sleep(server.sample_latency())
+
+                if random.random() < server.error_rate:
+                    with server._lock:
+                        server.error_count += 1
+                    self._send_json(
+                        429,
+                        {"error": {"message": "Rate limit reached", "type": "requests"}},
+                        headers={"retry-after-ms": "200"},
+                    )
+                    return
+
+                try:
+                    completion = server.make_completion(json.loads(body))
+                except (KeyError, ValueError) as e:
+                    self._send_json(
+                        400, {"error": {"message": f"Invalid request: {e}"}}
+                    )
+                    return
+                self._send_json(200, completion)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve scripted or recorded LLM responses on an OpenAI-compatible endpoint"
+    )
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST, help="host to bind")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to bind")
+    parser.add_argument("--script", type=str, default=None, help="JSONL file of scripted responses")
+    parser.add_argument("--recordings_dir", type=str, default=None, help="directory of responses recorded with TESTFLOW_LLM_CACHE_MODE=record")
+    parser.add_argument("--latency", type=str, default="constant:0", help="latency distribution, e.g. lognormal:-0.5,0.4")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests answered with a 429 error")
+    args = parser.parse_args()
+
+    server = StubLLMServer(
+        host=args.host,
+        port=args.port,
+        script=args.script,
+        recordings_dir=args.recordings_dir,
+        latency=args.latency,
+        error_rate=args.error_rate,
+    )
+    print(f"export OPENAI_BASE_URL={server.base_url} OPENAI_API_KEY=stub")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
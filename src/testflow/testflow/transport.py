@@ -0,0 +1,92 @@
+import os
+import asyncio
+import weakref
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+KEEPALIVE_EXPIRY = 120
+CONNECT_TIMEOUT = 10
+REQUEST_TIMEOUT = 60
+
+
+class LLMTransport:
+    """
+    Process-wide OpenAI clients shared by the text and vision paths.
+    Every request goes through a pooled keep-alive HTTP connection, so TLS is only negotiated
+    once per connection instead of once per call.
+    """
+
+    base_url = os.environ.get("OPENAI_BASE_URL", None)
+    api_key = None
+    max_connections = MAX_CONNECTIONS
+    max_keepalive_connections = MAX_KEEPALIVE_CONNECTIONS
+
+    _client = None
+    # httpx async connections are bound to the event loop that opened them
+    _async_clients = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def configure(
+        cls,
+        base_url=None,
+        api_key=None,
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+    ):
+        cls.close()
+        cls.base_url = base_url
+        cls.api_key = api_key
+        cls.max_connections = max_connections
+        cls.max_keepalive_connections = max_keepalive_connections
+
+    @classmethod
+    def _limits(cls):
+        return httpx.Limits(
+            max_connections=cls.max_connections,
+            max_keepalive_connections=cls.max_keepalive_connections,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+
+    @classmethod
+    def _timeout(cls):
+        return httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+    @classmethod
+    def client(cls):
+        if cls._client is None:
+            cls._client = OpenAI(
+                api_key=cls.api_key,
+                base_url=cls.base_url,
+                max_retries=0,  # retries are handled by the model layer
+                timeout=cls._timeout(),
+                http_client=httpx.Client(limits=cls._limits(), timeout=cls._timeout()),
+            )
+        return cls._client
+
+    @classmethod
+    def async_client(cls):
+        loop = asyncio.get_running_loop()
+        if loop not in cls._async_clients:
+            cls._async_clients[loop] = AsyncOpenAI(
+                api_key=cls.api_key,
+                base_url=cls.base_url,
+                max_retries=0,
+                timeout=cls._timeout(),
+                http_client=httpx.AsyncClient(
+                    limits=cls._limits(), timeout=cls._timeout()
+                ),
+            )
+        return cls._async_clients[loop]
+
+    @classmethod
+    def close(cls):
+        if cls._client is not None:
+            cls._client.close()
+            cls._client = None
+        cls._async_clients = weakref.WeakKeyDictionary()
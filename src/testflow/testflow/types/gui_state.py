@@ -1,29 +1,30 @@
 from ..config import agent_config
 from ..utils.activity_name_manager import ActivityNameManager
-from ..utils.stringutil import remove_quotes
 from ..utils.viewtreeutil import minimize_view_tree
 from ..utils.logger import Logger
+from ..utils.token_budget import count_tokens, truncate_to_tokens, TRIM_LINES_HEAD
 
 from .action import initialize_possible_actions, initialize_screen_scroll_action, initialize_go_back_action, initialize_enter_key_action
 from .widget import Widget
+from .state_diff import diff_states, render_state_diff
+from .screen_encoders import SCREEN_ENCODERS, get_screen_encoder
+from .screen_pruning import PrunableScreen
 
 from abc import ABC, abstractmethod
 from collections import defaultdict, OrderedDict
 from functools import cached_property
 
-import json
 import copy
-import difflib
 import logging
 
-CONTEXT_LENGTH_LIMIT = 15000
+CONTEXT_TOKEN_LIMIT = 4000
 
 logger = Logger(__name__)
 
 
 class GUIStateBase(ABC):
     @abstractmethod
-    def from_droidbot_state(self, droidbot_state):
+    def from_droidbot_state(self, droidbot_state, previous_state=None):
         pass
 
     @abstractmethod
@@ -56,6 +57,8 @@ class GUIStateBase(ABC):
 
 
 class GUIState(GUIStateBase):
+    screen_encoders = SCREEN_ENCODERS # name -> function(view hierarchy) -> str, see types/screen_encoders.py
+
     def __init__(self):
         self.tag = None
         self.activity = None
@@ -63,11 +66,16 @@ class GUIState(GUIStateBase):
         self.activity_stack = []
         self.possible_actions = []
         self.lost_messages = set()
+        self.subtree_index = {} # subtree key -> Widget
+        self._description_cache = {} # (method, arguments) -> description; widgets are immutable
+        self.widgets = []
+        self.build_indexes()
 
-    def from_droidbot_state(self, droidbot_state):
+    def from_droidbot_state(self, droidbot_state, previous_state=None):
         """
         Convert the view tree and view list from DroidBot to a GUI state
-        :param _view_tree: dict, the view tree from DroidBot
+        :param droidbot_state: DeviceState, the state fetched by DroidBot
+        :param previous_state: GUIState, a recent state whose unchanged subtrees (and their cached properties) are reused
         """
         self.droidbot_state = droidbot_state
         self.activity = ActivityNameManager.fix_activity_name(droidbot_state.foreground_activity)
@@ -75,12 +83,32 @@ class GUIState(GUIStateBase):
         self.tag = droidbot_state.tag
         view_tree = minimize_view_tree(droidbot_state.view_tree)
 
+        reusable_widgets = previous_state.subtree_index if previous_state is not None else None
+
         self.root_widgets = []
         self.widgets = []
+        self.subtree_index = {}
         for root_elem in view_tree:
-            self.root_widgets.append(traverse_widgets(root_elem, self.widgets, droidbot_state.views))
+            self.root_widgets.append(traverse_widgets(root_elem, self.widgets, droidbot_state.views, self.subtree_index, reusable_widgets))
+
+        self.build_indexes()
 
         return self
+
+    def build_indexes(self):
+        """
+        Hash indexes for widget lookups (the first widget wins on duplicate view IDs, as a scan would return)
+        """
+        self.widgets_by_id = {}
+        self.widgets_by_signature = defaultdict(list) # signature -> widgets in screen order (e.g., the rows of a list)
+        self.widgets_by_resource_id = defaultdict(list) # (activity, resource_id) -> widgets in screen order
+        for widget in self.widgets:
+            if widget.view_id is not None:
+                self.widgets_by_id.setdefault(widget.view_id, widget)
+            if widget.signature is not None:
+                self.widgets_by_signature[widget.signature].append(widget)
+            if widget.resource_id is not None:
+                self.widgets_by_resource_id[(self.activity, widget.resource_id)].append(widget)
     
     def get_app_activity_depth(self):
         package_name = agent_config.package_name
@@ -98,11 +126,7 @@ class GUIState(GUIStateBase):
         :param view_id: int, the view ID
         :return: Widget, the widget with the given view ID
         """
-        for widget in self.widgets:
-            if widget.view_id == view_id:
-                return widget
-        
-        return None
+        return self.widgets_by_id.get(view_id, None)
 
     def get_widget_by_signature(self, signature):
         """
@@ -110,21 +134,82 @@ class GUIState(GUIStateBase):
         :param signature: str, the signature
         :return: Widget, the widget with the given signature
         """
-        for widget in self.widgets:
-            if widget.signature == signature:
-                return widget
-        
-        return None
+        widgets = self.widgets_by_signature.get(signature)
+        return widgets[0] if widgets else None
+
+    def get_widgets_by_resource_id(self, resource_id, activity=None):
+        """
+        Get the widgets with the given resource ID
+        :param activity: str, the page the widgets should belong to (defaults to this state's page)
+        :return: list of Widget
+        """
+        return self.widgets_by_resource_id.get((activity or self.activity, resource_id), [])
 
     def __str__(self):
         return self.describe_screen()
 
-    def describe_screen_w_memory(self, memory, length_limit=CONTEXT_LENGTH_LIMIT, show_id=True, prompt_recorder=None, include_widget_knowledge=True):
+    def _truncate(self, description, token_limit):
+        """
+        Cut a description at a line boundary so that it fits in `token_limit` tokens
+        """
+        if not token_limit:
+            return description
+
+        token_count = count_tokens(description)
+        if token_count <= token_limit:
+            return description
+
+        logger.warning(f'Screen description is too long ({token_count} > {token_limit} tokens). Truncated. (state tag: {self.tag}))')
+        return truncate_to_tokens(description, token_limit, policy=TRIM_LINES_HEAD)
+
+    def encode_screen(self, view_hierarchy, encoder=None):
+        """
+        :param encoder: str, name of a registered screen encoder (defaults to the configured one)
+        """
+        return get_screen_encoder(encoder or agent_config.screen_encoder)(view_hierarchy)
+
+    def describe_screen_w_memory(self, memory, token_limit=CONTEXT_TOKEN_LIMIT, show_id=True, prompt_recorder=None, include_widget_knowledge=True, encoder=None, query=None):
         """
         From a given GUI state, creates a description of the GUI state including the list of interactable widgets and non-interactable widgets
+        If it exceeds `token_limit`, the least relevant widget subtrees are left out (see `prunable_screen_w_memory`)
+        :param encoder: str, name of the screen encoder to use (see `screen_encoders`)
+        """
+        screen = self.prunable_screen_w_memory(memory, show_id=show_id, prompt_recorder=prompt_recorder, include_widget_knowledge=include_widget_knowledge, encoder=encoder, query=query)
+        return screen.describe(token_limit)
+
+    def screen_bounds(self):
+        width = getattr(self.droidbot_state, 'width', None)
+        height = getattr(self.droidbot_state, 'height', None)
+        if not width or not height:
+            return None
+        return [[0, 0], [width, height]]
+
+    def prunable_screen_w_memory(self, memory, show_id=True, prompt_recorder=None, include_widget_knowledge=True, encoder=None, query=None):
+        """
+        :param query: str, text the kept widgets should be relevant to (defaults to the current task)
+        :return: PrunableScreen, whose `describe(token_limit)` ranks widgets by interactability, visibility,
+                 overlap with the query and past usefulness, and drops whole low-ranked subtrees to fit the limit
         """
-        def inject_widget_knowledge(widget, show_id):
-            widget_info = widget.to_dict(include_id=show_id)
+        if query is None and memory.working_memory.task is not None:
+            query = memory.working_memory.task.summary
+
+        screen = PrunableScreen(
+            view_hierarchy={'page_name': self.activity, 'children': []},
+            encode=lambda view_hierarchy: self.encode_screen(view_hierarchy, encoder),
+            screen_bounds=self.screen_bounds(),
+            query=query,
+            usefulness=lambda widget: 1.0 if memory.widget_knowledge.has_widget_knowledge(self.activity, widget.signature) else 0.0,
+        )
+
+        # fetch the knowledge of all widgets at once instead of one widget at a time while rendering
+        widget_knowledge = {}
+        if include_widget_knowledge:
+            widgets_w_knowledge = [w for w in self.widgets if len(w.possible_action_types) > 0 and memory.widget_knowledge.has_widget_knowledge(self.activity, w.signature)]
+            if len(widgets_w_knowledge) > 0:
+                widget_knowledge = memory.widget_knowledge.retrieve_widgets_knowledge(self, widgets_w_knowledge, prompt_recorder=prompt_recorder)
+
+        def inject_widget_knowledge(widget, show_id, parent_info=None):
+            widget_info = screen.add_widget(widget.to_dict(include_id=show_id), widget, parent_info)
 
             if ('Main' in self.activity or self.activity == agent_config.main_activity) and 'content_description' in widget_info:
                 # If "Navigate up" widget is in the main page, change its name to "Menu"
@@ -150,20 +235,14 @@ class GUIState(GUIStateBase):
 
                 widget_info['num_prev_actions'] = interaction_count
 
-                if include_widget_knowledge and memory.widget_knowledge.has_widget_knowledge(self.activity, widget.signature):
-                    widget_knowledge = memory.widget_knowledge.retrieve_widget_knowledge(
-                        self,
-                        widget, 
-                        prompt_recorder=prompt_recorder
-                    )
-                    if widget_knowledge is not None:
-                        widget_info['widget_role_inference'] = widget_knowledge
+                if widget_knowledge.get(widget.signature) is not None:
+                    widget_info['widget_role_inference'] = widget_knowledge[widget.signature]
 
             children_w_knowledge = []
 
             if not children_merged:
                 for child in widget.children:
-                    children_w_knowledge.append(inject_widget_knowledge(child, show_id))
+                    children_w_knowledge.append(inject_widget_knowledge(child, show_id, widget_info))
 
             if 'children' in widget_info:
                 del widget_info['children']
@@ -171,23 +250,21 @@ class GUIState(GUIStateBase):
                 widget_info['children'] = children_w_knowledge
             return widget_info
 
-        view_hierarchy = {
-            'page_name': self.activity,
-            'children': []
-        }
         for widget in self.root_widgets:
-            view_hierarchy['children'].append(inject_widget_knowledge(widget, show_id))
+            screen.view_hierarchy['children'].append(inject_widget_knowledge(widget, show_id))
 
-        screen_description = json.dumps(view_hierarchy, indent=2, ensure_ascii=False)
-
-        if length_limit and len(screen_description) > length_limit:
-            screen_description = screen_description[:length_limit] + '[...truncated...]'
-            logger.warning(f'Screen description is too long ({len(screen_description)} > {length_limit}). Truncated. (state tag: {self.tag}))')
-        
-        screen_description = remove_quotes(screen_description) # remove all quotes to reduce the number of tokens
-        return screen_description
+        return screen
     
-    def describe_screen(self, length_limit=CONTEXT_LENGTH_LIMIT, show_id=True):
+    def _cached_description(self, key, describe):
+        if key not in self._description_cache:
+            self._description_cache[key] = describe()
+        return self._description_cache[key]
+
+    def describe_screen(self, token_limit=CONTEXT_TOKEN_LIMIT, show_id=True, encoder=None):
+        encoder = encoder or agent_config.screen_encoder
+        return self._cached_description(('screen', token_limit, show_id, encoder), lambda: self._describe_screen(token_limit, show_id, encoder))
+
+    def _describe_screen(self, token_limit, show_id, encoder):
         view_hierarchy = {
             'page_name': self.activity,
             'children': []
@@ -196,16 +273,14 @@ class GUIState(GUIStateBase):
         for widget in self.root_widgets:
             view_hierarchy['children'].append(widget.to_dict(include_id=show_id))
 
-        screen_description = json.dumps(view_hierarchy, indent=2, ensure_ascii=False)
+        screen_description = self.encode_screen(view_hierarchy, encoder)
 
-        if length_limit and len(screen_description) > length_limit:
-            screen_description = screen_description[:length_limit] + '[...truncated...]'
-            logger.warning(f'Screen description is too long ({len(screen_description)} > {length_limit}). Truncated. (state tag: {self.tag}))')
+        return self._truncate(screen_description, token_limit)
 
-        screen_description = remove_quotes(screen_description) # remove all double quotes to reduce the number of tokens
-        return screen_description
+    def describe_widgets(self, token_limit=CONTEXT_TOKEN_LIMIT, show_id=True):
+        return self._cached_description(('widgets', token_limit, show_id), lambda: self._describe_widgets(token_limit))
 
-    def describe_widgets(self, length_limit=CONTEXT_LENGTH_LIMIT, show_id=True):
+    def _describe_widgets(self, token_limit):
         desc = ''
 
         for widget in self.widgets:
@@ -213,13 +288,12 @@ class GUIState(GUIStateBase):
         
         desc = desc.strip()
 
-        if length_limit and len(desc) > length_limit:
-            desc = desc[:length_limit] + '[...truncated...]'
-            logger.warning(f'Screen description is too long ({len(screen_description)} > {length_limit}). Truncated. (state tag: {self.tag}))')
-        
-        return desc
+        return self._truncate(desc, token_limit)
 
-    def describe_widgets_NL(self, length_limit=CONTEXT_LENGTH_LIMIT):
+    def describe_widgets_NL(self, token_limit=CONTEXT_TOKEN_LIMIT):
+        return self._cached_description(('widgets_NL', token_limit), lambda: self._describe_widgets_NL(token_limit))
+
+    def _describe_widgets_NL(self, token_limit):
         desc = ''
 
         for widget in self.widgets:
@@ -227,59 +301,46 @@ class GUIState(GUIStateBase):
         
         desc = desc.strip()
 
-        if length_limit and len(desc) > length_limit:
-            desc = desc[:length_limit] + '[...truncated...]'
-            logger.warning(f'Screen description is too long ({len(desc)} > {length_limit}). Truncated. (state tag: {self.tag}))')
-        
-        return desc
+        return self._truncate(desc, token_limit)
 
     def diff(self, other):
         """
         Calculate the difference between two GUI states
         """
-        diff = difflib.ndiff(self.describe_widgets().splitlines(keepends=True), other.describe_widgets().splitlines(keepends=True))
-        return ''.join(diff)
+        return render_state_diff(diff_states(self, other), describe=lambda w: w.dump(indent=None))
 
     def diff_widgets(self, other):
+        """
+        Compare the widgets of two states; widgets sharing a signature (e.g., the rows of a list) are matched in screen order
+        :return: (list of (new widget, change), list of appeared widgets, list of disappeared widgets)
+        """
         changed_widgets = []
         appeared_widgets = []
         disappeared_widgets = []
 
-        old_widgets = {}
-        new_widgets = {}
+        for key, new_ws in other.widgets_by_signature.items():
+            old_ws = self.widgets_by_signature.get(key, [])
+            appeared_widgets.extend(new_ws[len(old_ws):])
 
-        for w in self.widgets:
-            if w.signature is None:
-                continue
-            key = w.signature
-            old_widgets[key] = w
-
-        for w in other.widgets:
-            if w.signature is None:
-                continue
-            key = w.signature
-            new_widgets[key] = w
-
-            if key not in old_widgets:
-                appeared_widgets.append(w)
-            else:
-                old_w = old_widgets[key]
-                if old_w.elem_dict.get('state', []) != w.elem_dict.get('state', []):
+            for old_w, w in zip(old_ws, new_ws):
+                if old_w.state != w.state:
                     changed_widgets.append((w, {
-                        'old_state': old_w.elem_dict.get('state', []),
-                        'new_state': w.elem_dict.get('state', [])
+                        'old_state': old_w.state,
+                        'new_state': w.state
                     }))
                 elif old_w.elem_dict.get('text', '') != w.elem_dict.get('text', ''):
-                    old_text = old_w.elem_dict.get('text', '')
-                    new_text = w.elem_dict.get('text', '')
                     changed_widgets.append((w, {
-                        'old_text': old_text,
-                        'new_text': new_text
+                        'old_text': old_w.elem_dict.get('text', ''),
+                        'new_text': w.elem_dict.get('text', '')
                     }))
-                    
-        for key in old_widgets:
-            if key not in new_widgets:
-                disappeared_widgets.append(old_widgets[key])
+
+        for key, old_ws in self.widgets_by_signature.items():
+            disappeared_widgets.extend(old_ws[len(other.widgets_by_signature.get(key, [])):])
+
+        # report widgets in screen order, as the old scans did
+        order = {id(w): i for i, w in enumerate(other.widgets)}
+        changed_widgets.sort(key=lambda change: order[id(change[0])])
+        appeared_widgets.sort(key=lambda w: order[id(w)])
 
         return changed_widgets, appeared_widgets, disappeared_widgets
 
@@ -312,10 +373,24 @@ class GUIState(GUIStateBase):
         return interactable_widget_ids
 
 
-def traverse_widgets(elem, processed_widgets, original_views):
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, _hashable(v)) for k, v in value.items())
+    return value
+
+
+def traverse_widgets(elem, processed_widgets, original_views, subtree_index=None, reusable_widgets=None):
     """
     Traverse all child widgets so that all required properties are included
+    Each subtree is keyed by the hash of its properties and of its children's keys; if the same subtree was
+    built for a previous state (`reusable_widgets`), that Widget is reused instead of being rebuilt
     """
+    children_widgets = []
+    for child in elem.get('children', []):
+        children_widgets.append(traverse_widgets(child, processed_widgets, original_views, subtree_index, reusable_widgets))
+
     new_elem = OrderedDict()
     possible_action_types = []
     state_properties = []
@@ -361,14 +436,18 @@ def traverse_widgets(elem, processed_widgets, original_views):
 
     new_elem['bounds'] = elem['bounds']
 
-    children_widgets = []
-    for child in elem.get('children', []):
-        children_widgets.append(traverse_widgets(child, processed_widgets, original_views))
-    
-    new_elem['children'] = children_widgets
+    subtree_key = hash((_hashable(new_elem), tuple(child.subtree_key for child in children_widgets)))
+
+    # reuse only if the children were reused as well, so that `processed_widgets` and the tree hold the same objects
+    widget = reusable_widgets.get(subtree_key) if reusable_widgets is not None else None
+    if widget is None or len(widget.children) != len(children_widgets) or any(a is not b for a, b in zip(widget.children, children_widgets)):
+        new_elem['children'] = children_widgets
+        widget = Widget().from_dict(new_elem)
+        widget.subtree_key = subtree_key
+
+    if subtree_index is not None:
+        subtree_index[subtree_key] = widget
 
-    widget = Widget().from_dict(new_elem)
-    
     processed_widgets.append(widget)
 
-    return widget
\ No newline at end of file
+    return widget
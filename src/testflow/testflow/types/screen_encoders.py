@@ -0,0 +1,119 @@
+"""
+Screen encoders turn a view hierarchy ({'page_name': str, 'children': [widget dict, ...]}, as built by
+GUIState.describe_screen*) into the text given to the model. They carry the same information and only
+differ in how many tokens they spend on syntax.
+"""
+
+import json
+
+from collections import namedtuple
+
+from ..utils.stringutil import remove_quotes
+
+JSON_ENCODER = 'json'
+OUTLINE_ENCODER = 'outline'
+TABLE_ENCODER = 'table'
+DEFAULT_SCREEN_ENCODER = JSON_ENCODER
+
+# properties written without a label, in this order; other properties follow as key=value
+HEADLINE_KEYS = ['ID', 'widget_type', 'text']
+TABLE_COLUMNS = ['depth', 'ID', 'widget_type', 'text', 'content_description', 'resource_id', 'state', 'possible_action_types', 'is_password', 'num_prev_actions', 'widget_role_inference']
+
+SCREEN_ENCODERS = {}
+SCREEN_FORMATS = {}
+
+# how prompts present an encoded screen: the language of its code fence, and what it is organized as
+# (completes "organized as a ...")
+ScreenFormat = namedtuple('ScreenFormat', ['fence', 'structure'])
+
+
+def register_screen_encoder(name, fence='text', structure='hierarchical structure'):
+    def register(encoder):
+        SCREEN_ENCODERS[name] = encoder
+        SCREEN_FORMATS[name] = ScreenFormat(fence, structure)
+        return encoder
+    return register
+
+
+def get_screen_encoder(name):
+    if name not in SCREEN_ENCODERS:
+        raise ValueError(f'Unknown screen encoder: {name} (available: {", ".join(sorted(SCREEN_ENCODERS))})')
+    return SCREEN_ENCODERS[name]
+
+
+def get_screen_format(name):
+    """
+    :return: ScreenFormat of a registered screen encoder
+    """
+    get_screen_encoder(name)
+    return SCREEN_FORMATS[name]
+
+
+def _format_value(value, separator=', '):
+    if isinstance(value, list):
+        return separator.join(_format_value(v) for v in value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).replace('\n', '[NEWLINE]')
+
+
+def _walk(widgets, depth=0):
+    """
+    :return: generator of (depth, widget dict without children) in pre-order
+    """
+    stack = [(widget, depth) for widget in reversed(widgets)]
+    while len(stack) > 0:
+        widget, depth = stack.pop()
+        yield depth, {k: v for k, v in widget.items() if k != 'children'}
+        for child in reversed(widget.get('children', [])):
+            stack.append((child, depth + 1))
+
+
+@register_screen_encoder(JSON_ENCODER, fence='json', structure='hierarchical structure')
+def encode_json(view_hierarchy):
+    """
+    Indented JSON without quotes (the original format)
+    """
+    return remove_quotes(json.dumps(view_hierarchy, indent=2, ensure_ascii=False))
+
+
+@register_screen_encoder(OUTLINE_ENCODER, fence='text', structure='nested outline with one widget per line')
+def encode_outline(view_hierarchy):
+    """
+    One line per widget, nested by indentation:
+    - [3] Button "Sign in" possible_action_types=touch num_prev_actions=1
+      - TextView "Forgot password?"
+    """
+    lines = [f'page_name: {view_hierarchy["page_name"]}']
+    for depth, widget in _walk(view_hierarchy['children']):
+        parts = []
+        if 'ID' in widget:
+            parts.append(f'[{widget["ID"]}]')
+        if 'widget_type' in widget:
+            parts.append(widget['widget_type'])
+        if 'text' in widget:
+            text = _format_value(widget['text'], separator=' | ').replace('"', "'")
+            parts.append(f'"{text}"')
+        for key, value in widget.items():
+            if key not in HEADLINE_KEYS:
+                parts.append(f'{key}={_format_value(value)}')
+        lines.append(f'{"  " * depth}- {" ".join(parts)}')
+    return '\n'.join(lines)
+
+
+@register_screen_encoder(TABLE_ENCODER, fence='text', structure='table with one widget per row, where the depth column gives the nesting')
+def encode_table(view_hierarchy):
+    """
+    One row per widget in pre-order, with a depth column for the hierarchy and only the columns used on this screen
+    """
+    rows = list(_walk(view_hierarchy['children']))
+    present_keys = set(key for _, widget in rows for key in widget)
+    columns = [c for c in TABLE_COLUMNS if c == 'depth' or c in present_keys]
+    columns += sorted(present_keys - set(columns))
+
+    lines = [f'page_name: {view_hierarchy["page_name"]}', '|'.join(columns)]
+    for depth, widget in rows:
+        widget = {**widget, 'depth': depth} # the widget dicts may be shared with the widgets' caches
+        cells = [_format_value(widget[c], separator=' / ').replace('|', '/') if c in widget else '' for c in columns]
+        lines.append('|'.join(cells))
+    return '\n'.join(lines)
@@ -0,0 +1,181 @@
+"""
+Fits a screen description into a token budget by dropping the least relevant widget subtrees,
+so that the result stays well-formed and keeps the widgets the agent is likely to act on
+"""
+
+import re
+
+from ..utils.token_budget import count_tokens, truncate_to_tokens, TRIM_LINES_HEAD
+
+RELEVANCE_WEIGHTS = {
+    'interactable': 1.0, # the widget has possible actions
+    'visible': 0.5, # fraction of the widget inside the screen
+    'task_overlap': 1.0, # share of the widget's words that appear in the current task
+    'usefulness': 0.5, # acting on the widget changed the app before (it has widget knowledge)
+}
+OMISSION_NOTE = '[{} less relevant widgets omitted]'
+STOP_WORDS = {'the', 'a', 'an', 'to', 'of', 'in', 'on', 'and', 'or', 'for', 'with', 'is', 'it', 'id', 'com', 'android', 'app'}
+
+
+def extract_terms(text):
+    """
+    :return: set of lowercase words of a text (resource IDs are split at '/', ':', '_' and '.')
+    """
+    if not text:
+        return set()
+    return set(w for w in re.split(r'[^0-9a-z]+', text.lower()) if len(w) > 1 and w not in STOP_WORDS)
+
+
+def visible_fraction(bounds, screen_bounds):
+    if bounds is None or screen_bounds is None:
+        return 1.0
+    (x1, y1), (x2, y2) = bounds
+    (sx1, sy1), (sx2, sy2) = screen_bounds
+    area = (x2 - x1) * (y2 - y1)
+    if area <= 0:
+        return 0.0
+    overlap = max(0, min(x2, sx2) - max(x1, sx1)) * max(0, min(y2, sy2) - max(y1, sy1))
+    return overlap / area
+
+
+class ScreenNode:
+    __slots__ = ['info', 'widget', 'parent', 'children', 'score', 'cost']
+
+    def __init__(self, info, widget, parent):
+        self.info = info
+        self.widget = widget
+        self.parent = parent
+        self.children = []
+        self.score = 0.0 # best relevance in the subtree
+        self.cost = 0 # estimated tokens of the subtree
+
+
+class PrunableScreen:
+    """
+    A view hierarchy ({'page_name': str, 'children': [widget dict, ...]}) together with the widget each
+    dict was built from, so that it can be described within a token limit
+    """
+    def __init__(self, view_hierarchy, encode, screen_bounds=None, query=None, usefulness=None):
+        """
+        :param encode: function(view hierarchy) -> str, the screen encoder
+        :param screen_bounds: [[x1, y1], [x2, y2]] of the device screen
+        :param query: str, the current task, to favor widgets mentioned in it
+        :param usefulness: function(Widget) -> float in [0, 1], from the agent's widget knowledge
+        """
+        self.view_hierarchy = view_hierarchy
+        self.encode = encode
+        self.screen_bounds = screen_bounds
+        self.query_terms = extract_terms(query)
+        self.usefulness = usefulness
+        self.roots = []
+        self._nodes = {} # id(widget dict) -> ScreenNode
+        self._empty_cost = None
+
+    def add_widget(self, info, widget, parent_info=None):
+        """
+        Register the widget a dict of the hierarchy was made from; parents must be added before their children
+        """
+        parent = self._nodes[id(parent_info)] if parent_info is not None else None
+        node = ScreenNode(info, widget, parent)
+        (parent.children if parent is not None else self.roots).append(node)
+        self._nodes[id(info)] = node
+        return info
+
+    def relevance(self, widget):
+        weights = RELEVANCE_WEIGHTS
+        score = weights['visible'] * visible_fraction(widget.bounds, self.screen_bounds)
+        if len(widget.possible_action_types) > 0:
+            score += weights['interactable']
+        if len(self.query_terms) > 0:
+            terms = extract_terms(widget.text) | extract_terms(widget.content_description) | extract_terms(widget.resource_id)
+            if len(terms) > 0:
+                score += weights['task_overlap'] * len(terms & self.query_terms) / len(terms)
+        if self.usefulness is not None:
+            score += weights['usefulness'] * self.usefulness(widget)
+        return score
+
+    def _own_cost(self, node):
+        own_info = {k: v for k, v in node.info.items() if k != 'children'}
+        return count_tokens(self.encode({'page_name': '', 'children': [own_info]})) - self._empty_cost
+
+    def _score(self, nodes):
+        for node in nodes:
+            self._score(node.children)
+            node.score = max([self.relevance(node.widget)] + [child.score for child in node.children])
+            node.cost = max(1, self._own_cost(node)) + sum(child.cost for child in node.children)
+
+    def _filtered(self, info, dropped):
+        if 'children' not in info:
+            return info
+        children = [self._filtered(child, dropped) for child in info['children'] if id(child) not in dropped]
+        info = {k: v for k, v in info.items() if k != 'children'}
+        if len(children) > 0:
+            info['children'] = children
+        return info
+
+    def describe(self, token_limit=None):
+        """
+        :param token_limit: int, maximum number of tokens of the description (no limit if None)
+        :return: str, the encoded screen; if it is too long, the lowest-ranked subtrees are left out
+        """
+        description = self.encode(self.view_hierarchy)
+        if token_limit is None:
+            return description
+
+        token_count = count_tokens(description)
+        if token_count <= token_limit:
+            return description
+        if token_limit <= 0: # e.g., a prompt budget that has no tokens left for the screen
+            return truncate_to_tokens(description, token_limit, policy=TRIM_LINES_HEAD)
+
+        self._empty_cost = count_tokens(self.encode({'page_name': '', 'children': []}))
+        self._score(self.roots)
+
+        candidates = []
+        stack = list(self.roots)
+        while len(stack) > 0:
+            node = stack.pop()
+            candidates.append(node)
+            stack.extend(node.children)
+        # least relevant first; among equally relevant subtrees, the larger ones free more tokens
+        candidates.sort(key=lambda node: (node.score, -node.cost))
+
+        # per-widget estimates miss the nesting syntax of some encoders, so scale them to the actual total
+        scale = token_count / max(1, self._empty_cost + sum(node.cost for node in self.roots))
+
+        dropped = set()
+        excess = token_count - token_limit + count_tokens(OMISSION_NOTE.format(len(self._nodes))) + 1
+        for node in candidates:
+            ancestor = node.parent
+            while ancestor is not None and id(ancestor.info) not in dropped:
+                ancestor = ancestor.parent
+            if ancestor is not None:
+                continue # already left out with its ancestor
+
+            dropped.add(id(node.info))
+            excess -= node.cost * scale
+            # the subtree no longer counts towards its ancestors
+            ancestor = node.parent
+            while ancestor is not None:
+                ancestor.cost -= node.cost
+                ancestor = ancestor.parent
+
+            if excess > 0:
+                continue
+
+            description = self._describe_without(dropped)
+            token_count = count_tokens(description)
+            if token_count <= token_limit:
+                return description
+            excess = token_count - token_limit
+
+        # even the most relevant widgets do not fit
+        return truncate_to_tokens(self._describe_without(dropped), token_limit, policy=TRIM_LINES_HEAD)
+
+    def _count_kept(self, nodes, dropped):
+        return sum(1 + self._count_kept(node.children, dropped) for node in nodes if id(node.info) not in dropped)
+
+    def _describe_without(self, dropped):
+        view_hierarchy = self._filtered(self.view_hierarchy, dropped)
+        omitted = len(self._nodes) - self._count_kept(self.roots, dropped)
+        return self.encode(view_hierarchy) + '\n' + OMISSION_NOTE.format(omitted)
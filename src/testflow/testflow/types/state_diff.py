@@ -0,0 +1,199 @@
+from collections import defaultdict, deque
+
+MAX_ANCHOR_LENGTH = 40
+
+
+class StateDiff:
+    """
+    Structural difference between two GUI states
+    - added: widgets only in the new state
+    - removed: widgets only in the old state
+    - changed: (old widget, new widget, {property: (old value, new value)}) for matched widgets whose text, state or bounds differ
+    """
+    def __init__(self, old_state, new_state):
+        self.old_state = old_state
+        self.new_state = new_state
+        self.added = []
+        self.removed = []
+        self.changed = []
+
+    def is_empty(self):
+        return len(self.added) == 0 and len(self.removed) == 0 and len(self.changed) == 0
+
+
+def _positions(state):
+    """
+    :return: list of (widget, path) in pre-order, where path is the sequence of child indexes from the root
+    """
+    positions = []
+    stack = [(widget, (i,)) for i, widget in reversed(list(enumerate(state.root_widgets)))]
+    while len(stack) > 0:
+        widget, path = stack.pop()
+        positions.append((widget, path))
+        for i in range(len(widget.children) - 1, -1, -1):
+            stack.append((widget.children[i], path + (i,)))
+    return positions
+
+
+def _structural_key(widget, path):
+    return (widget.widget_type, widget.resource_id, path)
+
+
+def _changes(old_widget, new_widget):
+    changes = {}
+    if old_widget.text != new_widget.text:
+        changes['text'] = (old_widget.text, new_widget.text)
+    if old_widget.state != new_widget.state:
+        changes['state'] = (old_widget.state, new_widget.state)
+    if old_widget.bounds != new_widget.bounds:
+        changes['bounds'] = (old_widget.bounds, new_widget.bounds)
+    return changes
+
+
+def diff_states(old_state, new_state):
+    """
+    Match the widgets of two states in linear time: first by signature at the same position in the tree, then by
+    signature (in order of appearance among equal signatures), then the rest by widget type, resource ID and position
+    :return: StateDiff
+    """
+    diff = StateDiff(old_state, new_state)
+    old_positions = _positions(old_state)
+    new_positions = _positions(new_state)
+
+    matched_old = set()
+
+    def match(old_widget, widget):
+        matched_old.add(id(old_widget))
+        if old_widget is not widget:
+            changes = _changes(old_widget, widget)
+            if len(changes) > 0:
+                diff.changed.append((old_widget, widget, changes))
+
+    # unchanged widgets that kept their place, so that repeated widgets (e.g., list rows) are paired with their own row
+    old_in_place = {(widget.signature, path): widget for widget, path in old_positions}
+    moved_new = []
+    for widget, path in new_positions:
+        old_widget = old_in_place.get((widget.signature, path))
+        if old_widget is not None:
+            match(old_widget, widget)
+        else:
+            moved_new.append((widget, path))
+
+    old_by_signature = defaultdict(deque)
+    for widget, path in old_positions:
+        if id(widget) not in matched_old:
+            old_by_signature[widget.signature].append(widget)
+
+    unmatched_new = []
+    for widget, path in moved_new:
+        candidates = old_by_signature.get(widget.signature)
+        if candidates:
+            match(candidates.popleft(), widget)
+        else:
+            unmatched_new.append((widget, path))
+
+    old_by_position = {}
+    for widget, path in old_positions:
+        if id(widget) not in matched_old:
+            old_by_position.setdefault(_structural_key(widget, path), widget)
+
+    for widget, path in unmatched_new:
+        old_widget = old_by_position.pop(_structural_key(widget, path), None)
+        if old_widget is None:
+            diff.added.append(widget)
+            continue
+
+        # a matched container whose own properties are equal only differs in its descendants, which are diffed themselves
+        changes = _changes(old_widget, widget)
+        if len(changes) > 0:
+            diff.changed.append((old_widget, widget, changes))
+
+    diff.removed = list(old_by_position.values())
+
+    return diff
+
+
+def _label(widget):
+    label = widget.text or widget.content_description
+    if label is None or len(label.strip()) == 0:
+        return None
+    label = label.strip()
+    return label[:MAX_ANCHOR_LENGTH] + '[...]' if len(label) > MAX_ANCHOR_LENGTH else label
+
+
+def _parents(state):
+    """
+    :return: dict, id(widget) -> its parent (None for root widgets)
+    """
+    parents = {id(widget): None for widget in state.root_widgets}
+    stack = list(state.root_widgets)
+    while len(stack) > 0:
+        widget = stack.pop()
+        for child in widget.children:
+            parents[id(child)] = widget
+            stack.append(child)
+    return parents
+
+
+def _anchor(widget, state, parents):
+    """
+    :return: str, the label of the nearest sibling, ancestor or ancestor's sibling that has text (e.g., the title of
+        the list row a checkbox belongs to), or None
+    """
+    node = widget
+    while id(node) in parents:
+        parent = parents[id(node)]
+        siblings = parent.children if parent is not None else state.root_widgets
+        for sibling in siblings:
+            if sibling is not node and _label(sibling) is not None:
+                return _label(sibling)
+        if parent is None or _label(parent) is not None:
+            return _label(parent) if parent is not None else None
+        node = parent
+    return None
+
+
+def render_state_diff(diff, describe=lambda w: w.stringify(include_children_text=False), fromfile=None, tofile=None):
+    """
+    Render a StateDiff as unified-diff-like lines ("-" for the old screen, "+" for the new one); each change is
+    preceded by a context line naming the nearest widget with text, so that repeated widgets (e.g., the rows of a
+    list) can be told apart
+    :param describe: function, one-line description of a widget
+    :return: str, empty if no described widget changed
+    """
+    old_parents = new_parents = None
+    lines = []
+    last_anchor = None
+
+    def add_context(widget, state, parents):
+        nonlocal last_anchor
+        anchor = _anchor(widget, state, parents)
+        if anchor is not None and anchor != last_anchor:
+            lines.append(f' near "{anchor}":')
+        last_anchor = anchor
+
+    for old_widget, new_widget, _ in diff.changed:
+        old_line, new_line = describe(old_widget), describe(new_widget)
+        if old_line != new_line:
+            new_parents = new_parents or _parents(diff.new_state)
+            add_context(new_widget, diff.new_state, new_parents)
+            lines.append(f'-{old_line}')
+            lines.append(f'+{new_line}')
+    for widget in diff.removed:
+        old_parents = old_parents or _parents(diff.old_state)
+        add_context(widget, diff.old_state, old_parents)
+        lines.append(f'-{describe(widget)}')
+    for widget in diff.added:
+        new_parents = new_parents or _parents(diff.new_state)
+        add_context(widget, diff.new_state, new_parents)
+        lines.append(f'+{describe(widget)}')
+
+    if len(lines) == 0:
+        return ''
+
+    header = []
+    if fromfile is not None:
+        header.append(f'--- {fromfile}')
+    if tofile is not None:
+        header.append(f'+++ {tofile}')
+    return '\n'.join(header + lines)
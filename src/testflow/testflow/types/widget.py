@@ -1,14 +1,21 @@
-from functools import cached_property
-
 import json
-import copy
 
 
 class Widget:
+    """
+    Immutable record of a widget; it can be shared by consecutive GUI states, so the prompt-facing
+    forms (dict, JSON dump, natural language description) are computed once and cached
+    """
+    __slots__ = ['view_id', 'widget_type', 'possible_action_types', 'children', 'elem_dict', 'subtree_key', '_cache']
+
     def __init__(self):
         self.view_id = None
         self.widget_type = None
         self.possible_action_types = []
+        self.children = []
+        self.elem_dict = {}
+        self.subtree_key = None
+        self._cache = {}
 
     def from_dict(self, elem_dict):
         self.view_id = elem_dict.get('ID', None)
@@ -20,12 +27,20 @@ class Widget:
             del elem_dict['children']
         
         self.elem_dict = elem_dict
+        self._cache = {}
 
         return self
 
-    def to_dict(self, include_id=True, only_rep_property=True):
-        children = [child.to_dict(include_id=include_id) for child in self.children]
-        elem_dict = copy.deepcopy(self.elem_dict)
+    def _cached(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def _own_dict(self, include_id, only_rep_property):
+        """
+        Prompt-facing properties of the widget itself (without children)
+        """
+        elem_dict = dict(self.elem_dict)
 
         del elem_dict['class']
         del elem_dict['bounds']
@@ -42,29 +57,48 @@ class Widget:
         if 'view_str' in elem_dict:
             del elem_dict['view_str']
 
-        if len(children) > 0:
-            elem_dict['children'] = children
-
         return elem_dict
 
-    @cached_property
+    def _tree_dict(self, include_id, only_rep_property):
+        """
+        Prompt-facing dict of the whole subtree, built once per combination of flags from the cached dicts of the children
+        """
+        def compute():
+            elem_dict = self._own_dict(include_id, only_rep_property)
+            if len(self.children) > 0:
+                elem_dict['children'] = [child._tree_dict(include_id, only_rep_property) for child in self.children]
+            return elem_dict
+
+        return self._cached(('dict', include_id, only_rep_property), compute)
+
+    def to_dict(self, include_id=True, only_rep_property=True):
+        """
+        :return: dict, a fresh (shallow) copy that the caller may modify; the dicts of the children are shared
+                 with the cache and must not be modified
+        """
+        return dict(self._tree_dict(include_id, only_rep_property))
+
+    @property
     def bounds(self):
         return self.elem_dict['bounds']
         
-    @cached_property
+    @property
     def text(self):
         return self.elem_dict.get('text', None)
 
-    @cached_property
+    @property
     def resource_id(self):
         return self.elem_dict.get('resource_id', None)
 
-    @cached_property
+    @property
     def content_description(self):
         return self.elem_dict.get('content_description', None)
 
-    @cached_property
+    @property
     def all_text(self):
+        return self._cached('all_text', self._all_text)
+
+    def _all_text(self):
         texts = []
         if self.text is not None and len(self.text.strip()) > 0:
             if len(self.text) > 50:
@@ -77,12 +111,15 @@ class Widget:
         
         return texts
 
-    @cached_property
+    @property
     def state(self):
         return self.elem_dict.get('state', [])
 
-    @cached_property
+    @property
     def signature(self):
+        return self._cached('signature', self._signature)
+
+    def _signature(self):
         immutable_props = ['content_description', 'resource_id']
         if 'set_text' not in self.possible_action_types:
             immutable_props.append('text')
@@ -135,12 +172,15 @@ class Widget:
             ]
         }
         """
-        return json.dumps(self.to_dict(), indent=indent, ensure_ascii=False)
+        return self._cached(('dump', indent), lambda: json.dumps(self.to_dict(), indent=indent, ensure_ascii=False))
 
     def stringify(self, include_children_text=True):
         """
         natural language description of the widget
         """
+        return self._cached(('stringify', include_children_text), lambda: self._stringify(include_children_text))
+
+    def _stringify(self, include_children_text):
         widget_type = self.widget_type
         widget_desc = ''
 
@@ -0,0 +1,94 @@
+import io
+import os
+import base64
+import threading
+
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:  # screenshots are then sent as they are
+    Image = None
+
+# resolution the vision models actually look at for each detail level
+DETAIL_LOW = "low"
+DETAIL_HIGH = "high"
+LOW_DETAIL_SIZE = 512  # the image is scaled to fit in 512x512
+HIGH_DETAIL_MAX_SIZE = 2048  # first scaled to fit in 2048x2048...
+HIGH_DETAIL_SHORT_SIDE = 768  # ...then so that the shortest side is 768
+
+IMAGE_FORMAT = os.environ.get("TESTFLOW_SCREENSHOT_FORMAT", "jpeg").lower()
+IMAGE_QUALITY = int(os.environ.get("TESTFLOW_SCREENSHOT_QUALITY", 80))
+MAX_CACHED_IMAGES = 64
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def target_size(width, height, detail=DETAIL_LOW):
+    """
+    :return: (int, int), the size an image is reduced to by the vision model for the given detail level
+    """
+    if detail == DETAIL_LOW:
+        scale = min(1, LOW_DETAIL_SIZE / max(width, height))
+    else:
+        scale = min(1, HIGH_DETAIL_MAX_SIZE / max(width, height))
+        scale *= min(1, HIGH_DETAIL_SHORT_SIDE / (min(width, height) * scale))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class ImageEncoder:
+    """
+    Downsizes screenshots to the resolution used by the vision model, re-encodes them in a compact
+    format and caches the resulting data URLs (keyed by state tag, or by path and mtime)
+    """
+
+    image_format = IMAGE_FORMAT
+    quality = IMAGE_QUALITY
+
+    _lock = threading.Lock()
+    _cache = OrderedDict()
+
+    @classmethod
+    def _encode(cls, image_path, detail):
+        if Image is None:
+            # the file is sent as it is, so label it with its own format
+            extension = os.path.splitext(image_path)[1].lstrip(".").lower().replace("jpg", "jpeg")
+            with open(image_path, "rb") as f:
+                return MIME_TYPES.get(extension, MIME_TYPES["png"]), f.read()
+
+        with Image.open(image_path) as image:
+            image = image.convert("RGB") if cls.image_format == "jpeg" else image.copy()
+        image = image.resize(target_size(*image.size, detail=detail), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        if cls.image_format == "png":
+            image.save(buffer, format="PNG", optimize=True)
+        else:
+            image.save(buffer, format=cls.image_format.upper(), quality=cls.quality)
+        return MIME_TYPES[cls.image_format], buffer.getvalue()
+
+    @classmethod
+    def encode(cls, image_path, detail=DETAIL_LOW, cache_key=None):
+        """
+        :param image_path: str, path to the screenshot
+        :param cache_key: str, e.g. the state tag of the screenshot; defaults to its path and mtime
+        :return: str, a data URL of the preprocessed image
+        """
+        if cache_key is None:
+            cache_key = f"{image_path}:{os.path.getmtime(image_path)}"
+        key = (cache_key, detail, cls.image_format)
+
+        with cls._lock:
+            if key in cls._cache:
+                cls._cache.move_to_end(key)
+                return cls._cache[key]
+
+        mime_type, data = cls._encode(image_path, detail)
+        data_url = f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+        with cls._lock:
+            cls._cache[key] = data_url
+            while len(cls._cache) > MAX_CACHED_IMAGES:
+                cls._cache.popitem(last=False)
+
+        return data_url
@@ -14,8 +14,18 @@ class PromptRecorder:
     @classmethod
     def record(cls, prompt, mode):
         prompt_str = stringify_prompt(prompt)
-        with open(os.path.join(agent_config.agent_output_dir, 'prompts', f'prompt_{cls.state_tag}_{datetime.now().strftime("%H%M%S")}_{mode}.txt'), 'w', encoding='utf-8') as f:
-            f.write(prompt_str)
+        file_name = f'prompt_{cls.state_tag}_{datetime.now().strftime("%H%M%S")}_{mode}'
+
+        # prompts of the same mode may be recorded in the same second (e.g., concurrent widget knowledge
+        # summaries): exclusive creation gives each of them its own file
+        suffix = ''
+        while True:
+            try:
+                with open(os.path.join(agent_config.agent_output_dir, 'prompts', f'{file_name}{suffix}.txt'), 'x', encoding='utf-8') as f:
+                    f.write(prompt_str)
+                return
+            except FileExistsError:
+                suffix = f'_{int(suffix[1:]) + 1}' if suffix else '_1'
 
     @classmethod
     def record_gptdroid_conversation(cls, current_prompt, full_prompt):
@@ -0,0 +1,222 @@
+import os
+import math
+
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # fall back to an estimate that still accounts for wide (CJK) characters
+    tiktoken = None
+
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-turbo-2024-04-09": 128000,
+    "gpt-4-0613": 8192,
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-3.5-turbo-16k-0613": 16385,
+    "gpt-3.5-turbo-0613": 4096,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Upper bound on prompt size regardless of the model window, to keep per-step cost bounded
+PROMPT_TOKEN_LIMIT = int(os.environ.get("TESTFLOW_PROMPT_TOKEN_LIMIT", 8000))
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators of each chat message
+TRUNCATION_MARKER = "[...truncated...]"
+
+TRIM_HEAD = "head"  # keep the beginning
+TRIM_TAIL = "tail"  # keep the end (e.g., the most recent history)
+TRIM_LINES_HEAD = "lines_head"  # keep whole lines from the beginning
+TRIM_LINES_TAIL = "lines_tail"  # keep whole lines from the end
+TRIM_POLICIES = [TRIM_HEAD, TRIM_TAIL, TRIM_LINES_HEAD, TRIM_LINES_TAIL]
+
+DEFAULT_SECTION_WEIGHTS = {
+    "history": 0.3,
+    "screen": 0.5,
+    "knowledge": 0.2,
+}
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base" if "4o" in model else "cl100k_base")
+
+
+def _is_wide_char(c):
+    return ord(c) >= 0x2E80
+
+
+def count_tokens(text, model="gpt-4o"):
+    if not text:
+        return 0
+
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    wide_chars = sum(1 for c in text if _is_wide_char(c))
+    return wide_chars + math.ceil((len(text) - wide_chars) / 4)
+
+
+def count_message_tokens(messages, model="gpt-4o"):
+    """
+    Count the prompt tokens of chat-completions messages (images are not counted)
+    """
+    token_count = 0
+    for message in messages:
+        token_count += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                token_count += count_tokens(part.get("text", ""), model)
+        elif content is not None:
+            token_count += count_tokens(content, model)
+
+        for tool_call in message.get("tool_calls", None) or []:
+            token_count += count_tokens(tool_call["function"]["name"], model)
+            token_count += count_tokens(tool_call["function"]["arguments"], model)
+
+    return token_count
+
+
+def get_context_window(model):
+    return MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+def truncate_to_tokens(text, max_tokens, policy=TRIM_HEAD, model="gpt-4o"):
+    """
+    Trim a text so that it fits in `max_tokens` tokens (including the truncation marker)
+    """
+    assert policy in TRIM_POLICIES, f"Unsupported trimming policy: {policy}"
+
+    if text is None or count_tokens(text, model) <= max_tokens:
+        return text
+
+    budget = max(0, max_tokens - count_tokens(TRUNCATION_MARKER, model))
+    keep_tail = policy in [TRIM_TAIL, TRIM_LINES_TAIL]
+
+    if policy in [TRIM_LINES_HEAD, TRIM_LINES_TAIL]:
+        lines = text.split("\n")
+        if keep_tail:
+            lines = lines[::-1]
+
+        kept_lines = []
+        used = 0
+        for line in lines:
+            line_tokens = count_tokens(line, model) + 1
+            if used + line_tokens > budget:
+                break
+            kept_lines.append(line)
+            used += line_tokens
+
+        if keep_tail:
+            return TRUNCATION_MARKER + "\n" + "\n".join(kept_lines[::-1])
+        return "\n".join(kept_lines) + "\n" + TRUNCATION_MARKER
+
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if keep_tail:
+            return TRUNCATION_MARKER + encoding.decode(tokens[len(tokens) - budget :])
+        return encoding.decode(tokens[:budget]) + TRUNCATION_MARKER
+
+    # binary search on the character length that fits
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        part = text[len(text) - mid :] if keep_tail else text[:mid]
+        if count_tokens(part, model) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+
+    if keep_tail:
+        return TRUNCATION_MARKER + text[len(text) - low :]
+    return text[:low] + TRUNCATION_MARKER
+
+
+class PromptBudget:
+    """
+    Splits the prompt budget of a model across the sections of a prompt.
+    Fixed parts (system prompt, instructions, earlier turns) are charged first; the remainder is
+    shared by the sections in proportion to their weights, and whatever a section does not
+    need is handed to the sections that do. Each section is then trimmed with its own policy.
+    """
+
+    def __init__(self, model, max_completion_tokens=500, prompt_token_limit=PROMPT_TOKEN_LIMIT):
+        self.model = model
+        self.total = (
+            min(get_context_window(model), prompt_token_limit + max_completion_tokens)
+            - max_completion_tokens
+        )
+        self.fixed_tokens = 0
+
+    def reserve(self, *texts):
+        for text in texts:
+            if text is None:
+                continue
+            if isinstance(text, str):
+                self.fixed_tokens += count_tokens(text, self.model)
+            else:
+                self.fixed_tokens += count_message_tokens(text, self.model)
+        return self
+
+    @property
+    def remaining(self):
+        return max(0, self.total - self.fixed_tokens)
+
+    def allocate(self, sections):
+        """
+        :param sections: dict, section name -> (text, trimming policy[, weight])
+        :return: dict, section name -> token allocation
+        """
+        needs = {}
+        weights = {}
+        for name, section in sections.items():
+            needs[name] = count_tokens(section[0], self.model)
+            weights[name] = (
+                section[2] if len(section) > 2 else DEFAULT_SECTION_WEIGHTS.get(name, 0.2)
+            )
+
+        allocation = {}
+        budget = self.remaining
+        pending = [name for name in sections]
+        while len(pending) > 0:
+            total_weight = sum(weights[name] for name in pending) or 1
+            shares = {name: budget * weights[name] / total_weight for name in pending}
+            satisfied = [name for name in pending if needs[name] <= shares[name]]
+            if len(satisfied) == 0:
+                for name in pending:
+                    allocation[name] = int(shares[name])
+                break
+
+            for name in satisfied:
+                allocation[name] = needs[name]
+                budget -= needs[name]
+                pending.remove(name)
+
+        return allocation
+
+    def fit(self, sections):
+        """
+        :param sections: dict, section name -> (text, trimming policy[, weight]); the policy can also be a
+                         function(max_tokens) -> text for sections that know how to shorten themselves
+        :return: dict, section name -> text trimmed to its allocation
+        """
+        allocation = self.allocate(sections)
+        fitted = {}
+        for name, section in sections.items():
+            if callable(section[1]):
+                fitted[name] = section[1](allocation[name])
+            else:
+                fitted[name] = truncate_to_tokens(
+                    section[0], allocation[name], policy=section[1], model=self.model
+                )
+        return fitted
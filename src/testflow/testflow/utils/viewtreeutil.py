@@ -1,4 +1,3 @@
-import copy
 """
 Getters
 """
@@ -29,9 +28,8 @@ Process DroidBot view tree
 def minimize_view_tree(view_tree):
     """
     Remove non-informative nodes from the view tree
+    The given tree is left untouched: nodes that are kept or modified are shallow-copied
     """
-    view_tree = copy.deepcopy(view_tree)
-    
     new_root_elems = []
     for root_elem in prune_elements(view_tree):
         new_root_elems.extend(additionally_prune_elements(root_elem))
@@ -40,6 +38,7 @@ def minimize_view_tree(view_tree):
 
 
 def prune_elements(elem):
+    elem = dict(elem)
     if is_meaningful_element(elem):
         # If the current node is interactable or has a text property, recursively prune its children
         if "children" in elem and isinstance(elem["children"], list):